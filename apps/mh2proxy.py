@@ -218,7 +218,8 @@ class CMeshInfo:
         self.shapes = []
         self.vertexMask = None
         self.faceMask = None
-        self.vertexMapping = None   # Maps vertex index of original object to the attached filtered object 
+        self.vertexMapping = None   # Maps vertex index of original object to the attached filtered object (-1 if filtered out)
+        self.uvMapping = None       # Maps uv index of original object to the attached filtered object (-1 if filtered out)
 
 
     def fromProxy(self, coords, texVerts, faceVerts, faceUvs, weights, shapes):
@@ -809,42 +810,46 @@ def fixProxyVGroup(vgroup):
     return fixedVGroup
 
 
+def getProxyVertWeightArrays(proxy):
+    """
+    The vertex weights of a proxy as flat arrays (verts, proxyVerts, weights),
+    proxy vertex proxyVerts[i] follows base vertex verts[i] with weights[i].
+    """
+    verts = []
+    pverts = []
+    weights = []
+    for (v, vlist) in proxy.vertWeights.items():
+        for (pv, w) in vlist:
+            verts.append(v)
+            pverts.append(pv)
+            weights.append(w)
+    return (numpy.asarray(verts, dtype=numpy.int32),
+            numpy.asarray(pverts, dtype=numpy.int32),
+            numpy.asarray(weights, dtype=float))
+
+
 def getProxyShapes(rawShapes, proxy, scale):
     if (not rawShapes) or (proxy.type not in ['Proxy', 'Clothes']):
         return []
+    verts, pverts, weights = getProxyVertWeightArrays(proxy)
+    if len(verts) == 0:
+        return []
+    nVerts = verts.max() + 1
+    nProxyVerts = pverts.max() + 1
     shapes = []
-    for (key, rawShape) in rawShapes:
-        shape = []
-        for (v,dr) in rawShape.items():    
-            (dx,dy,dz) = dr
-            try:
-                vlist = proxy.vertWeights[v]
-            except KeyError:
-                vlist = []
-            for (pv, w) in vlist:
-                shape.append((pv, scale*w*dx, scale*w*dy, scale*w*dz))
-        if shape != []:
-            fixedShape = fixProxyShape(shape)
-            shapes.append((key,fixedShape))
+    for (key, (indices, deltas)) in rawShapes:
+        # Scatter the shape to the base vertices the proxy depends on
+        dense = numpy.zeros((nVerts, 3), float)
+        used = numpy.zeros(nVerts, bool)
+        inside = indices < nVerts
+        dense[indices[inside]] = deltas[inside]
+        used[indices[inside]] = True
+        if not used[verts].any():
+            continue
+        shape = numpy.zeros((nProxyVerts, 3), float)
+        for axis in range(3):
+            shape[:,axis] = numpy.bincount(pverts, scale * weights * dense[verts,axis], minlength=nProxyVerts)
+        pindices = numpy.flatnonzero(numpy.sum(shape*shape, axis=1) > 1e-8).astype(numpy.int32)
+        shapes.append((key, (pindices, shape[pindices])))
     return shapes
-
-
-def fixProxyShape(shape):
-    fixedShape = {}
-    shape.sort()
-    pv = -1
-    #while shape:
-    #    (pv0, dx0, dy0, dz0) = shape.pop()
-    for (pv0, dx0, dy0, dz0) in shape:
-        if pv0 == pv:
-            dx += dx0
-            dy += dy0
-            dz += dz0
-        else:
-            if pv >= 0 and (dx*dx + dy*dy + dz*dz) > 1e-8:
-                fixedShape[pv] = (dx, dy, dz)
-            (pv, dx, dy, dz) = (pv0, dx0, dy0, dz0)        
-    if pv >= 0 and (dx*dx + dy*dy + dz*dz) > 1e-8:
-        fixedShape[pv] = (dx, dy, dz)
-    return fixedShape
     
@@ -0,0 +1,335 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Batch reading of .mhm files and a compact file format for populations of
+characters.
+
+Unlike Human.load, the functions in this module do not need the
+application, its load handlers or a scene: .mhm files are only parsed,
+optionally in several processes, into a ModelTable holding one row of
+modifier values and one set of choices (proxy, skin, clothes, ...) per file.
+
+A population file stores such rows for any number of characters in fixed
+size binary records, followed by a JSON footer describing the columns. The
+records are memory mapped when reading, so that populations much larger
+than memory can be streamed into whatever builds the meshes.
+"""
+
+import os
+import json
+import struct
+import numpy
+import multiprocessing
+
+# Keywords of .mhm lines that set a modifier value, as "<keyword> <name> <value>"
+ModifierKeywords = ('macro', 'face', 'torso', 'armslegs', 'gendered', 'asymmetry',
+                    'detail', 'microdetail', 'measure', 'expression', 'custom')
+
+# Keywords of .mhm lines that are not part of a character
+IgnoredKeywords = ('version', 'tags')
+
+# Number of files handed to a worker process at once
+ChunkSize = 64
+
+def parseMhm(filename):
+    """
+    Parse a .mhm file without applying it.
+    Returns (values, choices), where values maps modifier columns, named
+    "<keyword>/<name>" (or "<name>" for the macro lines of old files), to
+    their value and choices maps the other keywords to the list of the
+    remainders of their lines.
+    """
+    values = {}
+    choices = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            words = line.split()
+            if not words or words[0].startswith('#') or words[0] in IgnoredKeywords:
+                continue
+            try:
+                if words[0] in ModifierKeywords and len(words) == 3:
+                    values['%s/%s' % (words[0], words[1])] = float(words[2])
+                    continue
+                elif len(words) == 2:
+                    # Macro values in files of older versions, as "<name> <value>"
+                    values[words[0]] = float(words[1])
+                    continue
+            except ValueError:
+                pass
+            choices.setdefault(words[0], []).append(' '.join(words[1:]))
+    return values, choices
+
+def _parseMhm(filename):
+    try:
+        return parseMhm(filename)
+    except (IOError, OSError):
+        return None
+
+class ModelTable(object):
+    """
+    The settings of a list of characters in columns.
+
+    - **self.names**: *list of string* The name of each character, usually
+      the file it was read from.
+    - **self.columns**: *list of string* The modifier columns.
+    - **self.values**: *float array (n, nColumns)* The modifier values, NaN
+      where a character does not set a modifier.
+    - **self.choiceKeys**: *list of string* The choice keywords.
+    - **self.choices**: *dict* For every choice keyword, the list of its
+      values per character, each a tuple of the lines for that keyword.
+    """
+
+    def __init__(self, names, columns, values, choiceKeys, choices):
+        self.names = names
+        self.columns = columns
+        self.values = values
+        self.choiceKeys = choiceKeys
+        self.choices = choices
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def fromParsed(cls, names, parsed):
+        """
+        Build a table from a list of (values, choices) as returned by
+        parseMhm.
+        """
+        columns = sorted(set(key for values, _ in parsed for key in values))
+        choiceKeys = sorted(set(key for _, choices in parsed for key in choices))
+        index = dict((column, i) for i, column in enumerate(columns))
+
+        table = numpy.empty((len(parsed), len(columns)), dtype=numpy.float32)
+        table.fill(numpy.nan)
+        for row, (values, _) in enumerate(parsed):
+            if values:
+                table[row, [index[key] for key in values.iterkeys()]] = values.values()
+
+        choices = dict((key, [tuple(c.get(key, ())) for _, c in parsed]) for key in choiceKeys)
+        return cls(list(names), columns, table, choiceKeys, choices)
+
+    def column(self, name):
+        return self.values[:, self.columns.index(name)]
+
+    def getCharacter(self, i):
+        """
+        The (values, choices) of character i, as returned by parseMhm.
+        """
+        row = self.values[i]
+        values = dict((column, float(value)) for column, value in zip(self.columns, row) if not numpy.isnan(value))
+        choices = dict((key, list(self.choices[key][i])) for key in self.choiceKeys if self.choices[key][i])
+        return values, choices
+
+def loadModels(filenames, processes = None, chunkSize = ChunkSize):
+    """
+    Parse a list of .mhm files into a ModelTable, in processes worker
+    processes (one per cpu if None, no workers if 1). Files that can not be
+    read are left out.
+    """
+    filenames = list(filenames)
+    if processes == 1 or len(filenames) <= chunkSize:
+        parsed = map(_parseMhm, filenames)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            parsed = pool.map(_parseMhm, filenames, chunkSize)
+        finally:
+            pool.close()
+            pool.join()
+
+    names = [name for name, p in zip(filenames, parsed) if p is not None]
+    parsed = [p for p in parsed if p is not None]
+    return ModelTable.fromParsed(names, parsed)
+
+def loadModelFolder(folder, processes = None):
+    """
+    Parse all .mhm files below folder into a ModelTable.
+    """
+    filenames = []
+    for root, dirs, files in os.walk(folder):
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() == '.mhm':
+                filenames.append(os.path.join(root, name))
+    return loadModels(filenames, processes)
+
+#----------------------------------------------------------
+#   Population files
+#----------------------------------------------------------
+
+Magic = 'MHPOP001'
+
+# Record value for a choice that is not set
+NoChoice = 0xFFFFFFFF
+
+def _recordType(nColumns, nChoices, dtype):
+    return numpy.dtype([('values', dtype, (nColumns,)), ('choices', numpy.uint32, (nChoices,))])
+
+class PopulationWriter(object):
+    """
+    Writes a population file record by record, so that it never has to be
+    held in memory. The columns and choice keywords are fixed when the file
+    is created. Use float16 values to halve the size of the records.
+    """
+
+    def __init__(self, filename, columns, choiceKeys, dtype = numpy.float32):
+        self.filename = filename
+        self.columns = list(columns)
+        self.choiceKeys = list(choiceKeys)
+        self.dtype = numpy.dtype(dtype)
+        self.recordType = _recordType(len(self.columns), len(self.choiceKeys), self.dtype)
+        self.vocabulary = []
+        self.codes = {}
+        self.count = 0
+        self.file = open(filename, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _code(self, choice):
+        if not choice:
+            return NoChoice
+        choice = '\n'.join(choice)
+        if choice not in self.codes:
+            self.codes[choice] = len(self.vocabulary)
+            self.vocabulary.append(choice)
+        return self.codes[choice]
+
+    def write(self, values, choices = None):
+        """
+        Append characters given as an (n, nColumns) array of values and, for
+        every choice keyword, a list of n choices (sequences of lines).
+        """
+        values = numpy.asarray(values).reshape(-1, len(self.columns))
+        records = numpy.zeros(len(values), dtype=self.recordType)
+        records['values'] = values
+        for k, key in enumerate(self.choiceKeys):
+            column = choices.get(key) if choices else None
+            if column is None:
+                records['choices'][:, k] = NoChoice
+            else:
+                records['choices'][:, k] = [self._code(choice) for choice in column]
+        records.tofile(self.file)
+        self.count += len(records)
+
+    def writeTable(self, table, start = 0, end = None):
+        """
+        Append the rows start to end of a ModelTable.
+        """
+        if end is None:
+            end = len(table)
+        index = dict((column, i) for i, column in enumerate(table.columns))
+        values = numpy.empty((end - start, len(self.columns)), dtype=numpy.float32)
+        values.fill(numpy.nan)
+        for i, column in enumerate(self.columns):
+            if column in index:
+                values[:, i] = table.values[start:end, index[column]]
+        choices = dict((key, table.choices[key][start:end]) for key in self.choiceKeys if key in table.choices)
+        self.write(values, choices)
+
+    def close(self):
+        if self.file is None:
+            return
+        footer = json.dumps({
+            'count': self.count,
+            'columns': self.columns,
+            'choiceKeys': self.choiceKeys,
+            'dtype': self.dtype.str,
+            'vocabulary': self.vocabulary,
+            })
+        self.file.write(footer)
+        self.file.write(struct.pack('<Q', len(footer)))
+        self.file.write(Magic)
+        self.file.close()
+        self.file = None
+
+def writePopulation(filename, table, dtype = numpy.float32):
+    """
+    Write a ModelTable as a population file.
+    """
+    with PopulationWriter(filename, table.columns, table.choiceKeys, dtype) as writer:
+        writer.writeTable(table)
+
+class Population(object):
+    """
+    A population file opened for reading. The records are memory mapped,
+    characters are only read from disk when they are accessed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            f.seek(-len(Magic) - 8, os.SEEK_END)
+            size = struct.unpack('<Q', f.read(8))[0]
+            if f.read(len(Magic)) != Magic:
+                raise RuntimeError('%s is not a population file' % filename)
+            f.seek(-len(Magic) - 8 - size, os.SEEK_END)
+            header = json.loads(f.read(size))
+
+        self.count = header['count']
+        self.columns = [str(column) for column in header['columns']]
+        self.choiceKeys = [str(key) for key in header['choiceKeys']]
+        self.vocabulary = [tuple(choice.encode('utf-8').split('\n')) for choice in header['vocabulary']]
+        self.recordType = _recordType(len(self.columns), len(self.choiceKeys), numpy.dtype(str(header['dtype'])))
+        if self.count:
+            self.records = numpy.memmap(filename, dtype=self.recordType, mode='r', shape=(self.count,))
+        else:
+            self.records = numpy.zeros(0, dtype=self.recordType)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def values(self):
+        return self.records['values']
+
+    def _choices(self, codes):
+        return dict((key, [self.vocabulary[code] if code != NoChoice else () for code in codes[:, k]])
+                    for k, key in enumerate(self.choiceKeys))
+
+    def getTable(self, start = 0, end = None):
+        """
+        The characters start to end as a ModelTable.
+        """
+        if end is None:
+            end = self.count
+        records = self.records[start:end]
+        names = ['%s:%d' % (self.filename, i) for i in xrange(start, end)]
+        values = numpy.asarray(records['values'], dtype=numpy.float32)
+        return ModelTable(names, list(self.columns), values, list(self.choiceKeys), self._choices(records['choices']))
+
+    def iterTables(self, chunkSize = 4096):
+        """
+        Stream the population as ModelTables of chunkSize characters.
+        """
+        for start in xrange(0, self.count, chunkSize):
+            yield self.getTable(start, min(start + chunkSize, self.count))
+
+    def getCharacter(self, i):
+        """
+        The (values, choices) of character i, as returned by parseMhm.
+        """
+        return self.getTable(i, i + 1).getCharacter(0)
+
+def readPopulation(filename):
+    return Population(filename)
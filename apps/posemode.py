@@ -86,7 +86,7 @@ def exitPoseMode():
         theShadowBones = amt.store()
 
     InPoseMode = False
-    if warpmodifier.shadowCoords == None:
+    if warpmodifier.shadowCoords is None:
         halt
     warpmodifier.removeAllWarpTargets(human)        
     obj.changeCoords(warpmodifier.shadowCoords)
@@ -31,11 +31,10 @@ import mh
 import os
 
 import algos3d
-from algos3d import theHuman, NMHVerts
+from algos3d import NMHVerts
 import warp
 import humanmodifier
 import log
-from core import G
 
 shadowCoords = None
 
@@ -65,7 +64,7 @@ class WarpTarget(algos3d.Target):
         if self.isObsolete:
             halt
         if self.isDirty:
-            shape = self.modifier.compileWarpTarget(self.human)
+            shape = self.modifier.compileWarpTargetArrays(self.human)
             saveWarpedTarget(shape, self.modifier.warppath)
             self.__init__(self.modifier, self.human)
             self.isDirty = False
@@ -78,12 +77,13 @@ class WarpTarget(algos3d.Target):
 
 
 def saveWarpedTarget(shape, path): 
-    slist = list(shape.items())
-    slist.sort()
-    fp = open(path, "w")
-    for (n, dr) in slist:
-        fp.write("%d %.4f %.4f %.4f\n" % (n, dr[0], dr[1], dr[2]))
-    fp.close()
+    """
+    Save a shape, given as (indices, deltas) arrays, as a target file.
+    """
+    indices, deltas = shape
+    order = numpy.argsort(indices)
+    rows = numpy.column_stack([numpy.asarray(indices)[order], numpy.asarray(deltas).reshape(-1,3)[order]])
+    numpy.savetxt(path, rows, fmt="%d %.4f %.4f %.4f")
          
 #----------------------------------------------------------
 #   class WarpModifier
@@ -150,7 +150,7 @@ class WarpModifier (humanmodifier.SimpleModifier):
         self.bodypart = bodypart
         self.slider = None
         self.refTargets = {}
-        self.refTargetVerts = {}        
+        self.refTargetVerts = emptyShape()
         self.modtype = modtype
         
         self.fallback = None
@@ -246,7 +246,7 @@ class WarpModifier (humanmodifier.SimpleModifier):
 
 
     def updateValue(self, human, value, updateNormals=1):        
-        target = self.getWarpTarget(theHuman)    
+        target = self.getWarpTarget(algos3d.theHuman)
         if not target:
             return
         target.reinit()
@@ -259,17 +259,23 @@ class WarpModifier (humanmodifier.SimpleModifier):
 
 
     def compileWarpTarget(self, human):
-        global shadowCoords
+        indices, deltas = self.compileWarpTargetArrays(human)
+        return dict(zip(indices.tolist(), deltas))
+
+
+    def compileWarpTargetArrays(self, human):
+        return compileModifiers([self], human)[0]
+
+
+    def prepareWarp(self, human):
+        """
+        Update the reference object and the reference target of this
+        modifier for human, returning the unwarped (indices, deltas).
+        """
         log.message("Compile %s", self)
-        landmarks = theLandMarks()[self.bodypart]
         objectChanged = self.getRefObject(human)
         self.getRefTarget(human, objectChanged)    
-        if self.refTargetVerts and _theRefObjectVerts[self.modtype] is not None:
-            shape = warp.warp_target(self.refTargetVerts, _theRefObjectVerts[self.modtype], shadowCoords, landmarks)
-        else:
-            shape = {}
-        log.message("...done")
-        return shape
+        return self.refTargetVerts
 
 
     def getRefTarget(self, human, objectChanged):       
@@ -300,7 +306,9 @@ class WarpModifier (humanmodifier.SimpleModifier):
         
 
     def makeRefTarget(self, human):
-        self.refTargetVerts = {}
+        # Accumulate in a dense buffer, keep track of the vertices touched
+        refTarget = numpy.zeros((NMHVerts, 3), float)
+        used = numpy.zeros(NMHVerts, bool)
         madeRefTarget = False
         factors = self.fallback.getFactors(human, 1.0)
         
@@ -311,7 +319,10 @@ class WarpModifier (humanmodifier.SimpleModifier):
                 madeRefTarget = True
                 verts = self.getTargetInsist(target.path)
                 if verts is not None:
-                    addVerts(self.refTargetVerts, cval, verts)
+                    addVerts(refTarget, cval, verts)
+                    used[verts[0]] = True
+        indices = numpy.flatnonzero(used).astype(numpy.int32)
+        self.refTargetVerts = (indices, refTarget[indices])
         return madeRefTarget                            
     
 
@@ -396,7 +407,7 @@ class WarpModifier (humanmodifier.SimpleModifier):
             return False
         else:
             log.message("Reset warps")
-            refverts = numpy.array(G.app.selectedHuman.meshData.orig_coord)
+            refverts = numpy.array(human.meshData.orig_coord)
             for char in theRefObjects().keys():
                 cval = human.getDetail(char)
                 if cval:
@@ -411,7 +422,7 @@ class WarpModifier (humanmodifier.SimpleModifier):
     def getRefObjectVerts(self, path):
         refObjects = theRefObjects()
     
-        if refObjects[path]:
+        if refObjects[path] is not None:
             return refObjects[path]
         else:
             verts = readTarget(path)
@@ -455,48 +466,71 @@ def getWarpedCoords(human):
 def compileWarpTarget(template, fallback, human, bodypart):
     mod = WarpModifier(template, bodypart, fallback)
     return mod.compileWarpTarget(human)
+
+def compileWarpTargetArrays(template, fallback, human, bodypart):
+    mod = WarpModifier(template, bodypart, fallback)
+    return mod.compileWarpTargetArrays(human)
+
+def compileWarpTargetsArrays(templates, fallback, human, bodypart):
+    """
+    Compile the warp targets of a list of templates of the same modifier
+    type and body part, solving their common landmark system once.
+    """
+    mods = [WarpModifier(template, bodypart, fallback) for template in templates]
+    return compileModifiers(mods, human)
+
+def compileModifiers(mods, human):
+    """
+    Warp the reference targets of a list of warp modifiers, with one RBF
+    evaluation for every (modifier type, body part).
+    """
+    shapes = [emptyShape() for mod in mods]
+    groups = {}
+    for n,mod in enumerate(mods):
+        groups.setdefault((mod.modtype, mod.bodypart), []).append(n)
+
+    for (modtype, bodypart), members in groups.items():
+        landmarks = theLandMarks()[bodypart]
+        morphs = [(n, mods[n].prepareWarp(human)) for n in members]
+        morphs = [(n, morph) for (n, morph) in morphs if len(morph[0])]
+        if not morphs or _theRefObjectVerts[modtype] is None:
+            continue
+        warped = warp.warp_targets_arrays([morph for (n, morph) in morphs], _theRefObjectVerts[modtype], shadowCoords, landmarks)
+        for (n, morph), shape in zip(morphs, warped):
+            shapes[n] = shape
+    log.message("...done")
+    return shapes
                 
 #----------------------------------------------------------
 #   Read target
 #----------------------------------------------------------                
 
 def readTarget(path):
-    try:        
-        fp = open(path, "r")
-    except:
-        fp = None
-    if fp:
-        target = {}
-        for line in fp:
-            words = line.split()
-            if len(words) >= 4:
-                n = int(words[0])
-                if n < NMHVerts:
-                    target[n] = numpy.array([float(words[1]), float(words[2]), float(words[3])])
-        fp.close()
-        return target
-    else:
+    """
+    Read a target as (indices, deltas) arrays, using the compiled target
+    loader of algos3d. Returns None if the target does not exist.
+    """
+    target = algos3d.loadTargetData(path)
+    if target is None:
         log.message("Could not find %s" % os.path.realpath(path))
         return None
+    indices, deltas = target
+    mask = indices < NMHVerts
+    return (numpy.asarray(indices[mask], dtype=numpy.int32), 
+            numpy.asarray(deltas[mask], dtype=float))
 
-#----------------------------------------------------------
-#   For testing numpy
-#----------------------------------------------------------
 
-"""    
-import numpy
- 
-def addVerts(targetVerts, cval, verts):     
-    return targetVerts + cval*verts
-    
-""" 
-def addVerts(targetVerts, cval, verts):                    
-    for n,v in verts.items():
-        dr = cval*v
-        try:
-            targetVerts[n] += dr
-        except KeyError:
-            targetVerts[n] = dr
+def emptyShape():
+    return (numpy.zeros(0, numpy.int32), numpy.zeros((0,3), float))
+
+
+def addVerts(targetVerts, cval, verts):
+    """
+    Add the target verts = (indices, deltas), scaled by cval, to the dense
+    (n,3) coordinate buffer targetVerts.
+    """
+    indices, deltas = verts
+    targetVerts[indices] += cval*deltas
     
 #----------------------------------------------------------
 #   Init globals
@@ -116,7 +116,7 @@ class Target:
         if iname not in Target.npzfile:
             log.message('compiled file missing: %s', iname)
             raise RuntimeError()
-        if vector not in Target.npzfile:
+        if vname not in Target.npzfile:
             log.message('compiled file missing: %s', vname)
             raise RuntimeError()
         self.verts = Target.npzfile[iname]
@@ -132,10 +132,10 @@ class Target:
         if not os.path.exists(vname):
             log.message('compiled file missing: %s', name)
             raise RuntimeError()
-        if os.path.getmtime(iname) < path.getmtime(name):
+        if os.path.getmtime(iname) < os.path.getmtime(name):
             log.message('compiled file out of date: %s', iname)
             raise RuntimeError()
-        if os.path.getmtime(vname) < path.getmtime(name):
+        if os.path.getmtime(vname) < os.path.getmtime(name):
             log.message('compiled file out of date: %s', vname)
             raise RuntimeError()
         self.verts = np.load(iname)
@@ -217,6 +217,28 @@ class Target:
             
         return False
 
+class TargetData(Target):
+    """
+    The translation data of a target, loaded with the same (compiled) target
+    loader as Target but without binding it to an object.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.morphFactor = -1
+        self._load(self.name)
+
+def loadTargetData(targetPath):
+    """
+    Load a target file as an array of vertex indices and an (n,3) array of
+    translation vectors. Returns None if the target could not be loaded.
+    """
+    try:
+        target = TargetData(targetPath)
+    except StandardError:
+        return None
+    return target.verts, target.data
+
 def getTarget(obj, targetPath):
     """
     This function retrieves a set of translation vectors from a morphing 
@@ -85,7 +85,6 @@ class Object(events3d.EventHandler):
 
     @staticmethod
     def attachMesh(mesh):
-        selection.selectionColorMap.assignSelectionID(mesh)
         object3d.Object3D.attach(mesh)
 
     @staticmethod
@@ -694,12 +693,10 @@ class Application(events3d.EventHandler):
         return True
             
     def getSelectedFaceGroupAndObject(self):
-        picked = mh.getColorPicked()
-        return selection.selectionColorMap.getSelectedFaceGroupAndObject(picked)
+        return selection.getSelectedFaceGroupAndObject(mh.getPicked())
         
     def getSelectedFaceGroup(self):
-        picked = mh.getColorPicked()
-        return selection.selectionColorMap.getSelectedFaceGroup(picked)
+        return selection.getSelectedFaceGroup(mh.getPicked())
 
     def addCategory(self, category, sortOrder = None):
         if category.name in self.categories:
@@ -447,7 +447,6 @@ class MHApplication(gui3d.Application, mh.Application):
 
         #printtree(self)
 
-        mh.updatePickingBuffer();
         self.redraw()
 
     def startupSequence(self):
@@ -54,15 +54,12 @@ class FaceGroup(object):
     :type name: str
     """
 
-    black = np.zeros(3, dtype=np.uint8)
-
     def __init__(self, object, name, idx):
         self.object = object
         self.parent = object
         self.name = name
         self.idx = idx
         self.color = None
-        self.colorID = self.black
 
     def __str__(self):
         """
@@ -102,6 +99,8 @@ class Object3D(object):
         self.object3d = None
         self.vmap = None
         self.tmap = None
+        self.r_dirty = {}
+        self.coordRevision = 0
         self.priority = 0
         self.cull = 0
         self.MAX_FACES = 8
@@ -307,6 +306,7 @@ class Object3D(object):
         nverts = len(self.coord)
 
         if coor:
+            self.coordRevision += 1
             if indices is None:
                 self.ucoor = True
             else:
@@ -460,6 +460,9 @@ class Object3D(object):
 
         self.r_faces = np.array(iverts, dtype=np.uint32)
 
+        # Render buffers were reallocated, they have to be uploaded in full
+        self.r_dirty = {}
+
     def updateIndexBufferFaces(self):
         index = self.r_faces[self.face_mask]
         group = self.group[self.face_mask]
@@ -482,6 +485,7 @@ class Object3D(object):
 
         self.index = index
         self.grpix = grpix
+        self.markRender('index')
 
         self.ucoor = True
         self.unorm = True
@@ -489,6 +493,36 @@ class Object3D(object):
         self.utexc = True
         self.sync_all()
 
+    def markRender(self, name, mask = None):
+        """
+        Record which part of the render buffer name ('coord', 'vnorm',
+        'color', 'texco' or 'index') changed since the drawing code last
+        uploaded it, as a (start, end) range of rows.
+        A mask of None marks the whole buffer.
+        """
+        if mask is None:
+            self.r_dirty[name] = None
+            return
+        rows = np.flatnonzero(mask)
+        if len(rows) == 0:
+            return
+        start, end = int(rows[0]), int(rows[-1]) + 1
+        if name in self.r_dirty:
+            if self.r_dirty[name] is None:
+                return
+            start = min(start, self.r_dirty[name][0])
+            end = max(end, self.r_dirty[name][1])
+        self.r_dirty[name] = (start, end)
+
+    def popRenderChanges(self):
+        """
+        Return the render buffer changes recorded with markRender and forget
+        them.
+        """
+        dirty = self.r_dirty
+        self.r_dirty = {}
+        return dirty
+
     def sync_coord(self):
         if self.ucoor is False:
             return
@@ -496,8 +530,11 @@ class Object3D(object):
             return
         if self.ucoor is True:
             self.r_coord[...] = self.coord[self.vmap]
+            self.markRender('coord')
         else:
-            self.r_coord[self.ucoor[self.vmap]] = self.coord[self.vmap][self.ucoor[self.vmap]]
+            mask = self.ucoor[self.vmap]
+            self.r_coord[mask] = self.coord[self.vmap][mask]
+            self.markRender('coord', mask)
         self.ucoor = False
 
     def sync_norms(self):
@@ -507,8 +544,11 @@ class Object3D(object):
             return
         if self.unorm is True:
             self.r_vnorm[...] = self.vnorm[self.vmap]
+            self.markRender('vnorm')
         else:
-            self.r_vnorm[self.unorm[self.vmap]] = self.vnorm[self.vmap][self.unorm[self.vmap]]
+            mask = self.unorm[self.vmap]
+            self.r_vnorm[mask] = self.vnorm[self.vmap][mask]
+            self.markRender('vnorm', mask)
         self.unorm = False
 
     def sync_color(self):
@@ -518,8 +558,11 @@ class Object3D(object):
             return
         if self.ucolr is True:
             self.r_color[...] = self.color[self.vmap]
+            self.markRender('color')
         else:
-            self.r_color[self.ucolr[self.vmap]] = self.color[self.vmap][self.ucolr[self.vmap]]
+            mask = self.ucolr[self.vmap]
+            self.r_color[mask] = self.color[self.vmap][mask]
+            self.markRender('color', mask)
         self.ucolr = False
 
     def sync_texco(self):
@@ -529,8 +572,11 @@ class Object3D(object):
             return
         if self.utexc is True:
             self.r_texco[...] = self.texco[self.tmap]
+            self.markRender('texco')
         else:
-            self.r_texco[self.utexc[self.tmap]] = self.texco[self.tmap][self.utexc[self.tmap]]
+            mask = self.utexc[self.tmap]
+            self.r_texco[mask] = self.texco[self.tmap][mask]
+            self.markRender('texco', mask)
         self.utexc = False
 
     def sync_all(self):
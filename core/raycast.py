@@ -0,0 +1,313 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Ray casting against meshes, used for picking with the mouse and for
+visibility queries that do not need an OpenGL context.
+
+The triangles of a mesh are kept in a bounding volume hierarchy. Triangles
+are sorted along a Morton curve through their centroids and grouped in
+leaves of a fixed size, the leaves form a complete binary tree stored as a
+heap. Because the tree layout only depends on the triangle order, a change
+of the vertex coordinates only requires the bounding boxes to be refitted,
+which is done level by level with numpy.
+"""
+
+import weakref
+import numpy as np
+
+# Number of triangles in a leaf of the tree
+LeafSize = 8
+
+# Number of rays traced at once
+ChunkSize = 4096
+
+def _spreadBits(x):
+    """
+    Spread the lower 10 bits of x so that there are two zero bits between
+    every two bits, for interleaving them in a Morton code.
+    """
+    x = x.astype(np.uint32)
+    x = (x | (x << 16)) & 0x030000FF
+    x = (x | (x << 8)) & 0x0300F00F
+    x = (x | (x << 4)) & 0x030C30C3
+    x = (x | (x << 2)) & 0x09249249
+    return x
+
+def mortonOrder(points):
+    """
+    The order that sorts points along a Morton (Z-order) curve.
+    """
+    lo = points.min(axis=0)
+    extent = points.max(axis=0) - lo
+    extent[extent == 0] = 1
+    cells = ((points - lo) / extent * 1023).astype(np.uint32)
+    code = _spreadBits(cells[:,0]) | (_spreadBits(cells[:,1]) << 1) | (_spreadBits(cells[:,2]) << 2)
+    return np.argsort(code, kind='mergesort')
+
+class TriangleTree(object):
+    """
+    Bounding volume hierarchy over the triangles of a mesh.
+
+    - **self.triangles**: *int array (n,3)* The vertex indices of each
+      triangle, in the order of the tree.
+    - **self.order**: *int array (n,)* The index each triangle had in the
+      list it was built from.
+    - **self.lo**, **self.hi**: *float array (2*nLeaves,3)* The bounding box of
+      each node. Node 1 is the root, node i has the children 2i and 2i+1 and
+      the leaves are nodes nLeaves to 2*nLeaves-1.
+    """
+
+    def __init__(self, coords, triangles, leafSize = LeafSize):
+        coords = np.asarray(coords, dtype=np.float64)
+        triangles = np.asarray(triangles, dtype=np.int32).reshape(-1, 3)
+
+        self.leafSize = leafSize
+        if len(triangles):
+            self.order = mortonOrder(coords[triangles].mean(axis=1))
+        else:
+            self.order = np.zeros(0, dtype=np.intp)
+        self.triangles = triangles[self.order]
+
+        nLeaves = 1
+        while nLeaves * leafSize < len(self.triangles):
+            nLeaves *= 2
+        self.nLeaves = nLeaves
+
+        self.lo = np.empty((2 * nLeaves, 3), dtype=np.float64)
+        self.hi = np.empty((2 * nLeaves, 3), dtype=np.float64)
+        self.refit(coords)
+
+    def refit(self, coords):
+        """
+        Recalculate the bounding boxes for new vertex coordinates, keeping
+        the structure of the tree.
+        """
+        self.coords = np.asarray(coords, dtype=np.float64)
+        nLeaves = self.nLeaves
+        size = nLeaves * self.leafSize
+
+        corners = self.coords[self.triangles]
+        lo = np.empty((size, 3), dtype=np.float64)
+        hi = np.empty((size, 3), dtype=np.float64)
+        lo.fill(np.inf)
+        hi.fill(-np.inf)
+        lo[:len(corners)] = corners.min(axis=1)
+        hi[:len(corners)] = corners.max(axis=1)
+        self.lo[nLeaves:] = lo.reshape(nLeaves, self.leafSize, 3).min(axis=1)
+        self.hi[nLeaves:] = hi.reshape(nLeaves, self.leafSize, 3).max(axis=1)
+
+        level = nLeaves / 2
+        while level >= 1:
+            self.lo[level:2*level] = np.minimum(self.lo[2*level:4*level:2], self.lo[2*level+1:4*level:2])
+            self.hi[level:2*level] = np.maximum(self.hi[2*level:4*level:2], self.hi[2*level+1:4*level:2])
+            level /= 2
+
+    def intersect(self, origins, directions, chunkSize = ChunkSize, cull = 0):
+        """
+        Find the nearest triangle hit by each ray origin + t * direction,
+        with t >= 0. With cull > 0 only the front of triangles (where their
+        corners are counter-clockwise) can be hit, with cull < 0 only the
+        back, as for back face culling with Object3D.cull.
+
+        Returns the arrays (t, triangle, u, v), where triangle is the index
+        in the list of triangles the tree was built from, or -1 for rays that
+        hit nothing, and the hit point is (1-u-v) * v0 + u * v1 + v * v2.
+        """
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        nRays = len(origins)
+
+        t = np.empty(nRays, dtype=np.float64)
+        t.fill(np.inf)
+        tri = np.empty(nRays, dtype=np.int32)
+        tri.fill(-1)
+        u = np.zeros(nRays, dtype=np.float64)
+        v = np.zeros(nRays, dtype=np.float64)
+
+        if len(self.triangles) == 0:
+            return t, tri, u, v
+
+        for start in xrange(0, nRays, chunkSize):
+            end = min(start + chunkSize, nRays)
+            rays, hits = self._intersectChunk(origins[start:end], directions[start:end], cull)
+            if len(rays) == 0:
+                continue
+            rays += start
+            ht, htri, hu, hv = hits
+            t[rays] = ht
+            tri[rays] = self.order[htri]
+            u[rays] = hu
+            v[rays] = hv
+
+        return t, tri, u, v
+
+    def _candidates(self, origins, directions):
+        """
+        The (ray, leaf) pairs for which the ray passes through the bounding
+        box of the leaf.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inverse = 1.0 / directions
+
+        rays = np.arange(len(origins))
+        nodes = np.ones(len(origins), dtype=np.intp)
+        while True:
+            org = origins[rays]
+            inv = inverse[rays]
+            with np.errstate(invalid='ignore'):
+                t0 = (self.lo[nodes] - org) * inv
+                t1 = (self.hi[nodes] - org) * inv
+            tnear = np.nanmax(np.minimum(t0, t1), axis=1)
+            tfar = np.nanmin(np.maximum(t0, t1), axis=1)
+            hit = (tnear <= tfar) & (tfar >= 0) & np.all(self.lo[nodes] <= self.hi[nodes], axis=1)
+            rays = rays[hit]
+            nodes = nodes[hit]
+
+            if len(nodes) == 0 or nodes[0] >= self.nLeaves:
+                # All nodes in a step are on the same level of the tree
+                return rays, nodes - self.nLeaves
+
+            rays = np.repeat(rays, 2)
+            nodes = np.repeat(2 * nodes, 2)
+            nodes[1::2] += 1
+
+    def _intersectChunk(self, origins, directions, cull):
+        rays, leaves = self._candidates(origins, directions)
+
+        # Expand (ray, leaf) to (ray, triangle) pairs
+        rays = np.repeat(rays, self.leafSize)
+        tris = (leaves[:,None] * self.leafSize + np.arange(self.leafSize)[None,:]).ravel()
+        valid = tris < len(self.triangles)
+        rays = rays[valid]
+        tris = tris[valid]
+
+        # Moller-Trumbore ray/triangle intersection
+        corners = self.coords[self.triangles[tris]]
+        e1 = corners[:,1] - corners[:,0]
+        e2 = corners[:,2] - corners[:,0]
+        d = directions[rays]
+        p = np.cross(d, e2)
+        det = np.sum(e1 * p, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            invDet = 1.0 / det
+            s = origins[rays] - corners[:,0]
+            hu = np.sum(s * p, axis=1) * invDet
+            q = np.cross(s, e1)
+            hv = np.sum(d * q, axis=1) * invDet
+            ht = np.sum(e2 * q, axis=1) * invDet
+            hit = (det != 0) & (hu >= 0) & (hv >= 0) & (hu + hv <= 1) & (ht >= 0)
+        # The determinant is positive for rays hitting the front of a triangle
+        if cull > 0:
+            hit &= det > 0
+        elif cull < 0:
+            hit &= det < 0
+
+        rays, tris, ht, hu, hv = rays[hit], tris[hit], ht[hit], hu[hit], hv[hit]
+
+        # Keep the nearest hit of each ray
+        order = np.lexsort((ht, rays))
+        rays, tris, ht, hu, hv = rays[order], tris[order], ht[order], hu[order], hv[order]
+        first = np.ones(len(rays), dtype=bool)
+        first[1:] = rays[1:] != rays[:-1]
+
+        return rays[first], (ht[first], tris[first], hu[first], hv[first])
+
+def meshTriangles(fvert, faceMask = None):
+    """
+    Split the faces of a mesh in triangles.
+    Quads are split along their first diagonal, faces with their last vertex
+    equal to the first are triangles.
+    Returns the (n,3) vertex indices of the triangles and the face each one
+    belongs to.
+    """
+    fvert = np.asarray(fvert)
+    faces = np.arange(len(fvert))
+    if faceMask is not None:
+        faces = faces[faceMask]
+    fv = fvert[faces]
+
+    if fv.shape[1] == 3:
+        return fv.astype(np.int32), faces
+
+    quads = fv[:,3] != fv[:,0]
+    triangles = np.vstack([fv[:,[0,1,2]], fv[quads][:,[0,2,3]]])
+    faces = np.hstack([faces, faces[quads]])
+    return triangles.astype(np.int32), faces
+
+class MeshRayCaster(object):
+    """
+    Ray casting against the visible faces of a module3d.Object3D.
+    The tree is refitted when the coordinates of the mesh were marked as
+    changed, and rebuilt when its faces or face mask changed.
+    """
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+        self.tree = None
+        self.triangles = None
+        self.faces = None
+        self.fvert = None
+        self.faceMask = None
+        self.coordRevision = None
+
+    def update(self):
+        mesh = self.mesh
+        if (self.tree is None or self.fvert is not mesh.fvert or
+            not np.array_equal(self.faceMask, mesh.face_mask)):
+            self.triangles, self.faces = meshTriangles(mesh.fvert, mesh.face_mask)
+            self.tree = TriangleTree(mesh.coord, self.triangles)
+            self.fvert = mesh.fvert
+            self.faceMask = mesh.face_mask.copy()
+        elif self.coordRevision != mesh.coordRevision:
+            self.tree.refit(mesh.coord)
+        self.coordRevision = mesh.coordRevision
+
+    def intersect(self, origins, directions, cull = None):
+        """
+        Cast rays, given in the coordinate space of the mesh, at the mesh.
+        Faces that are culled when the mesh is drawn can not be hit, unless
+        cull is given, as for TriangleTree.intersect.
+
+        Returns the arrays (t, face, verts, barycentric) where face is the
+        index of the face hit or -1, verts are the (n,3) indices of the
+        vertices of the triangle hit and barycentric the (n,3) weights of
+        these vertices for the hit point.
+        """
+        self.update()
+        if cull is None:
+            cull = self.mesh.cull
+        t, tri, u, v = self.tree.intersect(origins, directions, cull = cull)
+        hit = tri >= 0
+        face = np.where(hit, self.faces[tri], -1)
+        verts = np.where(hit[:,None], self.triangles[tri], -1)
+        barycentric = np.column_stack([1 - u - v, u, v])
+        barycentric[~hit] = 0
+        return t, face, verts, barycentric
+
+_rayCasters = weakref.WeakKeyDictionary()
+
+def getRayCaster(mesh):
+    """
+    The ray caster of a module3d.Object3D, created on first use.
+    """
+    if mesh not in _rayCasters:
+        _rayCasters[mesh] = MeshRayCaster(mesh)
+    return _rayCasters[mesh]
@@ -82,12 +82,20 @@ where A = HT H, b = HT b, where HT is the transpose of H.
 """
    
 import math
+import hashlib
 import numpy
 import sys
 import imp
 import os
+from multiprocessing.pool import ThreadPool
 import log
 
+# Upper bound in bytes of the scratch memory used to evaluate a warp
+MaxMemory = 64 * 1024 * 1024
+
+# Number of threads evaluating a warp, None for a single thread
+Threads = None
+
 #----------------------------------------------------------
 #   class CWarp2
 #----------------------------------------------------------
@@ -104,17 +112,78 @@ def compute_distance2(x, y=None):
         return diagx[:,numpy.newaxis] + diagy[numpy.newaxis] - 2* gram
 
 
-class CWarp2(object):
-    
-    def __init__(self, source, target, landmarks):
-        self.source = numpy.asarray(source, dtype="float32")
-        self.target = numpy.asarray(target, dtype="float32")
-        
-        self.xverts = self.source[landmarks]
-        self.yverts = self.target[landmarks]
-        H = self.rbf(self.xverts)
-        w = numpy.linalg.lstsq(H,self.yverts)[0]
-        self.w = w
+class CRbfEvaluator(object):
+    """
+    Evaluates the warp field sum_j w_j h_j(x) for many points in blocks, so
+    that the (points x landmarks) RBF matrix is never built in full. Each
+    block is computed in float32 in a preallocated scratch buffer, the
+    block size follows from MaxMemory.
+    """
+
+    def __init__(self, xverts, s2, w, maxMemory=None, threads=None):
+        self.center = xverts.mean(0)
+        self.xverts = numpy.asarray(xverts - self.center, dtype=numpy.float32)
+        self.diagy = (self.xverts.astype(numpy.float64)**2).sum(-1)
+        self.s2 = numpy.asarray(s2, dtype=numpy.float32)
+        self.offset = numpy.asarray(self.diagy + s2, dtype=numpy.float32)
+        self.w = numpy.asarray(w, dtype=numpy.float32)
+        if maxMemory is None:
+            maxMemory = MaxMemory
+        if threads is None:
+            threads = Threads
+        self.threads = threads or 1
+        nLandmarks = len(self.xverts)
+        self.blockSize = max(1, maxMemory // (4 * nLandmarks * self.threads))
+
+
+    def evaluate(self, x):
+        x = numpy.asarray(x - self.center, dtype=numpy.float32)
+        result = numpy.empty((len(x), self.w.shape[1]), dtype=numpy.float32)
+        blocks = range(0, len(x), self.blockSize)
+
+        if self.threads > 1 and len(blocks) > 1:
+            pool = ThreadPool(self.threads)
+            try:
+                def evaluateBlocks(k):
+                    scratch = numpy.empty((self.blockSize, len(self.xverts)), dtype=numpy.float32)
+                    for start in blocks[k::self.threads]:
+                        self.evaluateBlock(x, start, result, scratch)
+                pool.map(evaluateBlocks, range(self.threads))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            scratch = numpy.empty((min(self.blockSize, len(x)), len(self.xverts)), dtype=numpy.float32)
+            for start in blocks:
+                self.evaluateBlock(x, start, result, scratch)
+        return result
+
+
+    def evaluateBlock(self, x, start, result, scratch):
+        end = min(start + self.blockSize, len(x))
+        xb = x[start:end]
+        H = scratch[:end-start]
+        # |x - y|^2 + s^2 = |x|^2 + (|y|^2 + s^2) - 2 x.y, computed in place
+        numpy.dot(xb, self.xverts.T, out=H)
+        H *= -2
+        H += self.offset[numpy.newaxis]
+        H += (xb*xb).sum(-1)[:,numpy.newaxis]
+        numpy.maximum(H, self.s2[numpy.newaxis], out=H)
+        numpy.sqrt(H, out=H)
+        numpy.dot(H, self.w, out=result[start:end])
+
+
+class CWarpSolver(object):
+    """
+    The factorization of the RBF system of a set of source landmarks. The
+    weights of the warp to any set of target landmarks are then found with a
+    single matrix product.
+    """
+
+    def __init__(self, xverts):
+        self.xverts = xverts
+        H = self.rbf(xverts)
+        self.pinv = numpy.linalg.pinv(H.astype(numpy.float64))
 
 
     def rbf(self, x, y=None):
@@ -129,13 +198,106 @@ class CWarp2(object):
         #~ return numpy.exp(- 0.003 * dists2 / dists2.max())
 
 
+    def solve(self, yverts):
+        return numpy.dot(self.pinv, yverts)
+
+
+class CWarp2(object):
+    
+    def __init__(self, source, target, landmarks, solver=None):
+        self.source = numpy.asarray(source, dtype="float32")
+        self.target = numpy.asarray(target, dtype="float32")
+        
+        if solver is None:
+            solver = CWarpSolver(self.source[landmarks])
+        self.solver = solver
+        self.xverts = solver.xverts
+        self.yverts = self.target[landmarks]
+        self.w = solver.solve(self.yverts)
+        self.evaluator = CRbfEvaluator(self.xverts, solver.s2, self.w)
+
+
+    def rbf(self, x, y=None):
+        return self.solver.rbf(x, y)
+
+
     def warpTarget(self, morph):
         idx = morph.keys()
         disp = numpy.asarray(morph.values(), dtype="float")
+        idx, ymorph = self.warpTargetArrays(idx, disp)
+        return dict(zip(idx.tolist(), ymorph))
+
+
+    def warpTargetArrays(self, idx, disp):
+        """
+        Warp a morph given as an array of vertex indices and an (n,3) array
+        of displacements. Returns the indices and the warped displacements.
+        """
+        idx = numpy.asarray(idx, dtype=numpy.int32)
         xmorph = self.source[idx] + disp
-        H = self.rbf(xmorph, self.xverts)
-        ymorph = numpy.dot(H, self.w) - self.target[idx]
-        return dict(zip(idx, ymorph))
+        ymorph = self.evaluator.evaluate(xmorph) - self.target[idx]
+        ymorph = ymorph.astype(numpy.float64)
+        return idx, ymorph
+
+
+    def warpTargetsArrays(self, morphs):
+        """
+        Warp a list of (indices, displacements) morphs with one RBF
+        evaluation. Returns the list of warped morphs.
+        """
+        if not morphs:
+            return []
+        idx = numpy.concatenate([numpy.asarray(i, dtype=numpy.int32) for i,_ in morphs])
+        disp = numpy.concatenate([numpy.asarray(d, dtype=float).reshape(-1,3) for _,d in morphs])
+        idx, ymorph = self.warpTargetArrays(idx, disp)
+        bounds = numpy.cumsum([len(i) for i,_ in morphs])[:-1]
+        return zip(numpy.split(idx, bounds), numpy.split(ymorph, bounds))
+
+
+#----------------------------------------------------------
+#   Solver cache
+#----------------------------------------------------------
+
+_solverCache = {}
+_warpCache = {}
+
+# Number of landmark factorizations and warps kept in memory
+SolverCacheSize = 16
+
+def shapeDigest(array):
+    return hashlib.sha1(numpy.ascontiguousarray(array).data).hexdigest()
+
+
+def getWarp(source, target, landmarks):
+    """
+    The CWarp2 from source to target, cached by landmark set, source shape
+    and target shape. The factorization of the landmark system only depends
+    on the landmarks and the source, and is shared between targets.
+    """
+    source = numpy.asarray(source, dtype="float32")
+    target = numpy.asarray(target, dtype="float32")
+    landmarks = numpy.asarray(landmarks, dtype=numpy.int32)
+    
+    solverKey = (shapeDigest(landmarks), shapeDigest(source))
+    warpKey = solverKey + (shapeDigest(target),)
+
+    if warpKey in _warpCache:
+        return _warpCache[warpKey]
+
+    if solverKey not in _solverCache:
+        if len(_solverCache) >= SolverCacheSize:
+            _solverCache.clear()
+        _solverCache[solverKey] = CWarpSolver(source[landmarks])
+
+    if len(_warpCache) >= SolverCacheSize:
+        _warpCache.clear()
+    warp = _warpCache[warpKey] = CWarp2(source, target, landmarks, _solverCache[solverKey])
+    return warp
+
+
+def clearWarpCache():
+    _solverCache.clear()
+    _warpCache.clear()
 
 
 #----------------------------------------------------------
@@ -146,7 +308,13 @@ def warp_target1(morph, source, target, landmarks):
     return CWarp().warpTarget(morph, source, target, landmarks)
 
 def warp_target(morph, source, target, landmarks):
-    return CWarp2(source, target, landmarks).warpTarget(morph)
+    return getWarp(source, target, landmarks).warpTarget(morph)
+
+def warp_target_arrays(idx, disp, source, target, landmarks):
+    return getWarp(source, target, landmarks).warpTargetArrays(idx, disp)
+
+def warp_targets_arrays(morphs, source, target, landmarks):
+    return getWarp(source, target, landmarks).warpTargetsArrays(morphs)
 
 
 #----------------------------------------------------------
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Export benchmark entry-point.
+
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Runs the export benchmark of exportutils.benchmark without the application
+and without a display, from the root of the source tree:
+
+    python exportbenchmark.py results.json [--baseline baseline.json]
+        [--exporter NAME]... [--character NAME]... [--repeat N]
+
+The results are written to results.json. With a baseline, the regressions
+against it are printed and the exit status is 1 if there are any.
+"""
+
+from __future__ import absolute_import  # Fix 'from . import x' statements on python 2.6
+import sys
+import os
+import optparse
+
+import makehuman
+
+def main(argv):
+    parser = optparse.OptionParser(usage = '%prog [options] results.json')
+    parser.add_option('--baseline', help = 'compare against the results in BASELINE')
+    parser.add_option('--exporter', action = 'append', help = 'only run this exporter, by name')
+    parser.add_option('--character', action = 'append', help = 'only export this reference character')
+    parser.add_option('--repeat', type = 'int', default = 1, help = 'keep the fastest of REPEAT exports')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('expected the name of the results file')
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    makehuman.set_sys_path()
+    makehuman.make_user_dir()
+    makehuman.init_logging()
+
+    from exportutils import benchmark
+
+    characters = None
+    if options.character:
+        characters = [character for character in benchmark.ReferenceCharacters
+                      if character.name in options.character]
+    results = benchmark.runHeadlessBenchmark(characters, options.exporter, options.repeat)
+    benchmark.saveResults(args[0], results)
+
+    if options.baseline:
+        regressions = benchmark.compareResults(results, benchmark.loadResults(options.baseline))
+        for character, exporter, measure, old, new in regressions:
+            print '%s %s %s: %s -> %s' % (character, exporter, measure, old, new)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
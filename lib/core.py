@@ -29,7 +29,7 @@ class Globals(object):
         self.cameras = []
         self.windowHeight = 600
         self.windowWidth = 800
-        self.color_picked = (0, 0, 0)
+        self.picked = None
         self.clearColor = (0.0, 0.0, 0.0, 0.0)
         self.swapBuffers = None
 
@@ -25,6 +25,10 @@ A Qt based filechooser widget.
 """
 
 import os
+import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from PyQt4 import QtCore, QtGui
 
@@ -33,37 +37,182 @@ import mh
 import log
 
 class ThumbnailCache(object):
+    """
+    Cache of thumbnails scaled to a fixed size.
+
+    Scaled thumbnails are kept in memory in least recently used order, up to
+    maxMemory bytes, and are stored on disk in a content addressed directory
+    (keyed on path, modification time, file size and thumbnail size) so that
+    they survive between sessions. The disk cache is trimmed to maxDiskSize
+    bytes, removing the least recently used thumbnails first.
+
+    Thumbnails can be requested asynchronously with request(), in which case
+    loading and scaling is done by a pool of background threads.
+    """
     aspect_mode = QtCore.Qt.KeepAspectRatioByExpanding
     scale_mode = QtCore.Qt.SmoothTransformation
 
-    def __init__(self, size):
-        self.cache = {}
+    def __init__(self, size, cacheDir=None, maxMemory=64*1024*1024, maxDiskSize=256*1024*1024, threads=4):
+        self.cache = OrderedDict()
         self.size = size
+        self.memory = 0
+        self.maxMemory = maxMemory
+        self.maxDiskSize = maxDiskSize
+        self.threads = threads
+        self._cacheDir = cacheDir
+        self._pending = {}
+        self._pool = None
+        self._trimmed = False
+
+    @property
+    def cacheDir(self):
+        if self._cacheDir is None:
+            self._cacheDir = os.path.join(mh.getPath(''), 'cache', 'thumbnails')
+        if not os.path.isdir(self._cacheDir):
+            try:
+                os.makedirs(self._cacheDir)
+            except OSError:
+                pass
+        return self._cacheDir
+
+    def getKey(self, name):
+        nstat = os.stat(name)
+        path = os.path.abspath(name)
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return hashlib.sha1('%s|%r|%d|%dx%d' % (path, nstat.st_mtime, nstat.st_size, self.size[0], self.size[1])).hexdigest()
+
+    def getCachePath(self, key):
+        return os.path.join(self.cacheDir, key + '.png')
 
     def __getitem__(self, name):
-        nstat = os.stat(name)
-        if name in self.cache:
-            stat, pixmap = self.cache[name]
-            if stat.st_size == nstat.st_size and stat.st_mtime == nstat.st_mtime:
-                return pixmap
-            else:
-                del self.cache[name]
-        pixmap = self.loadImage(name)
-        self.cache[name] = (nstat, pixmap)
+        key = self.getKey(name)
+        pixmap = self._fromMemory(key)
+        if pixmap is None:
+            pixmap = QtGui.QPixmap.fromImage(self._loadThumbnail(name, key))
+            self._toMemory(key, pixmap)
         return pixmap
 
-    def loadImage(self, path):
-        pixmap = QtGui.QPixmap(path)
-        width, height = self.size
-        pixmap = pixmap.scaled(width, height, self.aspect_mode, self.scale_mode)
-        pwidth = pixmap.width()
-        pheight = pixmap.height()
-        if pwidth > width or pheight > height:
-            x0 = max(0, (pwidth - width) / 2)
-            y0 = max(0, (pheight - height) / 2)
-            pixmap = pixmap.copy(x0, y0, width, height)
+    def request(self, name, callback):
+        """
+        Returns the thumbnail for the image file name if it is in memory.
+        Otherwise None is returned, the thumbnail is loaded in the background
+        and callback is called with it from the main thread when it is ready.
+        """
+        key = self.getKey(name)
+        pixmap = self._fromMemory(key)
+        if pixmap is not None:
+            return pixmap
+        if key in self._pending:
+            self._pending[key].append(callback)
+            return None
+        self._pending[key] = [callback]
+        if self._pool is None:
+            self._pool = ThreadPool(self.threads)
+        def onLoaded(image):
+            mh.callAsyncThread(self._onLoaded, key, image)
+        self._pool.apply_async(self._loadThumbnailSafe, (name, key), callback=onLoaded)
+        if not self._trimmed:
+            self._trimmed = True
+            self._pool.apply_async(self.trimDisk)
+        return None
+
+    def _onLoaded(self, key, image):
+        pixmap = QtGui.QPixmap.fromImage(image)
+        self._toMemory(key, pixmap)
+        for callback in self._pending.pop(key, []):
+            try:
+                callback(pixmap)
+            except RuntimeError:
+                # The widget waiting for the thumbnail was deleted
+                pass
+
+    def _fromMemory(self, key):
+        pixmap = self.cache.pop(key, None)
+        if pixmap is not None:
+            self.cache[key] = pixmap
         return pixmap
 
+    def _toMemory(self, key, pixmap):
+        if key in self.cache:
+            return
+        self.cache[key] = pixmap
+        self.memory += pixmap.width() * pixmap.height() * 4
+        while self.memory > self.maxMemory and len(self.cache) > 1:
+            _, old = self.cache.popitem(last=False)
+            self.memory -= old.width() * old.height() * 4
+
+    def _loadThumbnailSafe(self, name, key):
+        try:
+            return self._loadThumbnail(name, key)
+        except Exception:
+            log.warning('Failed to load thumbnail %s', name, exc_info=True)
+            return QtGui.QImage()
+
+    def _loadThumbnail(self, name, key):
+        """
+        Load the scaled thumbnail from the disk cache, or scale it from the
+        original image and store it in the disk cache. Only uses QImage so
+        that it can run outside of the main thread.
+        """
+        cachePath = self.getCachePath(key)
+        if os.path.isfile(cachePath):
+            image = QtGui.QImage(cachePath)
+            if not image.isNull():
+                try:
+                    os.utime(cachePath, None)
+                except OSError:
+                    pass
+                return image
+        image = self.scaleImage(QtGui.QImage(name))
+        if not image.isNull():
+            tmpPath = '%s.%d.tmp' % (cachePath, threading.current_thread().ident)
+            if image.save(tmpPath, 'PNG'):
+                try:
+                    if os.path.exists(cachePath):
+                        os.remove(cachePath)
+                    os.rename(tmpPath, cachePath)
+                except OSError:
+                    pass
+        return image
+
+    def trimDisk(self):
+        """
+        Remove the least recently used thumbnails from the disk cache until it
+        is smaller than maxDiskSize.
+        """
+        try:
+            entries = []
+            for f in os.listdir(self.cacheDir):
+                path = os.path.join(self.cacheDir, f)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.maxDiskSize:
+                    break
+                os.remove(path)
+                total -= size
+        except OSError:
+            log.warning('Failed to trim thumbnail cache', exc_info=True)
+
+    def scaleImage(self, image):
+        if image.isNull():
+            return image
+        width, height = self.size
+        image = image.scaled(width, height, self.aspect_mode, self.scale_mode)
+        iwidth = image.width()
+        iheight = image.height()
+        if iwidth > width or iheight > height:
+            x0 = max(0, (iwidth - width) / 2)
+            y0 = max(0, (iheight - height) / 2)
+            image = image.copy(x0, y0, width, height)
+        return image
+
+    def loadImage(self, path):
+        return QtGui.QPixmap.fromImage(self.scaleImage(QtGui.QImage(path)))
+
 class FileChooserRectangle(gui.Button):
     _size = (128, 128)
     _imageCache = ThumbnailCache(_size)
@@ -77,9 +226,10 @@ class FileChooserRectangle(gui.Button):
         self.layout = QtGui.QGridLayout(self)
         self.layout.setSizeConstraint(QtGui.QLayout.SetMinimumSize)
 
-        image = self._imageCache[imagePath]
         self.preview = QtGui.QLabel()
-        self.preview.setPixmap(image)
+        image = self._imageCache.request(imagePath, self.setPreview)
+        if image is not None:
+            self.preview.setPixmap(image)
         self.layout.addWidget(self.preview, 0, 0)
         self.layout.setRowStretch(0, 1)
         self.layout.setColumnMinimumWidth(0, self._size[0])
@@ -91,6 +241,9 @@ class FileChooserRectangle(gui.Button):
         self.layout.addWidget(self.label, 1, 0)
         self.layout.setRowStretch(1, 0)
 
+    def setPreview(self, image):
+        self.preview.setPixmap(image)
+
     def onClicked(self, event):
         self.owner.selection = self.file
         self.owner.callEvent('onFileSelected', self.file)
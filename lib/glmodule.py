@@ -25,6 +25,7 @@ TODO
 import sys
 import math
 import atexit
+import ctypes
 import numpy as np
 
 import OpenGL
@@ -59,7 +60,7 @@ def grabScreen(x, y, width, height, filename = None):
 
     log.debug('grabScreen: %d %d %d %d', x, y, width, height)
 
-    # Draw before grabbing, to make sure we grab a rendering and not a picking buffer
+    # Draw before grabbing, to make sure we grab a complete rendering
     draw()
 
     sx0 = x
@@ -101,61 +102,6 @@ def grabScreen(x, y, width, height, filename = None):
 
     return surface
 
-pickingBuffer = None
-
-def updatePickingBuffer():
-    width = G.windowWidth
-    height = G.windowHeight
-    rwidth = (width + 3) / 4 * 4
-
-    # Resize the buffer in case the window size has changed
-    global pickingBuffer
-    if pickingBuffer is None or pickingBuffer.shape != (height, rwidth, 3):
-        pickingBuffer = np.empty((height, rwidth, 3), dtype = np.uint8)
-
-    # Turn off lighting
-    glDisable(GL_LIGHTING)
-
-    # Turn off antialiasing
-    glDisable(GL_BLEND)
-    if have_multisample:
-        glDisable(GL_MULTISAMPLE)
-
-    # Clear screen
-    glClearColor(0.0, 0.0, 0.0, 0.0)
-    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-
-    drawMeshes(True)
-
-    # Make sure the data is 1 byte aligned
-    glPixelStorei(GL_PACK_ALIGNMENT, 1)
-    #glFlush()
-    #glFinish()
-    glReadPixels(0, 0, rwidth, height, GL_RGB, GL_UNSIGNED_BYTE, pickingBuffer)
-    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-
-    # Turn on antialiasing
-    glEnable(GL_BLEND)
-    if have_multisample:
-        glEnable(GL_MULTISAMPLE)
-
-    # restore lighting
-    glEnable(GL_LIGHTING)
-
-    # draw()
-
-def getPickedColor(x, y):
-    y = G.windowHeight - y
-
-    if y < 0 or y >= G.windowHeight or x < 0 or x >= G.windowWidth:
-        G.color_picked = (0, 0, 0)
-        return
-
-    if pickingBuffer is None:
-        updatePickingBuffer()
-
-    G.color_picked = tuple(pickingBuffer[y,x,:])
-
 def reshape(w, h):
     try:
         # Prevent a division by zero when minimising the window
@@ -169,8 +115,6 @@ def reshape(w, h):
 
         # go back to modelview matrix so we can move the objects about
         glMatrixMode(GL_MODELVIEW)
-
-        updatePickingBuffer()
     except StandardError:
         log.error('gl.reshape', exc_info=True)
 
@@ -261,6 +205,116 @@ def cameraPosition(camera, eye):
 def transformObject(obj):
     glMultMatrixd(np.ascontiguousarray(obj.transform.T))
 
+_hasVBO = None
+def hasVBO():
+    global _hasVBO
+    if _hasVBO is None:
+        _hasVBO = all([
+            bool(glGenBuffers), bool(glBindBuffer), bool(glBufferData),
+            bool(glBufferSubData), bool(glDeleteBuffers)])
+    return _hasVBO
+
+class VertexBuffers(object):
+    """
+    The render data of one object kept in buffer objects in graphics memory.
+    Only the rows that changed since the previous draw are uploaded again,
+    using the changes recorded by the mesh (see module3d.Object3D.markRender).
+    """
+
+    def __init__(self):
+        self.buffers = dict(zip(['coord', 'vnorm', 'color', 'texco', 'index'], glGenBuffers(5)))
+        self.sizes = dict((name, -1) for name in self.buffers)
+
+    def delete(self):
+        if not self.buffers:
+            return
+        glDeleteBuffers(len(self.buffers), np.array(self.buffers.values(), dtype=np.uint32))
+        self.buffers = {}
+
+    def upload(self, target, name, data, rows = None):
+        glBindBuffer(target, self.buffers[name])
+        if data.nbytes != self.sizes[name]:
+            glBufferData(target, data.nbytes, data if data.nbytes else None, GL_DYNAMIC_DRAW)
+            self.sizes[name] = data.nbytes
+        elif rows is None:
+            glBufferSubData(target, 0, data.nbytes, data)
+        else:
+            start, end = rows
+            block = data[start:end]
+            glBufferSubData(target, start * (data.nbytes / len(data)), block.nbytes, block)
+
+    def sync(self, obj, changes):
+        for name, data in [('coord', obj.verts), ('vnorm', obj.norms), ('texco', obj.UVs)]:
+            if name in changes or data.nbytes != self.sizes[name]:
+                self.upload(GL_ARRAY_BUFFER, name, data, changes.get(name))
+
+        if 'color' in changes or obj.color.nbytes != self.sizes['color']:
+            self.upload(GL_ARRAY_BUFFER, 'color', obj.color, changes.get('color'))
+
+        if 'index' in changes or obj.primitives.nbytes != self.sizes['index']:
+            self.upload(GL_ELEMENT_ARRAY_BUFFER, 'index', obj.primitives)
+
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+def getBuffers(obj):
+    """
+    The up to date vertex buffers of obj, or None if buffer objects are not
+    supported, in which case the client side arrays are drawn.
+    """
+    if not hasVBO():
+        return None
+    if obj.buffers is None:
+        obj.buffers = VertexBuffers()
+    obj.buffers.sync(obj, obj.popRenderChanges())
+    return obj.buffers
+
+def setArrays(obj, buffers, textured = False):
+    """
+    Point the vertex arrays at the data of obj, either the buffer objects or
+    the client side arrays.
+    """
+    if buffers is None:
+        glVertexPointer(3, GL_FLOAT, 0, obj.verts)
+        glNormalPointer(GL_FLOAT, 0, obj.norms)
+        glColorPointer(4, GL_UNSIGNED_BYTE, 0, obj.color)
+        if textured:
+            glTexCoordPointer(2, GL_FLOAT, 0, obj.UVs)
+        return
+
+    glBindBuffer(GL_ARRAY_BUFFER, buffers.buffers['coord'])
+    glVertexPointer(3, GL_FLOAT, 0, None)
+    glBindBuffer(GL_ARRAY_BUFFER, buffers.buffers['vnorm'])
+    glNormalPointer(GL_FLOAT, 0, None)
+    glBindBuffer(GL_ARRAY_BUFFER, buffers.buffers['color'])
+    glColorPointer(4, GL_UNSIGNED_BYTE, 0, None)
+    if textured:
+        glBindBuffer(GL_ARRAY_BUFFER, buffers.buffers['texco'])
+        glTexCoordPointer(2, GL_FLOAT, 0, None)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, buffers.buffers['index'])
+
+def unsetArrays(buffers):
+    if buffers is not None:
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+def drawElements(obj, buffers, start = 0, count = None):
+    """
+    Draw the primitives start to start+count of obj, all of them if count is
+    None.
+    """
+    if count is None:
+        count = obj.nPrimitives - start
+    if count <= 0:
+        return
+    mode = g_primitiveMap[obj.vertsPerPrimitive-1]
+    if buffers is None:
+        indices = obj.primitives[start:start+count,:]
+        glDrawElements(mode, indices.size, GL_UNSIGNED_INT, indices)
+    else:
+        offset = start * obj.vertsPerPrimitive * obj.primitives.itemsize
+        glDrawElements(mode, count * obj.vertsPerPrimitive, GL_UNSIGNED_INT, ctypes.c_void_p(offset))
+
 def drawMesh(obj):
     if not obj.visibility:
         return
@@ -271,19 +325,18 @@ def drawMesh(obj):
     glPushMatrix()
     transformObject(obj)
 
-    if obj.texture and obj.solid:
+    textured = bool(obj.texture and obj.solid)
+    if textured:
         glEnable(GL_TEXTURE_2D)
         glEnableClientState(GL_TEXTURE_COORD_ARRAY)
         glBindTexture(GL_TEXTURE_2D, obj.texture)
-        glTexCoordPointer(2, GL_FLOAT, 0, obj.UVs)
 
         if obj.nTransparentPrimitives:
             obj.sortFaces()
 
     # Fill the array pointers with object mesh data
-    glVertexPointer(3, GL_FLOAT, 0, obj.verts)
-    glNormalPointer(GL_FLOAT, 0, obj.norms)
-    glColorPointer(4, GL_UNSIGNED_BYTE, 0, obj.color)
+    buffers = getBuffers(obj)
+    setArrays(obj, buffers, textured)
 
     # Disable lighting if the object is shadeless
     if obj.shadeless:
@@ -307,29 +360,30 @@ def drawMesh(obj):
         glDisableClientState(GL_COLOR_ARRAY)
         glColor3f(0.0, 0.0, 0.0)
         glPolygonMode(GL_FRONT_AND_BACK, GL_LINE)
-        glDrawElements(g_primitiveMap[obj.vertsPerPrimitive-1], obj.primitives.size, GL_UNSIGNED_INT, obj.primitives)
+        drawElements(obj, buffers)
         glEnableClientState(GL_COLOR_ARRAY)
         glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
         glEnable(GL_POLYGON_OFFSET_FILL)
         glPolygonOffset(1.0, 1.0)
-        glDrawElements(g_primitiveMap[obj.vertsPerPrimitive-1], obj.primitives.size, GL_UNSIGNED_INT, obj.primitives)
+        drawElements(obj, buffers)
         glDisable(GL_POLYGON_OFFSET_FILL)
     elif obj.nTransparentPrimitives:
         glDepthMask(GL_FALSE)
         glEnable(GL_ALPHA_TEST)
         glAlphaFunc(GL_GREATER, 0.0)
-        glDrawElements(g_primitiveMap[obj.vertsPerPrimitive-1], obj.primitives.size, GL_UNSIGNED_INT, obj.primitives)
+        drawElements(obj, buffers)
         glDisable(GL_ALPHA_TEST)
         glDepthMask(GL_TRUE)
     elif obj.depthless:
         glDepthMask(GL_FALSE)
         glDisable(GL_DEPTH_TEST)
-        glDrawElements(g_primitiveMap[obj.vertsPerPrimitive-1], obj.primitives.size, GL_UNSIGNED_INT, obj.primitives)
+        drawElements(obj, buffers)
         glEnable(GL_DEPTH_TEST)
         glDepthMask(GL_TRUE)
     else:
-        glDrawElements(g_primitiveMap[obj.vertsPerPrimitive-1], obj.primitives.size, GL_UNSIGNED_INT, obj.primitives)
+        drawElements(obj, buffers)
 
+    # Face group colors are drawn in extra passes over their primitives
     if obj.solid and not obj.nTransparentPrimitives:
         glDisableClientState(GL_COLOR_ARRAY)
         for i, (start, count) in enumerate(obj.groups):
@@ -337,10 +391,11 @@ def drawMesh(obj):
             if color is None or np.all(color[:3] == 255):
                 continue
             glColor4ub(*color)
-            indices = obj.primitives[start:start+count,:]
-            glDrawElements(g_primitiveMap[obj.vertsPerPrimitive-1], indices.size, GL_UNSIGNED_INT, indices)
+            drawElements(obj, buffers, start, count)
         glEnableClientState(GL_COLOR_ARRAY)
 
+    unsetArrays(buffers)
+
     # Disable the shader if the driver supports it and there is a shader assigned
     if obj.shader and obj.solid and Shader.supported():
         glUseProgram(0)
@@ -352,56 +407,15 @@ def drawMesh(obj):
     if obj.shadeless:
         glEnable(GL_LIGHTING)
 
-    if obj.texture and obj.solid:
+    if textured:
         glDisable(GL_TEXTURE_2D)
         glDisableClientState(GL_TEXTURE_COORD_ARRAY)
 
     glPopMatrix()
 
-def pickMesh(obj):
-    if not obj.visibility:
-        return
-    if not obj.pickable:
-        return
-
-    # Transform the current object
-    glPushMatrix()
-    transformObject(obj)
-
-    # Fill the array pointers with object mesh data
-    glVertexPointer(3, GL_FLOAT, 0, obj.verts)
-    glNormalPointer(GL_FLOAT, 0, obj.norms)
-
-    # Use color to pick i
-    glDisableClientState(GL_COLOR_ARRAY)
-
-    # Disable lighting
-    glDisable(GL_LIGHTING)
-
-    if obj.cull:
-        glEnable(GL_CULL_FACE)
-        glCullFace(GL_BACK if obj.cull > 0 else GL_FRONT)
-
-    # draw the meshes
-    for i, (start, count) in enumerate(obj.groups):
-        glColor3ub(*obj.clrid(i))
-        indices = obj.primitives[start:start+count,:]
-        glDrawElements(g_primitiveMap[obj.vertsPerPrimitive-1], indices.size, GL_UNSIGNED_INT, indices)
-
-    glDisable(GL_CULL_FACE)
-
-    glEnable(GL_LIGHTING)
-    glEnableClientState(GL_COLOR_ARRAY)
-
-    glPopMatrix()
-
-def drawOrPick(pickMode, obj):
-    if pickMode:
-        if hasattr(obj, 'pick'):
-            obj.pick()
-    else:
-        if hasattr(obj, 'draw'):
-            obj.draw()
+def drawObject(obj):
+    if hasattr(obj, 'draw'):
+        obj.draw()
 
 _hasRenderSkin = None
 def hasRenderSkin():
@@ -523,7 +537,7 @@ def renderSkin(dst, vertsPerPrimitive, verts, index = None, objectMatrix = None,
 
     return surface
 
-def drawMeshes(pickMode):
+def drawMeshes():
     if G.world is None:
         return
 
@@ -534,26 +548,26 @@ def drawMeshes(pickMode):
         if camera.stereoMode:
             glColorMask(GL_TRUE, GL_FALSE, GL_FALSE, GL_TRUE) # Red
             cameraPosition(camera, 1)
-            drawOrPick(pickMode, obj)
+            drawObject(obj)
             glClear(GL_DEPTH_BUFFER_BIT)
             glColorMask(GL_FALSE, GL_TRUE, GL_TRUE, GL_TRUE) # Cyan
             cameraPosition(camera, 2)
-            drawOrPick(pickMode, obj)
+            drawObject(obj)
             # To prevent the GUI from overwritting the red model, we need to render it again in the z-buffer
             glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE) # None, only z-buffer
             cameraPosition(camera, 1)
-            drawOrPick(pickMode, obj)
+            drawObject(obj)
             glColorMask(GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE) # All
             cameraMode = None
         else:
             if cameraMode != obj.cameraMode:
                 cameraPosition(camera, 0)
                 cameraMode = obj.cameraMode
-            drawOrPick(pickMode, obj)
+            drawObject(obj)
 
 def _draw():
     drawBegin()
-    drawMeshes(False)
+    drawMeshes()
     drawEnd()
 
 def draw():
@@ -25,7 +25,7 @@ Python compatibility layer replacing the old C functions of MakeHuman.
 from core import G
 from getpath import getPath
 
-from glmodule import updatePickingBuffer, grabScreen, hasRenderSkin, renderSkin
+from glmodule import grabScreen, hasRenderSkin, renderSkin
 
 from image import Image
 from texture import Texture, getTexture, reloadTextures
@@ -40,8 +40,8 @@ from inifile import parseINI, formatINI
 
 cameras = G.cameras
 
-def getColorPicked():
-    return G.color_picked
+def getPicked():
+    return G.picked
 
 def setClearColor(r, g, b, a):
     G.clearColor = (r, g, b, a)
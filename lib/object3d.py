@@ -38,6 +38,7 @@ class Object3D(object):
         self._textureTex = None
         self._shaderPath = None
         self._shaderObj = None
+        self.buffers = None
 
     @property
     def verts(self):
@@ -187,18 +188,15 @@ class Object3D(object):
     def cull(self):
         return self.parent.cull
 
-    def clrid(self, idx):
-        return self.parent._faceGroups[idx].colorID
-
     def gcolor(self, idx):
         return self.parent._faceGroups[idx].color
 
+    def popRenderChanges(self):
+        return self.parent.popRenderChanges()
+
     def draw(self, *args, **kwargs):
         return gl.drawMesh(self, *args, **kwargs)
 
-    def pick(self, *args, **kwargs):
-        return gl.pickMesh(self, *args, **kwargs)
-
     def sortFaces(self):
         camera = G.cameras[0]
 
@@ -223,6 +221,7 @@ class Object3D(object):
         indices2 = indices[order,:]
 
         indices[...] = indices2
+        self.parent.markRender('index')
 
     @property
     def textureTex(self):
@@ -262,4 +261,6 @@ class Object3D(object):
             return
 
         G.world.remove(mesh.object3d)
+        if mesh.object3d.buffers is not None:
+            mesh.object3d.buffers.delete()
         mesh.object3d = None
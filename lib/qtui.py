@@ -31,6 +31,7 @@ from PyQt4 import QtCore, QtGui, QtOpenGL
 from core import G
 import glmodule as gl
 import events3d
+import selection
 import qtgui
 import queue
 
@@ -178,15 +179,13 @@ class Canvas(QtOpenGL.QGLWidget):
 
         gg_mouse_pos = x, y
 
-        gl.getPickedColor(x, y)
+        G.picked = selection.pick(x, y)
 
         G.app.callEvent(direction, events3d.MouseEvent(b, x, y))
 
         # Update screen
         self.update()
 
-        gl.updatePickingBuffer()
-
     def wheelEvent(self, ev):
         global gg_mouse_pos
 
@@ -230,7 +229,7 @@ class Canvas(QtOpenGL.QGLWidget):
         buttons = int(G.app.mouseButtons())
 
         if not buttons:
-            gl.getPickedColor(x, y)
+            G.picked = selection.pick(x, y)
 
         G.app.callEvent('onMouseMovedCallback', events3d.MouseEvent(buttons, x, y, xrel, yrel))
 
@@ -384,7 +384,6 @@ class TextureProjectionView(gui3d.TaskView) :
         def onClicked(event):
             self.backgroundImage.mesh.setPickable(self.dragButton.selected)
             gui3d.app.selectedHuman.mesh.setPickable(not self.dragButton.selected)
-            mh.updatePickingBuffer()
 
         self.chooseBGButton = self.backgroundBox.addWidget(gui.Button('Choose background'))
 
@@ -422,7 +421,6 @@ class TextureProjectionView(gui3d.TaskView) :
         gui3d.TaskView.onShow(self, event)
         self.backgroundImage.mesh.setPickable(self.dragButton.selected)
         gui3d.app.selectedHuman.mesh.setPickable(not self.dragButton.selected)
-        mh.updatePickingBuffer()
         gui3d.app.selectedHuman.mesh.setShadeless(1 if self.shadelessButton.selected else 0)
         self.opacitySlider.setValue(self.backgroundChooserView.opacity)
         self.foregroundTggl.setChecked(self.backgroundChooserView.isShowBgInFront())
@@ -433,7 +431,6 @@ class TextureProjectionView(gui3d.TaskView) :
         gui3d.app.selectedHuman.mesh.setShadeless(0)
         self.backgroundImage.mesh.setPickable(False)
         gui3d.app.selectedHuman.mesh.setPickable(True)
-        mh.updatePickingBuffer()
 
     def onHumanChanging(self, event):
         
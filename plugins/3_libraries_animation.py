@@ -302,7 +302,6 @@ class AnimationLibrary(gui3d.TaskView):
 
         self.oldHumanTransp = self.human.meshData.transparentPrimitives
         self.human.meshData.setPickable(False)
-        mh.updatePickingBuffer()
 
         self.skelObj = self.human.getSkeleton().object
         if self.skelObj:
@@ -334,7 +333,6 @@ class AnimationLibrary(gui3d.TaskView):
         self.setToRestPose()
         self.setHumanTransparency(False)
         self.human.meshData.setPickable(True)
-        mh.updatePickingBuffer()
 
         if self.skelObj:
             self.skelObj.hide()
@@ -134,7 +134,6 @@ class BVHAnimLibrary(gui3d.TaskView):
 
         self.oldHumanTransp = self.human.meshData.transparentPrimitives
         self.human.meshData.setPickable(False)
-        mh.updatePickingBuffer()
 
         self.skelObj = self.human.getSkeleton().object
         if self.skelObj:
@@ -157,7 +156,6 @@ class BVHAnimLibrary(gui3d.TaskView):
         self.setToRestPose()
         self.setHumanTransparency(False)
         self.human.meshData.setPickable(True)
-        mh.updatePickingBuffer()
 
         if self.skelObj:
             self.skelObj.hide()
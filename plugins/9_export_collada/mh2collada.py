@@ -32,6 +32,7 @@ import log
 
 import gui3d
 import exportutils
+from exportutils import formatting
 import posemode
 
 #
@@ -355,13 +356,36 @@ def writeMaterials(fp, stuff):
 #    writeController(fp, stuff, config):
 #
 
+def getSkinWeights(stuff):
+    """
+    The skin weights of stuff as arrays of bone index, vertex index and
+    weight. Weights are ordered by bone, in the order of stuff.boneInfo.bones,
+    and the position of a weight is its index in the WEIGHT array.
+    """
+    bones = []
+    verts = []
+    weights = []
+    for (bn,b) in enumerate(stuff.boneInfo.bones):
+        try:
+            wts = stuff.meshInfo.weights[b]
+        except KeyError:
+            continue
+        if len(wts) == 0:
+            continue
+        wts = numpy.asarray(wts, dtype=numpy.float64).reshape(-1, 2)
+        bones.append(numpy.repeat(bn, len(wts)))
+        verts.append(wts[:,0].astype(int))
+        weights.append(wts[:,1])
+    if not bones:
+        return numpy.zeros(0, int), numpy.zeros(0, int), numpy.zeros(0, numpy.float64)
+    return numpy.concatenate(bones), numpy.concatenate(verts), numpy.concatenate(weights)
+
+
 def writeController(fp, stuff, config):
     obj = stuff.meshInfo.object
-    exportutils.collect.setStuffSkinWeights(stuff)
+    weightBones, weightVerts, weights = getSkinWeights(stuff)
     nVerts = len(obj.coord)
-    nUvVerts = len(obj.texco)
-    nFaces = len(obj.fvert)
-    nWeights = len(stuff.skinWeights)
+    nWeights = len(weights)
     nBones = len(stuff.boneInfo.bones)
     nShapes = len(stuff.meshInfo.shapes)
 
@@ -378,8 +402,7 @@ def writeController(fp, stuff, config):
         '          <IDREF_array count="%d" id="%s-skin-joints-array">\n' % (nBones,stuff.name) +
         '           ')
 
-    for b in stuff.boneInfo.bones:
-        fp.write(' %s' % b)
+    fp.write(''.join([' %s' % b for b in stuff.boneInfo.bones]))
     
     fp.write('\n' +
         '          </IDREF_array>\n' +
@@ -393,9 +416,7 @@ def writeController(fp, stuff, config):
         '          <float_array count="%d" id="%s-skin-weights-array">\n' % (nWeights,stuff.name) +
         '           ')
 
-    for (n,b) in enumerate(stuff.skinWeights):
-        (v,w) = stuff.skinWeights[n]
-        fp.write(' %s' % w)
+    formatting.writeRows(fp, ' %s', weights)
 
     fp.write('\n' +
         '          </float_array>\n' +    
@@ -408,17 +429,12 @@ def writeController(fp, stuff, config):
         '        <source id="%s-skin-poses">\n' % stuff.name +
         '          <float_array count="%d" id="%s-skin-poses-array">' % (16*nBones,stuff.name))
 
-    mat = [[1,0,0,0],[0,1,0,0],[0,0,1,0],[0,0,0,1]]
-    for b in stuff.boneInfo.bones:
-        vec = stuff.boneInfo.heads[b]
-        (x,y,z) = rotateLoc(vec, config)
-        mat[0][3] = -x
-        mat[1][3] = -y
-        mat[2][3] = -z
-        fp.write('\n            ')
-        for i in range(4):
-            for j in range(4):
-                fp.write('%.4f ' % mat[i][j])
+    # Inverse bind matrices, translations by minus the bone heads
+    heads = numpy.array([stuff.boneInfo.heads[b] for b in stuff.boneInfo.bones], dtype=numpy.float64).reshape(-1, 3)
+    mats = numpy.zeros((nBones, 4, 4))
+    mats[:] = numpy.identity(4)
+    mats[:,:3,3] = -rotateLocs(heads, config)
+    formatting.writeRows(fp, '\n            ' + 16*'%.4f ', mats)
 
     fp.write('\n' +
         '          </float_array>\n' +    
@@ -438,24 +454,16 @@ def writeController(fp, stuff, config):
         '          <vcount>\n' +
         '            ')
 
-    for wts in stuff.vertexWeights.values():
-        fp.write('%d ' % len(wts))
+    formatting.writeRows(fp, '%d ', numpy.bincount(weightVerts, minlength=nVerts))
 
     fp.write('\n' +
         '          </vcount>\n'
         '          <v>\n' +
         '           ')
 
-    #print(stuff.vertexWeights)
-    for (vn,wts) in stuff.vertexWeights.items():
-        wtot = 0.0
-        for (bn,wn) in wts:
-            wtot += wn
-        if wtot < 0.01:
-            # print("wtot", vn, wtot)
-            wtot = 1
-        for (bn,wn) in wts:
-            fp.write(' %d %d' % (bn, wn))
+    # (joint, weight index) pairs grouped by vertex, in bone order
+    order = numpy.argsort(weightVerts, kind='mergesort')
+    formatting.writeRows(fp, ' %d %d', numpy.column_stack([weightBones[order], order]))
 
     fp.write('\n' +
         '          </v>\n' +
@@ -474,8 +482,7 @@ def writeController(fp, stuff, config):
             '        <source id="%sTargets">\n' % (stuff.name) +
             '          <IDREF_array id="%sTargets-array" count="%d">' % (stuff.name, nShapes))
 
-        for key,_ in stuff.meshInfo.shapes:
-            fp.write(" %sMeshMorph_%s" % (stuff.name, key))
+        fp.write(''.join([" %sMeshMorph_%s" % (stuff.name, key) for key,_ in stuff.meshInfo.shapes]))
 
         fp.write(
             '        </IDREF_array>\n' +
@@ -515,9 +522,7 @@ def writeGeometry(fp, stuff, config):
     obj = stuff.meshInfo.object
     nVerts = len(obj.coord)
     nUvVerts = len(obj.texco)
-    nWeights = len(stuff.skinWeights)
-    nBones = len(stuff.boneInfo.bones)
-    nShapes = len(stuff.meshInfo.shapes)
+    coords = rotateLocs(obj.coord, config)
 
     fp.write('\n' +
         '    <geometry id="%sMesh" name="%s">\n' % (stuff.name,stuff.name) +
@@ -527,9 +532,7 @@ def writeGeometry(fp, stuff, config):
         '          ')
 
 
-    for co in obj.coord:
-        (x,y,z) = rotateLoc(co, config)
-        fp.write("%.4f %.4f %.4f " % (x,y,z))
+    formatting.writeRows(fp, "%.4f %.4f %.4f ", coords)
 
     fp.write('\n' +
         '          </float_array>\n' +
@@ -552,9 +555,7 @@ def writeGeometry(fp, stuff, config):
             '          <float_array count="%d" id="%s-Normals-array">\n' % (3*nNormals,stuff.name) +
             '          ')
 
-        for no in obj.fnorm:
-            (x,y,z) = rotateLoc(no, config)
-            fp.write("%.4f %.4f %.4f " % (x,y,z))
+        formatting.writeRows(fp, "%.4f %.4f %.4f ", rotateLocs(obj.fnorm, config))
 
         fp.write('\n' +
             '          </float_array>\n' +
@@ -575,8 +576,7 @@ def writeGeometry(fp, stuff, config):
         '           ')
 
 
-    for uv in obj.texco:
-        fp.write(" %.4f %.4f" % tuple(uv))
+    formatting.writeRows(fp, " %.4f %.4f", obj.texco)
 
     fp.write('\n' +
         '          </float_array>\n' +
@@ -603,14 +603,37 @@ def writeGeometry(fp, stuff, config):
         '      </mesh>\n' +
         '    </geometry>\n')
 
-    for name,shape in stuff.meshInfo.shapes:
-        writeShapeKey(fp, name, shape, stuff, config)
+    # All shape keys share the base coordinates and faces
+    if stuff.meshInfo.shapes:
+        polylist = formatShapeKeyPolylist(obj)
+        for name,shape in stuff.meshInfo.shapes:
+            writeShapeKey(fp, name, shape, stuff, config, coords, polylist)
     return
     
     
-def writeShapeKey(fp, name, shape, stuff, config):  
+def formatShapeKeyPolylist(obj):
+    """
+    The vcount and p bodies of the polylist of a shape key, as strings.
+    """
+    isTri = obj.fvert[:,0] == obj.fvert[:,3]
+    vcount = formatting.formatRows("%d ", numpy.where(isTri, 3, 4))
+    p = formatting.formatFaceRows("%d %d %d %s ", "%d %d %d ", obj.fvert, isTri)
+    return vcount, p
+
+
+def writeShapeKey(fp, name, shape, stuff, config, coords=None, polylist=None):  
+    """
+    Write the morph target geometry of a shape key. The shape is given as
+    the vertices it moves and their offsets, coords are the rotated base
+    coordinates and polylist the result of formatShapeKeyPolylist, both
+    computed from the stuff if not given.
+    """
     obj = stuff.meshInfo.object
     nVerts = len(obj.coord)    
+    if coords is None:
+        coords = rotateLocs(obj.coord, config)
+    if polylist is None:
+        polylist = formatShapeKeyPolylist(obj)
     
     # Verts
     
@@ -621,12 +644,10 @@ def writeShapeKey(fp, name, shape, stuff, config):
         '          <float_array id="%sMeshMorph_%s-positions-array" count="%d">\n' % (stuff.name, name, 3*nVerts) +
         '           ')
 
-    target = numpy.array(obj.coord)
-    for n,dr in shape.items():
-        target[n] += numpy.array(dr)
-    for co in target:
-        loc = rotateLoc(co, config)
-        fp.write(" %.4g %.4g %.4g" % tuple(loc))
+    target = numpy.array(coords)
+    verts,deltas = shape
+    target[verts] += rotateLocs(deltas, config)
+    formatting.writeRows(fp, " %.4g %.4g %.4g", target)
 
     fp.write('\n' +
         '          </float_array>\n' +
@@ -668,21 +689,14 @@ def writeShapeKey(fp, name, shape, stuff, config):
         #'          <input semantic="NORMAL" source="#%sMeshMorph_%s-normals" offset="1"/>\n' % (stuff.name, name) +
         '          <vcount>')
 
-    for fv in obj.fvert:
-        if fv[0] == fv[3]:
-            fp.write("3 ")
-        else:
-            fp.write("4 ")
+    vcount, p = polylist
+    fp.write(vcount)
         
     fp.write('\n' +
         '          </vcount>\n' +
         '          <p>')
 
-    for fv in obj.fvert:
-        if fv[0] == fv[3]:
-            fp.write("%d %d %d " % (fv[0], fv[1], fv[2]))
-        else:
-            fp.write("%d %d %d %s " % (fv[0], fv[1], fv[2], fv[3]))
+    fp.write(p)
 
     fp.write('\n' +
         '          </p>\n' +
@@ -731,28 +745,21 @@ def writePolylist(fp, stuff, config):
         '          <input offset="1" semantic="TEXCOORD" source="#%s-UV"/>\n' % stuff.name +
         '          <vcount>')
 
-    for fv in obj.fvert:
-        if fv[0] == fv[3]:
-            fp.write('3 ')
-        else:
-            fp.write('4 ')
+    isTri = obj.fvert[:,0] == obj.fvert[:,3]
+    formatting.writeRows(fp, '%d ', numpy.where(isTri, 3, 4))
 
     fp.write('\n' +
         '          </vcount>\n'
         '          <p>')
 
-    for fn,fv in enumerate(obj.fvert):
-        fuv = obj.fuvs[fn]
-        if fv[0] == fv[3]:
-            nverts = 3
-        else:
-            nverts = 4
-        if config.useNormals:
-            for n in range(nverts):
-                fp.write("%d %d %d " % (fv[n], fn, fuv[n]))
-        else:
-            for n in range(nverts):
-                fp.write("%d %d " % (fv[n], fuv[n]))
+    # Per corner index columns: vertex [, normal], uv
+    columns = [obj.fvert]
+    if config.useNormals:
+        columns.append(numpy.repeat(numpy.arange(len(obj.fvert))[:,None], obj.fvert.shape[1], axis=1))
+    columns.append(obj.fuvs)
+    corners = numpy.dstack(columns).astype(numpy.int64)
+    token = "%d %d %d " if config.useNormals else "%d %d "
+    formatting.writeFaceRows(fp, 4*token, 3*token, corners, isTri)
 
     fp.write(
         '          </p>\n' +
@@ -765,13 +772,12 @@ def writePolylist(fp, stuff, config):
 
 def checkFaces(stuff, nVerts, nUvVerts):
     obj = stuff.meshInfo.object
-    for fn,fverts in enumerate(obj.fvert):
-        for n,vn in enumerate(fverts):
-            uv = obj.fuvs[fn][n]
-            if vn > nVerts:
-                raise NameError("v %d > %d" % (vn, nVerts))
-            if uv > nUvVerts:
-                raise NameError("uv %d > %d" % (uv, nUvVerts))            
+    bad = numpy.flatnonzero(obj.fvert.ravel() > nVerts)
+    if len(bad):
+        raise NameError("v %d > %d" % (obj.fvert.flat[bad[0]], nVerts))
+    bad = numpy.flatnonzero(obj.fuvs.ravel() > nUvVerts)
+    if len(bad):
+        raise NameError("uv %d > %d" % (obj.fuvs.flat[bad[0]], nUvVerts))
     return 
     
 #
@@ -820,6 +826,23 @@ def rotateLoc(loc, config):
     return (x,y,z)        
 
 
+def rotateLocs(locs, config):
+    """
+    rotateLoc applied to an (n,3) array of locations at once. The rotations
+    only swap and negate axes, so the result is exact.
+    """
+    locs = numpy.asarray(locs)
+    index = [0,1,2]
+    sign = [1,1,1]
+    if config.rotate90X:
+        index = [index[0], index[2], index[1]]
+        sign = [sign[0], -sign[2], sign[1]]
+    if config.rotate90Z:
+        index = [index[1], index[0], index[2]]
+        sign = [-sign[1], sign[0], sign[2]]
+    return locs[:,index] * numpy.array(sign, dtype=locs.dtype)
+
+
 def writeBone(fp, bone, orig, extra, pad, stuff, config):
     (name, children) = bone
     if name:
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Exporter plugin for the binary glTF 2.0 format (.glb).
+"""
+
+import gui
+from export import Exporter
+from exportutils.config import Config
+
+class GltfConfig(Config):
+
+    def __init__(self, exporter):
+        Config.__init__(self)
+        self.selectedOptions(exporter)
+        self.useRelPaths = True
+        self.expressions     = exporter.expressions.selected
+        self.useCustomShapes = exporter.useCustomShapes.selected
+        self.animations      = exporter.animations.selected
+
+
+class ExporterGltf(Exporter):
+    def __init__(self):
+        Exporter.__init__(self)
+        self.name = "glTF binary (glb)"
+        self.filter = "glTF binary (*.glb)"
+
+    def build(self, options, taskview):
+        Exporter.build(self, options, taskview)
+        self.expressions     = options.addWidget(gui.CheckBox("Expressions", False))
+        self.useCustomShapes = options.addWidget(gui.CheckBox("Custom shapes", False))
+        self.animations      = options.addWidget(gui.CheckBox("Animations", True))
+
+    def export(self, human, filename):
+        from . import mh2gltf
+
+        mh2gltf.exportGlb(human, filename("glb"), GltfConfig(self))
+
+def load(app):
+    app.addExporter(ExporterGltf())
+
+def unload(app):
+    pass
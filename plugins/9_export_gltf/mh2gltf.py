@@ -0,0 +1,529 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Export to the binary glTF 2.0 format.
+
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Writes the human, its proxy and clothes to a single .glb file: a JSON
+description of the scene followed by one binary buffer. Vertex attributes
+are interleaved in numpy record arrays, and all arrays are written to the
+binary chunk as they are, nothing is converted to text.
+
+If the human has a skeleton, its bones are written as a hierarchy of nodes
+and every mesh is skinned with JOINTS_0 / WEIGHTS_0, using the four largest
+weights of each vertex. The animations of the human become samplers of the
+bone translations and rotations. Shape keys (expressions and custom shapes)
+are written as sparse morph targets, holding only the vertices they move.
+
+See https://github.com/KhronosGroup/glTF/tree/master/specification/2.0
+"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import time
+import json
+import struct
+import numpy as np
+
+import exportutils
+import skeleton
+import animation
+import log
+
+# Buffer view targets
+ArrayBuffer = 34962
+ElementArrayBuffer = 34963
+
+# Accessor component types
+UnsignedShort = 5123
+UnsignedInt = 5125
+Float = 5126
+
+ComponentTypes = {
+    np.dtype(np.uint16): UnsignedShort,
+    np.dtype(np.uint32): UnsignedInt,
+    np.dtype(np.float32): Float,
+    }
+
+AccessorTypes = {1: 'SCALAR', 2: 'VEC2', 3: 'VEC3', 4: 'VEC4', 16: 'MAT4'}
+
+# Maximum number of bones influencing a vertex
+MaxInfluences = 4
+
+# Records of the interleaved vertex buffers
+VertexRecord = np.dtype([('position', '<f4', (3,)), ('normal', '<f4', (3,)), ('texco', '<f4', (2,))])
+SkinRecord = np.dtype([('joints', '<u2', (MaxInfluences,)), ('weights', '<f4', (MaxInfluences,))])
+
+
+class GlbBuffer(object):
+    """
+    The binary chunk of a .glb file with its buffer views and accessors.
+    Arrays added to the buffer are kept as they are and only written when the
+    file is saved.
+    """
+
+    def __init__(self):
+        self.arrays = []
+        self.bufferViews = []
+        self.accessors = []
+        self.byteLength = 0
+
+    def addBufferView(self, array, target = None, byteStride = None):
+        array = np.ascontiguousarray(array)
+        # Keep every buffer view aligned to 4 bytes
+        offset = (self.byteLength + 3) & ~3
+        view = {'buffer': 0, 'byteOffset': offset, 'byteLength': array.nbytes}
+        if target:
+            view['target'] = target
+        if byteStride:
+            view['byteStride'] = byteStride
+        self.arrays.append((offset, array))
+        self.bufferViews.append(view)
+        self.byteLength = offset + array.nbytes
+        return len(self.bufferViews) - 1
+
+    def addAccessor(self, bufferView, componentType, count, type, byteOffset = 0, values = None):
+        """
+        Add an accessor for count elements of a buffer view. If values is
+        given, its minimum and maximum are stored in the accessor.
+        """
+        accessor = {'componentType': componentType, 'count': count, 'type': type}
+        if bufferView is not None:
+            accessor['bufferView'] = bufferView
+            if byteOffset:
+                accessor['byteOffset'] = byteOffset
+        if values is not None:
+            values = np.asarray(values).reshape(count, -1)
+            accessor['min'] = values.min(axis=0).tolist()
+            accessor['max'] = values.max(axis=0).tolist()
+        self.accessors.append(accessor)
+        return len(self.accessors) - 1
+
+    def addArray(self, array, target = None, minMax = False):
+        """
+        Add an (n,) or (n, k) array as a buffer view with one accessor.
+        """
+        array = np.ascontiguousarray(array)
+        view = self.addBufferView(array, target)
+        size = array[0].size if array.ndim > 1 else 1
+        return self.addAccessor(view, ComponentTypes[array.dtype], len(array), AccessorTypes[size],
+                                values = array if minMax else None)
+
+    @property
+    def paddedLength(self):
+        return (self.byteLength + 3) & ~3
+
+    def write(self, f):
+        pos = 0
+        for offset, array in self.arrays:
+            f.write('\x00' * (offset - pos))
+            array.tofile(f)
+            pos = offset + array.nbytes
+        f.write('\x00' * (self.paddedLength - pos))
+
+
+def exportGlb(human, filepath, config = None):
+    if config is None:
+        config = exportutils.config.Config()
+    time1 = time.clock()
+    config.setHuman(human)
+    config.setupTexFolder(filepath)
+    filename = os.path.basename(filepath)
+    name = config.goodName(os.path.splitext(filename)[0])
+
+    skel = getSkeleton(human)
+    rawTargets = exportutils.collect.readTargets(human, config)
+    # The weights of the skeleton are only known for the unsubdivided mesh
+    stuffs = exportutils.collect.setupObjects(
+        name,
+        human,
+        config=config,
+        rawTargets=rawTargets,
+        helpers=config.helpers,
+        eyebrows=config.eyebrows,
+        lashes=config.lashes,
+        subdivide=config.subdivide and not skel)
+
+    gltf = {
+        'asset': {'version': '2.0', 'generator': 'MakeHuman'},
+        'scene': 0,
+        'scenes': [{'name': name, 'nodes': []}],
+        'nodes': [],
+        'meshes': [],
+        'materials': [],
+        'textures': [],
+        'images': [],
+        'skins': [],
+        'animations': [],
+        }
+    buf = GlbBuffer()
+
+    if skel:
+        addSkeleton(gltf, buf, skel, config.scale)
+
+    for stuff in stuffs:
+        node = {'name': stuff.name, 'mesh': addMesh(gltf, buf, human, stuff, skel, config)}
+        if skel:
+            node['skin'] = 0
+        gltf['scenes'][0]['nodes'].append(len(gltf['nodes']))
+        gltf['nodes'].append(node)
+
+    if skel and getattr(config, 'animations', True) and hasattr(human, 'animations'):
+        for anim in human.animations:
+            addAnimation(gltf, buf, skel, anim.getAnimationTrack(), config.scale)
+
+    writeGlb(filepath, gltf, buf)
+    time2 = time.clock()
+    log.message("Wrote glTF file in %g s: %s", time2-time1, filepath)
+
+
+def getSkeleton(human):
+    if not hasattr(human, 'getSkeleton'):
+        return None
+    return human.getSkeleton()
+
+
+def toXYZW(quats):
+    # animation.matricesToQuaternions returns (w, x, y, z)
+    return quats[...,[1,2,3,0]]
+
+#
+#   Skeleton
+#
+
+def addSkeleton(gltf, buf, skel, scale):
+    """
+    Add the bones of skel as nodes in their rest pose, and a skin with their
+    inverse bind matrices. Bone i is node nodes[0] + i.
+    """
+    bones = skel.getBones()
+    first = len(gltf['nodes'])
+
+    rest = np.array([bone.matRestRelative for bone in bones], dtype=np.float64)
+    rotations = toXYZW(animation.matricesToQuaternions(rest[:,:3,:3]))
+    translations = rest[:,:3,3] * scale
+    for bIdx, bone in enumerate(bones):
+        node = {
+            'name': bone.name,
+            'translation': translations[bIdx].tolist(),
+            'rotation': rotations[bIdx].tolist(),
+            }
+        if bone.children:
+            node['children'] = [first + child.index for child in bone.children]
+        gltf['nodes'].append(node)
+
+    roots = [first + bone.index for bone in bones if not bone.parent]
+    gltf['scenes'][0]['nodes'].extend(roots)
+
+    # Column major inverse bind matrices
+    inverseBind = np.linalg.inv(np.array([bone.matRestGlobal for bone in bones], dtype=np.float64))
+    inverseBind[:,:3,3] *= scale
+    inverseBind = inverseBind.transpose(0,2,1).reshape(-1, 16).astype(np.float32)
+    gltf['skins'].append({
+        'name': skel.name,
+        'inverseBindMatrices': buf.addArray(inverseBind),
+        'joints': range(first, first + len(bones)),
+        'skeleton': roots[0],
+        })
+
+
+def getStuffWeights(human, stuff, obj):
+    """
+    The bone weights of the vertices of obj, as {bone: (verts, weights)}.
+    """
+    bodyWeights = human.getVertexWeights()
+    if bodyWeights is None:
+        return {}
+    if stuff.type:
+        # Determine vertex weights for proxy
+        return skeleton.getProxyWeights(stuff.proxy, bodyWeights, obj)
+
+    # Account for vertices that are filtered out
+    if stuff.meshInfo.vertexMapping is None:
+        return bodyWeights
+    weights = {}
+    for (boneName, (verts,ws)) in bodyWeights.items():
+        verts2 = stuff.meshInfo.vertexMapping[np.asarray(verts, dtype=np.int32)]
+        keep = verts2 >= 0
+        weights[boneName] = (verts2[keep], np.asarray(ws)[keep])
+    return weights
+
+
+def packWeights(weights, skel, nVerts):
+    """
+    The MaxInfluences largest weights of every vertex, normalized, as
+    (nVerts, MaxInfluences) arrays of bone indices and weights. Vertices
+    without weights are bound to the root bone.
+    """
+    bones = []
+    verts = []
+    values = []
+    for boneName, (vs, ws) in weights.items():
+        if not skel.containsBone(boneName) or len(vs) == 0:
+            continue
+        bones.append(np.repeat(skel.getBone(boneName).index, len(vs)))
+        verts.append(np.asarray(vs, dtype=np.int64))
+        values.append(np.asarray(ws, dtype=np.float32))
+
+    joints = np.zeros((nVerts, MaxInfluences), dtype=np.uint16)
+    packed = np.zeros((nVerts, MaxInfluences), dtype=np.float32)
+    if bones:
+        bones = np.concatenate(bones)
+        verts = np.concatenate(verts)
+        values = np.concatenate(values)
+
+        # Sort by vertex, largest weight first, and number the weights of
+        # every vertex
+        order = np.lexsort((-values, verts))
+        bones, verts, values = bones[order], verts[order], values[order]
+        rank = np.arange(len(verts)) - np.searchsorted(verts, verts)
+        keep = rank < MaxInfluences
+        joints[verts[keep], rank[keep]] = bones[keep]
+        packed[verts[keep], rank[keep]] = values[keep]
+
+    total = packed.sum(axis=1)
+    weighted = total > 0
+    packed[weighted] /= total[weighted,None]
+    packed[~weighted,0] = 1
+    return joints, packed
+
+#
+#   Meshes
+#
+
+def unweldMesh(obj):
+    """
+    Split the vertices of obj that have different UVs in different faces,
+    as Object3D.updateIndexBuffer does, without touching the render buffers
+    of obj. Returns the vertex and UV of every unwelded vertex and the faces
+    as indices of unwelded vertices.
+    """
+    packed = obj.fvert.astype(np.uint64) << 32
+    packed |= obj.fuvs
+    unwelded, faces = np.unique(packed.reshape(-1), return_inverse=True)
+    vmap = (unwelded >> np.uint64(32)).astype(np.uint32)
+    tmap = (unwelded & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+    return vmap, tmap, faces.reshape(obj.fvert.shape).astype(np.uint32)
+
+def getVertexNormals(obj):
+    """
+    The vertex normals of obj, the normalized sum of the normals of the faces
+    around each vertex, as Object3D.calcVertexNormals computes them.
+    """
+    corners = obj.coord[obj.fvert]
+    fnorm = np.cross(corners[:,0] - corners[:,1], corners[:,1] - corners[:,2])
+    vnorm = np.zeros((len(obj.coord), 3), dtype=np.float64)
+    np.add.at(vnorm, obj.fvert.reshape(-1), np.repeat(fnorm, obj.fvert.shape[1], axis=0))
+    length = np.sqrt(np.sum(vnorm ** 2, axis=-1))
+    length[length == 0] = 1
+    return (vnorm / length[:,None]).astype(np.float32)
+
+def addMesh(gltf, buf, human, stuff, skel, config):
+    # The object may be the mesh of the human itself, shared with the other
+    # exporters of a session, so it is only read
+    obj = stuff.meshInfo.object
+    # Unweld the vertices that have different UVs in different faces
+    vmap, tmap, faces = unweldMesh(obj)
+    nVerts = len(vmap)
+
+    verts = np.zeros(nVerts, dtype=VertexRecord)
+    verts['position'] = obj.coord[vmap]
+    verts['normal'] = getVertexNormals(obj)[vmap]
+    if obj.has_uv:
+        verts['texco'] = obj.texco[tmap]
+        verts['texco'][:,1] = 1 - verts['texco'][:,1]
+
+    view = buf.addBufferView(verts, ArrayBuffer, VertexRecord.itemsize)
+    attributes = {
+        'POSITION': buf.addAccessor(view, Float, nVerts, 'VEC3', VertexRecord.fields['position'][1], verts['position']),
+        'NORMAL': buf.addAccessor(view, Float, nVerts, 'VEC3', VertexRecord.fields['normal'][1]),
+        }
+    if obj.has_uv:
+        attributes['TEXCOORD_0'] = buf.addAccessor(view, Float, nVerts, 'VEC2', VertexRecord.fields['texco'][1])
+
+    if skel:
+        joints, weights = packWeights(getStuffWeights(human, stuff, obj), skel, len(obj.coord))
+        skin = np.zeros(nVerts, dtype=SkinRecord)
+        skin['joints'] = joints[vmap]
+        skin['weights'] = weights[vmap]
+        view = buf.addBufferView(skin, ArrayBuffer, SkinRecord.itemsize)
+        attributes['JOINTS_0'] = buf.addAccessor(view, UnsignedShort, nVerts, 'VEC4', SkinRecord.fields['joints'][1])
+        attributes['WEIGHTS_0'] = buf.addAccessor(view, Float, nVerts, 'VEC4', SkinRecord.fields['weights'][1])
+
+    # Triangles, quads are split in (0, 1, 2) and (2, 3, 0)
+    if faces.shape[1] == 4:
+        keep = np.ones((len(faces), 2), dtype=bool)
+        keep[:,1] = obj.fvert[:,0] != obj.fvert[:,3]
+        faces = faces[:, [[0, 1, 2], [2, 3, 0]]][keep]
+    indices = faces.ravel().astype(np.uint16 if nVerts <= 0xFFFF else np.uint32)
+
+    primitive = {
+        'attributes': attributes,
+        'indices': buf.addArray(indices, ElementArrayBuffer),
+        'material': addMaterial(gltf, human, stuff, config),
+        }
+    mesh = {'name': stuff.name, 'primitives': [primitive]}
+
+    targets, names = getMorphTargets(buf, stuff, obj, vmap)
+    if targets:
+        primitive['targets'] = targets
+        mesh['weights'] = [0.0] * len(targets)
+        mesh['extras'] = {'targetNames': names}
+
+    gltf['meshes'].append(mesh)
+    return len(gltf['meshes']) - 1
+
+
+def getMorphTargets(buf, stuff, obj, vmap):
+    """
+    Sparse POSITION morph targets for the shape keys of stuff, on the
+    unwelded vertices vmap of obj. Shape keys that do not move any vertex
+    are left out.
+    """
+    targets = []
+    names = []
+    nVerts = len(vmap)
+    for name, (verts, deltas) in stuff.meshInfo.shapes:
+        offsets = np.zeros((len(obj.coord), 3), dtype=np.float32)
+        offsets[verts] = deltas
+        offsets = offsets[vmap]
+        moved = np.flatnonzero(np.any(offsets != 0, axis=1)).astype(np.uint32)
+        if len(moved) == 0:
+            continue
+        values = offsets[moved]
+        lo = np.minimum(values.min(axis=0), 0)
+        hi = np.maximum(values.max(axis=0), 0)
+        accessor = buf.addAccessor(None, Float, nVerts, 'VEC3')
+        buf.accessors[accessor].update({
+            'min': lo.tolist(),
+            'max': hi.tolist(),
+            'sparse': {
+                'count': len(moved),
+                'indices': {'bufferView': buf.addBufferView(moved), 'componentType': UnsignedInt},
+                'values': {'bufferView': buf.addBufferView(values)},
+                },
+            })
+        targets.append({'POSITION': accessor})
+        names.append(name)
+    return targets, names
+
+
+def addMaterial(gltf, human, stuff, config):
+    alpha = 1.0
+    if stuff.material:
+        for (key, value) in stuff.material.settings:
+            if key == "alpha":
+                alpha = float(value)
+
+    material = {
+        'name': stuff.name,
+        'pbrMetallicRoughness': {
+            'baseColorFactor': [1.0, 1.0, 1.0, alpha],
+            'metallicFactor': 0.0,
+            'roughnessFactor': 1.0,
+            },
+        }
+    if not stuff.type:
+        # Eyebrows and lashes are part of the human mesh
+        material['alphaMode'] = 'MASK'
+    elif alpha < 1:
+        material['alphaMode'] = 'BLEND'
+
+    if stuff.proxy:
+        texture = stuff.texture
+    else:
+        texture = ("data/textures", "texture.png")
+    if texture:
+        (folder, texfile) = texture
+        texpath = config.getTexturePath(texfile, folder, True, human)
+        gltf['images'].append({'uri': texpath.replace(os.sep, '/')})
+        gltf['textures'].append({'source': len(gltf['images']) - 1})
+        material['pbrMetallicRoughness']['baseColorTexture'] = {'index': len(gltf['textures']) - 1}
+
+    gltf['materials'].append(material)
+    return len(gltf['materials']) - 1
+
+#
+#   Animations
+#
+
+def addAnimation(gltf, buf, skel, animTrack, scale):
+    """
+    Add an AnimationTrack as linear samplers of the translation and rotation
+    of every bone. The keyframes of all bones are stored in one buffer view
+    per path, bone by bone.
+    """
+    log.message("Exporting animation %s.", animTrack.name)
+    nFrames = animTrack.nFrames
+    nBones = animTrack.nBones
+    first = gltf['skins'][0]['joints'][0]
+
+    local = skel.getPoseLocalMatrices(animTrack.data[:nFrames*nBones])
+    translations = local[:,:,:3,3] * scale
+    rotations = toXYZW(animation.matricesToQuaternions(local[:,:,:3,:3].reshape(-1, 3, 3)).reshape(nFrames, nBones, 4))
+
+    # Keep the sign of consecutive quaternions, for the shortest interpolation
+    flip = np.ones((nFrames, nBones))
+    flip[1:] = np.where(np.sum(rotations[1:] * rotations[:-1], axis=-1) < 0, -1, 1)
+    rotations *= np.cumprod(flip, axis=0)[:,:,None]
+
+    translations = np.ascontiguousarray(translations.transpose(1,0,2), dtype=np.float32)
+    rotations = np.ascontiguousarray(rotations.transpose(1,0,2), dtype=np.float32)
+
+    times = (np.arange(nFrames) / animTrack.frameRate).astype(np.float32)
+    timeAccessor = buf.addArray(times, minMax = True)
+    translationView = buf.addBufferView(translations)
+    rotationView = buf.addBufferView(rotations)
+
+    samplers = []
+    channels = []
+    for bIdx in xrange(nBones):
+        for view, path, type, size in ((translationView, 'translation', 'VEC3', 12), (rotationView, 'rotation', 'VEC4', 16)):
+            output = buf.addAccessor(view, Float, nFrames, type, bIdx * nFrames * size)
+            channels.append({'sampler': len(samplers), 'target': {'node': first + bIdx, 'path': path}})
+            samplers.append({'input': timeAccessor, 'output': output, 'interpolation': 'LINEAR'})
+
+    gltf['animations'].append({'name': animTrack.name, 'samplers': samplers, 'channels': channels})
+
+#
+#   File
+#
+
+def writeGlb(filepath, gltf, buf):
+    gltf['buffers'] = [{'byteLength': buf.paddedLength}]
+    gltf['bufferViews'] = buf.bufferViews
+    gltf['accessors'] = buf.accessors
+    # Top level arrays may not be empty
+    for key in gltf.keys():
+        if gltf[key] == []:
+            del gltf[key]
+
+    text = json.dumps(gltf, separators=(',', ':'))
+    text += ' ' * (-len(text) % 4)
+    length = 12 + 8 + len(text) + 8 + buf.paddedLength
+
+    f = open(filepath, 'wb')
+    f.write(struct.pack('<4sII', 'glTF', 2, length))
+    f.write(struct.pack('<I4s', len(text), 'JSON'))
+    f.write(text)
+    f.write(struct.pack('<I4s', buf.paddedLength, 'BIN\x00'))
+    buf.write(f)
+    f.close()
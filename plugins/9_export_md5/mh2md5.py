@@ -38,12 +38,16 @@ import numpy.linalg as la
 import aljabr
 import exportutils
 import skeleton
+import animation
 import log
 
 ZYRotation = np.array(((1,0,0,0),(0,0,-1,0),(0,1,0,0),(0,0,0,1)), dtype=np.float32)
 
 scale = 5  # Override scale setting to a sensible default for doom-style engines
 
+# Number of animation frames formatted into one block before writing
+FrameChunkSize = 64
+
 
 def exportMd5(human, filepath, config):
     """
@@ -136,17 +140,13 @@ def exportMd5(human, filepath, config):
                 # Use vertex weights for human body
                 weights = bodyWeights
                 # Account for vertices that are filtered out
-                if stuff.meshInfo.vertexMapping != None:
+                if stuff.meshInfo.vertexMapping is not None:
                     filteredVIdxMap = stuff.meshInfo.vertexMapping
                     weights2 = {}
                     for (boneName, (verts,ws)) in weights.items():
-                        verts2 = []
-                        ws2 = []
-                        for i, vIdx in enumerate(verts):
-                            if vIdx in filteredVIdxMap:
-                                verts2.append(filteredVIdxMap[vIdx])
-                                ws2.append(ws[i])
-                        weights2[boneName] = (verts2, ws2)
+                        verts2 = filteredVIdxMap[np.asarray(verts, dtype=np.int32)]
+                        keep = verts2 >= 0
+                        weights2[boneName] = (verts2[keep], np.asarray(ws)[keep])
                     weights = weights2
 
             # Remap vertex weights to the unwelded vertices of the object (obj.coord to obj.r_coord)
@@ -328,17 +328,9 @@ def writeAnimation(filepath, human, config, animTrack):
     f.write('}\n\n')
 
     f.write('bounds {\n')
-    bounds = human.meshData.calcBBox()
-    if config.feetOnGround:
-        bounds[:][1] += getFeetOnGroundOffset(human)
-    if config.zUp:
-        bounds[0] = bounds[0][[0,2,1]] * [1,-1,1]
-        bounds[1] = bounds[1][[0,2,1]] * [1,-1,1]
-    bounds = bounds * scale
-    # TODO use bounds calculated for every frame
-    for frameIdx in xrange(animTrack.nFrames):
-        #( vec3:boundMin ) ( vec3:boundMax )
-        f.write('\t( %f %f %f ) ( %f %f %f )\n' % (bounds[0][0], bounds[0][1], bounds[0][2], bounds[1][0], bounds[1][1], bounds[1][2]))
+    bounds = calcFrameBounds(human, config, animTrack)
+    #( vec3:boundMin ) ( vec3:boundMax )
+    exportutils.formatting.writeRows(f, '\t( %f %f %f ) ( %f %f %f )\n', bounds)
     f.write('}\n\n')
 
     f.write('baseframe {\n')
@@ -365,41 +357,60 @@ def writeAnimation(filepath, human, config, animTrack):
         bases.append((pos, [qx, qy, qz, w]))
     f.write('}\n\n')
 
-    for frameIdx in xrange(animTrack.nFrames):
-        frame = animTrack.getAtFramePos(frameIdx)
-        f.write('frame %d {\n' % frameIdx)
-        f.write('\t%f %f %f %f %f %f\n' % (0.0, 0.0, 0.0, 0.0, 0.0, 0.0))  # Transformation for origin joint
-        for bIdx in xrange(numJoints-1):
-            transformationMat = frame[bIdx].copy()
-            pos = transformationMat[:3,3] * scale
-            transformationMat[:3,3] = [0.0, 0.0, 0.0]
-
-            if config.zUp:
-                transformationMat = np.dot(ZYRotation, np.dot(transformationMat,la.inv(ZYRotation)))
-                pos = pos[[0,2,1]] * [1,-1,1]
-
-            #baseRot = aljabr.quaternion2Matrix(bases[bIdx][1])
-            #transformationMat = np.dot(transformationMat[:3,:3], baseRot)
-
-            pos += bases[bIdx][0]
-            orientationQuat = aljabr.matrix2Quaternion(transformationMat)
-            qx = orientationQuat[0]
-            qy = orientationQuat[1]
-            qz = orientationQuat[2]
-            w = orientationQuat[3]
-
-            if w > 0:
-                qx = -qx
-                qy = -qy
-                qz = -qz
-
-            # vec3:position vec3:orientation
-            f.write('\t%f %f %f %f %f %f\n' % (pos[0], pos[1], pos[2], qx, qy, qz))
-        f.write('}\n\n')
+    # Joint positions and orientations of all frames at once
+    nBones = numJoints-1
+    frames = np.asarray(animTrack.data[:animTrack.nFrames*nBones], dtype=np.float64)
+    pos = frames[:,:3,3] * scale
+    rot = frames[:,:3,:3]
+    if config.zUp:
+        zy = ZYRotation[:3,:3].astype(np.float64)
+        rot = np.einsum('ij,njk,kl->nil', zy, rot, zy.T)
+        pos = pos[:,[0,2,1]] * [1,-1,1]
+    basePos = np.asarray([base[0] for base in bases], dtype=np.float64)
+    pos = pos.reshape(-1, nBones, 3) + basePos[None,:,:]
+    quats = animation.matricesToQuaternions(rot)
+    # Orientations are written with a negative w component
+    quats[quats[:,0] > 0] *= -1
+    rows = np.concatenate([pos.reshape(-1, 3), quats[:,1:]], axis=-1).reshape(-1, nBones, 6)
+
+    boneFmt = '\t%f %f %f %f %f %f\n' * nBones
+    for start in xrange(0, animTrack.nFrames, FrameChunkSize):
+        block = []
+        for frameIdx in xrange(start, min(start + FrameChunkSize, animTrack.nFrames)):
+            block.append('frame %d {\n' % frameIdx)
+            block.append('\t%f %f %f %f %f %f\n' % (0.0, 0.0, 0.0, 0.0, 0.0, 0.0))  # Transformation for origin joint
+            block.append(boneFmt % tuple(rows[frameIdx].ravel().tolist()))
+            block.append('}\n\n')
+        f.write(''.join(block))
 
     f.close()
 
 
+def calcFrameBounds(human, config, animTrack):
+    """
+    The bounds of the human mesh in every frame of animTrack, skinned in
+    one batch, in the coordinate system of the exported file.
+    Falls back to the rest pose bounds when the mesh is not skinned.
+    """
+    skel = human.getSkeleton()
+    weights = human.getVertexWeights()
+    coords = None
+    if human.animated:
+        coords = human.animated.getRestCoordinates("base.obj")
+
+    if weights and coords is not None:
+        bounds = skel.skinBounds(animTrack.data[:animTrack.nFrames*skel.getBoneCount()], coords, weights)
+    else:
+        bounds = np.tile(human.meshData.calcBBox(), (animTrack.nFrames, 1, 1)).astype(np.float64)
+
+    if config.feetOnGround:
+        bounds[:,:,1] += getFeetOnGroundOffset(human)
+    if config.zUp:
+        bounds = bounds[:,:,[0,2,1]] * [1,-1,1]
+        bounds = np.concatenate([bounds.min(axis=1)[:,None], bounds.max(axis=1)[:,None]], axis=1)
+    return bounds.reshape(-1, 6) * scale
+
+
 def copyTexture(texture, human, config):
     if not texture:
         return
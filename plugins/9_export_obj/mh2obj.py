@@ -23,8 +23,9 @@ Exports proxy mesh to obj
 """
 
 import os
-import math
+import numpy as np
 import exportutils
+from exportutils import formatting
 import mh2proxy
 
 #
@@ -57,81 +58,79 @@ def exportObj(human, filepath, config=None):
         "# www.makehuman.org\n\n" +
         "mtllib %s\n" % os.path.basename(mtlfile))
 
-    # Vertices
+    writeGeometry(fp, stuffs, config.useNormals)
+    fp.close()
     
+    fp = open(mtlfile, 'w')
+    fp.write(
+        '# MakeHuman exported MTL\n' +
+        '# www.makehuman.org\n\n')
     for stuff in stuffs:
-        obj = stuff.meshInfo.object
-        for co in obj.coord:
-            fp.write("v %.4g %.4g %.4g\n" % tuple(co))
+        writeMaterial(fp, stuff, human, config)
+    fp.close()
+    return
 
-    # Vertex normals
-    
-    if config.useNormals:
-        for stuff in stuffs:
-            obj = stuff.meshInfo.object
-            obj.calcFaceNormals()
-            #obj.calcVertexNormals()
-            for no in obj.fnorm:
-                no = no/math.sqrt(no.dot(no))
-                fp.write("vn %.4g %.4g %.4g\n" % tuple(no))
+#
+#   writeGeometry(fp, stuffs, useNormals):
+#
+
+def writeGeometry(fp, stuffs, useNormals=False):
+    """
+    Write the v, vn, vt and f sections for all stuffs. Whole arrays are
+    formatted at once and written in chunks.
+    """
+    objs = [stuff.meshInfo.object for stuff in stuffs]
+
+    # Vertices
+
+    for obj in objs:
+        formatting.writeRows(fp, "v %.4g %.4g %.4g\n", obj.coord)
 
+    # Face normals
+
+    if useNormals:
+        for obj in objs:
+            obj.calcFaceNormals()
+            fnorm = obj.fnorm / np.sqrt(np.sum(obj.fnorm ** 2, axis=-1))[:,None]
+            formatting.writeRows(fp, "vn %.4g %.4g %.4g\n", fnorm)
 
     # UV vertices
-    
-    for stuff in stuffs:
-        obj = stuff.meshInfo.object
+
+    for obj in objs:
         if obj.has_uv:
-            for uv in obj.texco:
-                fp.write("vt %.4g %.4g\n" % tuple(uv))
+            formatting.writeRows(fp, "vt %.4g %.4g\n", obj.texco)
 
     # Faces
-    
+
     nVerts = 1
     nTexVerts = 1
-    for stuff in stuffs:
+    nNormals = 1
+    for stuff, obj in zip(stuffs, objs):
         fp.write("usemtl %s\n" % stuff.name)
-        fp.write("g %s\n" % stuff.name)    
-        obj = stuff.meshInfo.object
-        for fn,fv in enumerate(obj.fvert):
-            fp.write('f ')
-            fuv = obj.fuvs[fn]                
-            if fv[0] == fv[3]:
-                nv = 3
-            else:
-                nv = 4
-            if config.useNormals:
-                if obj.has_uv:            
-                    for n in range(nv):
-                        vn = fv[n]+nVerts
-                        fp.write("%d/%d/%d " % (vn, fuv[n]+nTexVerts, fn))
-                else:
-                    for n in range(nv):
-                        vn = fv[n]+nVerts
-                        fp.write("%d//%d " % (vn, fn))
-            else:
-                if obj.has_uv:
-                    for n in range(nv):
-                        vn = fv[n]+nVerts
-                        fp.write("%d/%d " % (vn, fuv[n]+nTexVerts))
-                else:
-                    for n in range(nv):
-                        vn = fv[n]+nVerts
-                        fp.write("%d " % (vn))
-            fp.write('\n')
-        
+        fp.write("g %s\n" % stuff.name)
+
+        # Per corner index columns: vertex [, uv] [, normal]
+        columns = [obj.fvert + nVerts]
+        if obj.has_uv:
+            columns.append(obj.fuvs + nTexVerts)
+        if useNormals:
+            fn = np.arange(len(obj.fvert))[:,None] + nNormals
+            columns.append(np.repeat(fn, obj.fvert.shape[1], axis=1))
+        corners = np.dstack(columns).astype(np.int64)
+
+        if useNormals:
+            token = "%d/%d/%d" if obj.has_uv else "%d//%d"
+        else:
+            token = "%d/%d" if obj.has_uv else "%d"
+        formatting.writeFaceRows(fp,
+            "f %s\n" % " ".join([token]*4),
+            "f %s\n" % " ".join([token]*3),
+            corners, obj.fvert[:,0] == obj.fvert[:,3])
+
         nVerts += len(obj.coord)
         nTexVerts += len(obj.texco)
-        
-    fp.close()
-    
-    fp = open(mtlfile, 'w')
-    fp.write(
-        '# MakeHuman exported MTL\n' +
-        '# www.makehuman.org\n\n')
-    for stuff in stuffs:
-        writeMaterial(fp, stuff, human, config)
-    fp.close()
-    return
+        nNormals += len(obj.fvert)
+
 
 #
 #   writeMaterial(fp, stuff, human, config):
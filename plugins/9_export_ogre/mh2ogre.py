@@ -31,9 +31,9 @@ __docformat__ = 'restructuredtext'
 
 import os
 import numpy as np
-import transformations
 import exportutils
 import skeleton
+import animation
 import log
 
 feetOnGround = True
@@ -138,17 +138,13 @@ def writeMeshFile(human, filepath, stuffs, config):
                 # Use vertex weights for human body
                 weights = bodyWeights
                 # Account for vertices that are filtered out
-                if stuff.meshInfo.vertexMapping != None:
+                if stuff.meshInfo.vertexMapping is not None:
                     filteredVIdxMap = stuff.meshInfo.vertexMapping
                     weights2 = {}
                     for (boneName, (verts,ws)) in weights.items():
-                        verts2 = []
-                        ws2 = []
-                        for i, vIdx in enumerate(verts):
-                            if vIdx in filteredVIdxMap:
-                                verts2.append(filteredVIdxMap[vIdx])
-                                ws2.append(ws[i])
-                        weights2[boneName] = (verts2, ws2)
+                        verts2 = filteredVIdxMap[np.asarray(verts, dtype=np.int32)]
+                        keep = verts2 >= 0
+                        weights2[boneName] = (verts2[keep], np.asarray(ws)[keep])
                     weights = weights2
 
             # Remap vertex weights to the unwelded vertices of the object (obj.coord to obj.r_coord)
@@ -268,22 +264,39 @@ def writeAnimation(human, fp, animTrack):
     log.message("Exporting animation %s.", animTrack.name)
     fp.write('        <animation name="%s" length="%s">\n' % (animTrack.name, animTrack.getPlaytime()))
     fp.write('            <tracks>\n')
+
+    # Angle-axis rotations and translations of all frames at once
+    nBones = animTrack.nBones
+    poseData = np.asarray(animTrack.data[:animTrack.nFrames*nBones], dtype=np.float64)
+    quats = animation.matricesToQuaternions(poseData[:,:3,:3])
+    quats[quats[:,0] < 0] *= -1
+    angles = 2 * np.arccos(np.clip(quats[:,0], -1.0, 1.0))
+    sines = np.sqrt(np.maximum(1 - quats[:,0]**2, 0))
+    axes = np.zeros((len(quats), 3))
+    axes[:,0] = 1
+    rotated = sines > 1e-8
+    axes[rotated] = quats[rotated,1:] / sines[rotated,None]
+
+    keys = np.zeros((animTrack.nFrames, nBones, 8))
+    keys[:,:,0] = np.arange(animTrack.nFrames)[:,None] / float(animTrack.frameRate)
+    keys[:,:,1:4] = poseData[:,:3,3].reshape(-1, nBones, 3)
+    keys[:,:,4] = angles.reshape(-1, nBones)
+    keys[:,:,5:8] = axes.reshape(-1, nBones, 3)
+
+    # Times and translations keep their absolute precision in long clips,
+    # %.6g would round them to 0.01 from 1000 on
+    keyFmt = ('                        <keyframe time="%f">\n'
+              '                            <translate x="%f" y="%f" z="%f" />\n'
+              '                            <rotate angle="%.6g">\n'
+              '                                <axis x="%.6g" y="%.6g" z="%.6g" />\n'
+              '                            </rotate>\n'
+              '                        </keyframe>\n')
+    # TODO account for scale
     for bIdx, bone in enumerate(human.getSkeleton().getBones()):
         # Note: OgreXMLConverter will optimize out unused (not moving) animation tracks
         fp.write('                <track bone="%s">\n' % bone.name)
         fp.write('                    <keyframes>\n')
-        frameTime = 1.0/float(animTrack.frameRate)
-        for frameIdx in xrange(animTrack.nFrames):
-            poseMat = animTrack.getAtFramePos(frameIdx)[bIdx]
-            translation = poseMat[:3,3]
-            angle, axis, _ = transformations.rotation_from_matrix(poseMat)
-            fp.write('                        <keyframe time="%s">\n' % (float(frameIdx) * frameTime))
-            fp.write('                            <translate x="%s" y="%s" z="%s" />\n' % (translation[0], translation[1], translation[2]))
-            # TODO account for scale
-            fp.write('                            <rotate angle="%s">\n' % angle)
-            fp.write('                                <axis x="%s" y="%s" z="%s" />\n' % (axis[0], axis[1], axis[2]))
-            fp.write('                            </rotate>\n')
-            fp.write('                        </keyframe>\n')
+        exportutils.formatting.writeRows(fp, keyFmt, keys[:,bIdx])
         fp.write('                    </keyframes>\n')
         fp.write('                </track>\n')
     fp.write('            </tracks>\n')
@@ -33,8 +33,66 @@ Requires:
 __docformat__ = 'restructuredtext'
 
 import os
-import struct
+import numpy as np
 import exportutils
+from exportutils import formatting
+
+# A facet of a binary STL file: normal, three vertices and attribute byte count
+StlRecord = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+
+# A facet of an ASCII STL file, formatted from a row of 12 values
+AsciiFacet = ('facet normal %f %f %f\n'
+              '\touter loop\n'
+              '\t\tvertex %f %f %f\n'
+              '\t\tvertex %f %f %f\n'
+              '\t\tvertex %f %f %f\n'
+              '\tendloop\n'
+              '\tendfacet\n')
+
+def getTriangles(stuffs):
+    """
+    The triangles of all stuffs, as a (n, 3, 3) array of vertex coordinates
+    and a (n, 3) array of unit normals.
+    Quads are split in the triangles (0, 1, 2) and (2, 3, 0), faces with their
+    last vertex equal to the first are triangles. The triangles of a face
+    follow each other, in the order of the faces.
+    """
+    triangles = []
+    for stuff in stuffs:
+        obj = stuff.meshInfo.object
+        fvert = np.asarray(obj.fvert)
+        if len(fvert) == 0:
+            continue
+        corners = fvert[:, [[0, 1, 2], [2, 3, 0]]]
+        keep = np.ones((len(fvert), 2), dtype=bool)
+        keep[:,1] = fvert[:,0] != fvert[:,3]
+        triangles.append(np.asarray(obj.coord, dtype=np.float32)[corners[keep]])
+
+    if not triangles:
+        return np.zeros((0, 3, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.float32)
+
+    coords = np.concatenate(triangles)
+    normals = np.cross(coords[:,0] - coords[:,1], coords[:,1] - coords[:,2])
+    length = np.sqrt(np.sum(normals ** 2, axis=-1))
+    length[length == 0] = 1
+    normals /= length[:,None]
+    return coords, normals
+
+def _setupStuffs(human, filepath, config):
+    config.setHuman(human)
+    config.setupTexFolder(filepath)
+    filename = os.path.basename(filepath)
+    name = config.goodName(os.path.splitext(filename)[0])
+
+    stuffs = exportutils.collect.setupObjects(
+        name, 
+        human,
+        config=config,
+        helpers=config.helpers, 
+        eyebrows=config.eyebrows, 
+        lashes=config.lashes,
+        subdivide=config.subdivide)
+    return name, stuffs
 
 def exportStlAscii(human, filepath, config, exportJoints = False):
     """
@@ -51,52 +109,24 @@ def exportStlAscii(human, filepath, config, exportJoints = False):
       *Config*.  Export configuration.
     """    
 
-    obj = human.meshData
-    config.setHuman(human)
-    config.setupTexFolder(filepath)
-    filename = os.path.basename(filepath)
-    name = config.goodName(os.path.splitext(filename)[0])
-
-    stuffs = exportutils.collect.setupObjects(
-        name, 
-        human,
-        config=config,
-        helpers=config.helpers, 
-        eyebrows=config.eyebrows, 
-        lashes=config.lashes,
-        subdivide=config.subdivide)
+    name, stuffs = _setupStuffs(human, filepath, config)
+    coords, normals = getTriangles(stuffs)
 
     f = open(filepath, 'w')
     solid = name.replace(' ','_')
     f.write('solid %s\n' % solid)
-
-    for stuff in stuffs:
-        obj = stuff.meshInfo.object
-        
-        for fn,fv in enumerate(obj.fvert):
-            f.write('facet normal %f %f %f\n' % tuple(obj.fnorm[fn]))
-            f.write('\touter loop\n')
-            f.write('\t\tvertex %f %f %f\n' % tuple(obj.coord[fv[0]]))
-            f.write('\t\tvertex %f %f %f\n' % tuple(obj.coord[fv[1]]))
-            f.write('\t\tvertex %f %f %f\n' % tuple(obj.coord[fv[2]]))
-            f.write('\tendloop\n')
-            f.write('\tendfacet\n')
-            
-            if fv[0] != fv[3]:
-                f.write('facet normal %f %f %f\n' % tuple(obj.fnorm[fn]))
-                f.write('\touter loop\n')
-                f.write('\t\tvertex %f %f %f\n' % tuple(obj.coord[fv[2]]))
-                f.write('\t\tvertex %f %f %f\n' % tuple(obj.coord[fv[3]]))
-                f.write('\t\tvertex %f %f %f\n' % tuple(obj.coord[fv[0]]))
-                f.write('\tendloop\n')
-                f.write('\tendfacet\n')
-        
+    formatting.writeRows(f, AsciiFacet, np.hstack([normals, coords.reshape(-1, 9)]))
     f.write('endsolid %s\n' % solid)
     f.close()
 
     
-def exportStlBinary(human, filename, config, exportJoints = False):
+def exportStlBinary(human, filepath, config, exportJoints = False):
     """
+    This function exports MakeHuman mesh data to stereolithography binary format.
+
+    Parameters
+    ----------
+
     human:     
       *Human*.  The object whose information is to be used for the export.
     filepath:     
@@ -105,44 +135,15 @@ def exportStlBinary(human, filename, config, exportJoints = False):
       *Config*.  Export configuration.
     """    
 
-    obj = human.meshData
-    config.setHuman(human)
-    config.setupTexFolder(filepath)
-    filename = os.path.basename(filepath)
-    name = config.goodName(os.path.splitext(filename)[0])
-
-    stuffs = exportutils.collect.setupObjects(
-        name, 
-        human,
-        config=config,
-        helpers=config.helpers, 
-        eyebrows=config.eyebrows, 
-        lashes=config.lashes,
-        subdivide=config.subdivide)
+    name, stuffs = _setupStuffs(human, filepath, config)
+    coords, normals = getTriangles(stuffs)
 
-    # TL: should loop over stuff (clothes etc) but only do nude human for now.
+    records = np.zeros(len(coords), dtype=StlRecord)
+    records['normal'] = normals
+    records['vertices'] = coords
 
-    f = open(filename, 'wb')
+    f = open(filepath, 'wb')
     f.write('\x00' * 80)
-    f.write(struct.pack('<I', 0))
-    count = 0
-    for fn,fverts in enumerate(obj.fvert):
-        fno = obj.fnorm[fn]
-
-        f.write(struct.pack('<fff', fno[0], fno[1], fno[2]))
-        f.write(struct.pack('<fff', fverts[0][0], fverts[0][1], fverts[0][2]))
-        f.write(struct.pack('<fff', fverts[1][0], fverts[1][1], fverts[1][2]))
-        f.write(struct.pack('<fff', fverts[2][0], fverts[2][1], fverts[2][2]))
-        f.write(struct.pack('<H', 0))
-        count += 1
-        
-        f.write(struct.pack('<fff', fno[0], fno[1], fno[2]))
-        f.write(struct.pack('<fff', fverts[2][0], fverts[2][1], fverts[2][2]))
-        f.write(struct.pack('<fff', fverts[3][0], fverts[3][1], fverts[3][2]))
-        f.write(struct.pack('<fff', fverts[0][0], fverts[0][1], fverts[0][2]))
-        f.write(struct.pack('<H', 0))
-        count += 1
-    f.seek(80)
-    f.write(struct.pack('<I', count))
-
-    
+    np.array([len(records)], dtype='<u4').tofile(f)
+    records.tofile(f)
+    f.close()
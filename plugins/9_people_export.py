@@ -31,7 +31,7 @@ import gui3d, gui
 import module3d
 import log
 import mh
-import bvh
+import motionlibrary
 import skeleton
 import skeleton_drawing
 import animation
@@ -56,6 +56,7 @@ RENDER_HELPERS = False
 WARNINGS = False
 SHOW_PICTURES = False
 SPARSIFY = True # If set to true, reduce animation framerate to 30 FPS if it is higher (probably not necessary
+BVH_SCALE = 0.7
 
 
 # Retrieve data path
@@ -76,6 +77,7 @@ class PeopleExportTaskView(gui3d.TaskView):
         self.rigButton.setFilter('Biovision Motion Hierarchy (*.bvh)')
         self.exportButton = box.addWidget(gui.Button('Export animation'))
         self.exportAllButton = box.addWidget(gui.Button('Export all'))
+        self.exportSequenceButton = box.addWidget(gui.Button('Export mesh sequence'))
 
         self.window = None
         @self.rigButton.mhEvent
@@ -99,6 +101,10 @@ class PeopleExportTaskView(gui3d.TaskView):
         def onClicked(event):
             self.exportAll()
 
+        @self.exportSequenceButton.mhEvent
+        def onClicked(event):
+            self.exportSequence()
+
         self.human = gui3d.app.selectedHuman
         self.humanChanged = False
         self.humanTransparent = False
@@ -240,33 +246,23 @@ class PeopleExportTaskView(gui3d.TaskView):
         log.message("Loading BVH animation %s", filename)
         animName = unicode(os.path.splitext(os.path.basename(filename))[0])
         self.stopPlayback()
+        # BVH files are parsed and retargeted once, and cached by the motion library
+        library = motionlibrary.getMotionLibrary(os.path.dirname(filename))
         if not self.animated.hasAnimation(animName):
-            # TODO cache bvh file (and mappings)
-            bvhRig = bvh.load(filename)
             # TODO scale bvh by comparing upper leg length
-            bvhRig.scale(0.7)
-            bvhRig.filename = filename
-
-            # TODO cache mapping
-            #jointToBoneMap = skeleton.loadJointsMapping("soft1", self.skel)
-            retargetMapping = skeleton.getRetargetMapping('mb', 'soft1', self.skel)
-            #retargetMapping = skeleton.getRetargetMappingFromBVH(bvhRig, 'soft1', self.skel)
-            # TODO guess format of source rig
-
-            animTrack = bvhRig.createAnimationTrack(retargetMapping, animName)
+            # TODO guess format of source rig, for now we assume all BVHs are mb format
+            animTrack = library.getAnimationTrack(filename, self.skel, 'soft1', 'mb', BVH_SCALE, animName)
             if SPARSIFY:
                 if animTrack.frameRate > 30:
                     animTrack.sparsify(30)
 
             self.animated.addAnimation(animTrack)
-
-            #self.__bvhRigCache['mb']  # TODO cache rig for all BVH rig types, for now we assume all BVHs are mb format
         else:
             animTrack = self.animated.getAnimation(animName)
 
         if not self.bvhAnimated or not self.bvhAnimated.hasAnimation(animName):
             # Draw BVH rig and/or add animation
-            self.loadBVHRig(bvhRig)
+            self.loadBVHRig(library.getBVH(filename, BVH_SCALE))
 
         self.animated.setActiveAnimation(animName)
         self.anim = animTrack
@@ -537,6 +533,17 @@ class PeopleExportTaskView(gui3d.TaskView):
             self.loadAnimation(bvhFile)
             self.export()
 
+    def exportSequence(self):
+        import exportutils
+
+        log.message("Exporting mesh sequence")
+        bodyParts = BodyParts()
+        bodyParts.readVertexDefinitions()
+        labels = bodyParts.getVertexLabels(self.human.meshData.getVertexCount())
+        animName = self.anim.name.replace('%', '%%')
+        outpath = os.path.join(DATA_PATH, 'mesh_%s_%%d.ply' % animName)
+        exportutils.sequence.exportSequence(self.human, self.animated, self.anim, outpath, 'ply', labels=labels)
+
     def renderAnimation(self, animName, clearColor=[150.0/255, 57.0/255, 80.0/255, 1.0], width=800, height=600):
         # TODO this creates an error with me
         #from glmodule import *
@@ -898,6 +905,17 @@ class BodyParts:
                 if WARNINGS:
                     log.warning("Warning: Parsing error at line "+str(lineCnt)+" of file "+ os.path.abspath(infile.name)+"!")
 
+    def getVertexLabels(self, nVerts):
+        """
+        Per vertex body part labels: the first vertex group each vertex is
+        assigned to, or -1 for unassigned vertices.
+        """
+        labels = np.zeros(nVerts, dtype=np.int32) - 1
+        for vertIdx, vGroups in self.groups.items():
+            if vGroups and vertIdx < nVerts:
+                labels[vertIdx] = vGroups[0]
+        return labels
+
 #### ColorMap ##################################################################
 
 #TODO perhaps define in data file
@@ -25,6 +25,8 @@ Data handlers for skeletal animation.
 import math
 import numpy as np
 
+import log
+
 
 INTERPOLATION = {
     'NONE'  : 0,
@@ -32,6 +34,151 @@ INTERPOLATION = {
     'LOG':    2
 }
 
+def matricesToQuaternions(rot):
+    """
+    Convert an (n,3,3) array of rotation matrices to an (n,4) array of unit
+    quaternions (w, x, y, z).
+    """
+    rot = np.asarray(rot, dtype=np.float64)
+    m00, m01, m02 = rot[:,0,0], rot[:,0,1], rot[:,0,2]
+    m10, m11, m12 = rot[:,1,0], rot[:,1,1], rot[:,1,2]
+    m20, m21, m22 = rot[:,2,0], rot[:,2,1], rot[:,2,2]
+    trace = m00 + m11 + m22
+
+    # Pick the numerically most stable formula for every matrix
+    case = np.argmax(np.column_stack([trace, m00, m11, m22]), axis=1)
+    w = np.empty(len(rot))
+    x = np.empty(len(rot))
+    y = np.empty(len(rot))
+    z = np.empty(len(rot))
+
+    c = case == 0
+    s = 2 * np.sqrt(np.maximum(1 + trace[c], 1e-12))
+    w[c] = 0.25 * s
+    x[c] = (m21[c] - m12[c]) / s
+    y[c] = (m02[c] - m20[c]) / s
+    z[c] = (m10[c] - m01[c]) / s
+
+    c = case == 1
+    s = 2 * np.sqrt(np.maximum(1 + m00[c] - m11[c] - m22[c], 1e-12))
+    w[c] = (m21[c] - m12[c]) / s
+    x[c] = 0.25 * s
+    y[c] = (m01[c] + m10[c]) / s
+    z[c] = (m02[c] + m20[c]) / s
+
+    c = case == 2
+    s = 2 * np.sqrt(np.maximum(1 + m11[c] - m00[c] - m22[c], 1e-12))
+    w[c] = (m02[c] - m20[c]) / s
+    x[c] = (m01[c] + m10[c]) / s
+    y[c] = 0.25 * s
+    z[c] = (m12[c] + m21[c]) / s
+
+    c = case == 3
+    s = 2 * np.sqrt(np.maximum(1 + m22[c] - m00[c] - m11[c], 1e-12))
+    w[c] = (m10[c] - m01[c]) / s
+    x[c] = (m02[c] + m20[c]) / s
+    y[c] = (m12[c] + m21[c]) / s
+    z[c] = 0.25 * s
+
+    q = np.column_stack([w, x, y, z])
+    return q / np.sqrt(np.sum(q*q, axis=-1))[:,None]
+
+def quaternionsToMatrices(q):
+    """
+    Convert an (n,4) array of unit quaternions (w, x, y, z) to an (n,3,3)
+    array of rotation matrices.
+    """
+    w, x, y, z = q[:,0], q[:,1], q[:,2], q[:,3]
+    rot = np.empty((len(q), 3, 3))
+    rot[:,0,0] = 1 - 2*(y*y + z*z)
+    rot[:,0,1] = 2*(x*y - z*w)
+    rot[:,0,2] = 2*(x*z + y*w)
+    rot[:,1,0] = 2*(x*y + z*w)
+    rot[:,1,1] = 1 - 2*(x*x + z*z)
+    rot[:,1,2] = 2*(y*z - x*w)
+    rot[:,2,0] = 2*(x*z - y*w)
+    rot[:,2,1] = 2*(y*z + x*w)
+    rot[:,2,2] = 1 - 2*(x*x + y*y)
+    return rot
+
+def nlerp(q1, q2, t):
+    """
+    Normalized linear interpolation between the (n,4) quaternion arrays q1
+    and q2, along the shortest arc, with t a scalar or an (n,) array.
+    """
+    t = np.asarray(t, dtype=np.float64).reshape(-1, 1)
+    sign = np.where(np.sum(q1*q2, axis=-1) < 0, -1.0, 1.0)[:,None]
+    q = (1-t) * q1 + t * sign * q2
+    return q / np.sqrt(np.sum(q*q, axis=-1))[:,None]
+
+def slerp(q1, q2, t):
+    """
+    Spherical linear interpolation between the (n,4) quaternion arrays q1
+    and q2, along the shortest arc, with t a scalar or an (n,) array.
+    """
+    t = np.asarray(t, dtype=np.float64).reshape(-1)
+    dot = np.sum(q1*q2, axis=-1)
+    sign = np.where(dot < 0, -1.0, 1.0)
+    dot = np.minimum(np.abs(dot), 1.0)
+    angle = np.arccos(dot)
+    sin = np.sin(angle)
+    # Nearly equal rotations are blended linearly
+    linear = sin < 1e-6
+    sin[linear] = 1
+    w1 = np.where(linear, 1-t, np.sin((1-t) * angle) / sin)
+    w2 = np.where(linear, t, np.sin(t * angle) / sin) * sign
+    q = w1[:,None] * q1 + w2[:,None] * q2
+    return q / np.sqrt(np.sum(q*q, axis=-1))[:,None]
+
+def decomposePoses(poseData):
+    """
+    Split an (n,4,4) array of pose matrices in rotations, as (n,4)
+    quaternions, (n,3) translations and (n,3) scales. A reflection is not a
+    rotation, matrices with a negative determinant are logged and get a
+    negative x scale, so that composePoses still returns them.
+    """
+    poseData = np.asarray(poseData, dtype=np.float64)
+    scale = np.sqrt(np.sum(poseData[:,:3,:3]**2, axis=1))
+    scale[scale == 0] = 1
+    rot = poseData[:,:3,:3] / scale[:,None,:]
+    reflected = np.linalg.det(rot) < 0
+    if np.any(reflected):
+        log.warning('%d of %d pose matrices are reflections, kept as a negative x scale',
+                    np.count_nonzero(reflected), len(rot))
+        scale[reflected,0] *= -1
+        rot[reflected,:,0] *= -1
+    return matricesToQuaternions(rot), poseData[:,:3,3].copy(), scale
+
+def composePoses(quats, trans, scale, dtype = np.float32):
+    """
+    Build an (n,4,4) array of pose matrices from rotations, translations and
+    scales, the inverse of decomposePoses.
+    """
+    poseData = np.zeros((len(quats), 4, 4), dtype=dtype)
+    poseData[:,:3,:3] = quaternionsToMatrices(quats) * scale[:,None,:]
+    poseData[:,:3,3] = trans
+    poseData[:,3,3] = 1
+    return poseData
+
+def interpolatePoses(decomposed, idx1, idx2, fraction, interpolationType):
+    """
+    Interpolate between the poses idx1 and idx2 of decomposed pose data, as
+    returned by decomposePoses, with linear (1) or spherical (2)
+    interpolation of the rotations.
+    """
+    quats, trans, scale = decomposed
+    fraction = np.asarray(fraction, dtype=np.float64).reshape(-1)
+    if len(fraction) == 1:
+        fraction = np.repeat(fraction, len(idx1))
+    if interpolationType == 2:
+        q = slerp(quats[idx1], quats[idx2], fraction)
+    else:
+        q = nlerp(quats[idx1], quats[idx2], fraction)
+    f = fraction[:,None]
+    t = (1-f) * trans[idx1] + f * trans[idx2]
+    s = (1-f) * scale[idx1] + f * scale[idx2]
+    return composePoses(q, t, s)
+
 class AnimationTrack(object):
 
     def __init__(self, name, poseData, nFrames, framerate):
@@ -65,10 +212,21 @@ class AnimationTrack(object):
         
         # Type of interpolation between animation frames
         #   0  no interpolation
-        #   1  linear
-        #   2  logarithmic   # TODO!
+        #   1  linear (normalized linear interpolation of rotations)
+        #   2  logarithmic (spherical linear interpolation of rotations)
         self.interpolationType = 0
 
+        # Pose data split in quaternions, translations and scales
+        self._decomposed = None
+
+    def getDecomposed(self):
+        """
+        The pose data as (quaternions, translations, scales), computed once.
+        """
+        if self._decomposed is None:
+            self._decomposed = decomposePoses(self.data)
+        return self._decomposed
+
     def getAtTime(self, time):
         """
         Returns the animation state at the specified time.
@@ -78,17 +236,13 @@ class AnimationTrack(object):
         frameIdx, fraction = self.getFrameIndexAtTime(time)
         if fraction == 0 or self.interpolationType == 0:
             # Discrete animation
-            idx = frameIdx*self.nBones
+            idx = int(frameIdx)*self.nBones
             return self.data[idx:idx+self.nBones]
-        elif self.interpolationType == 1:
-            # Linear interpolation
-            idx1 = frameIdx*self.nBones
-            idx2 = ((frameIdx+1) % self.nFrames) * self.nBones
-            return self.data[idx1:idx1+self.nBones] * (1-fraction) + \
-                   self.data[idx2:idx2+self.nBones] * fraction
-        elif self.interpolationType == 2:
-            # Logarithmic interpolation
-            pass # TODO
+        else:
+            idx1 = int(frameIdx)*self.nBones
+            idx2 = ((int(frameIdx)+1) % self.nFrames) * self.nBones
+            bones = np.arange(self.nBones)
+            return interpolatePoses(self.getDecomposed(), idx1 + bones, idx2 + bones, fraction, self.interpolationType)
 
     def getAtFramePos(self, frame):
         frame = int(frame)
@@ -127,26 +281,46 @@ class AnimationTrack(object):
         """
         return float(self.nFrames)/self.frameRate
 
-    def sparsify(self, newFrameRate):
-        if newFrameRate > self.frameRate:
-            raise RuntimeError("Cannot sparsify animation: new framerate %s is higher than old framerate %s." % (newFrameRate, self.frameRate))
+    def resample(self, newFrameRate, interpolationType = None):
+        """
+        Resample the animation to a new framerate. New frames lie at multiples
+        of 1/newFrameRate seconds and are interpolated from the frames around
+        them with interpolationType (the type of this track if None), or take
+        the frame before them if it is 0.
+        """
+        newFrameRate = float(newFrameRate)
+        if interpolationType is None:
+            interpolationType = self.interpolationType
+
+        # Position of the new frames in the old frames
+        nFrames = int(math.floor((self.nFrames-1) * newFrameRate / self.frameRate + 1e-6)) + 1
+        pos = np.arange(nFrames) * self.frameRate / newFrameRate
+        frames = np.minimum(np.floor(pos + 1e-6).astype(int), self.nFrames-1)
+        fraction = np.maximum(pos - frames, 0)
+
+        bones = np.arange(self.nBones)
+        idx1 = (frames[:,None] * self.nBones + bones[None,:]).ravel()
+        if interpolationType == 0:
+            data = self.data[idx1]
+            if self._decomposed is not None:
+                self._decomposed = tuple(a[idx1] for a in self._decomposed)
+        else:
+            nextFrames = np.minimum(frames + 1, self.nFrames-1)
+            idx2 = (nextFrames[:,None] * self.nBones + bones[None,:]).ravel()
+            fraction = np.repeat(fraction, self.nBones)
+            data = interpolatePoses(self.getDecomposed(), idx1, idx2, fraction, interpolationType).astype(self.data.dtype)
+            self._decomposed = None
 
-        # Number of frames to drop
-        dropFrames = int(float(self.frameRate)/float(newFrameRate))
-        if dropFrames <= 0:
-            return
-        indxs = []
-        count = 0
-        for frameI in range(0,self.dataLen,self.nBones):
-            if count == 0:
-                indxs.extend(range(frameI,frameI+self.nBones))
-            count = (count + 1) % dropFrames
-        data = self.data[indxs]
         self.data = data
         self.frameRate = newFrameRate
         self.dataLen = len(self.data)
         self.nFrames = self.dataLen/self.nBones
 
+    def sparsify(self, newFrameRate):
+        if newFrameRate > self.frameRate:
+            raise RuntimeError("Cannot sparsify animation: new framerate %s is higher than old framerate %s." % (newFrameRate, self.frameRate))
+        self.resample(newFrameRate)
+
 class AnimatedMesh(object):
     """
     Manages skeletal animation for a mesh or multiple meshes.
@@ -248,6 +422,17 @@ class AnimatedMesh(object):
     def getMeshes(self):
         return [mesh.name for mesh in self.__meshes]
 
+    def getRestCoordinates(self, name):
+        """
+        Returns the rest pose coordinates of the mesh with specified name as
+        an array of homogenous (n,4) coordinates, or None if no such mesh is
+        attached.
+        """
+        for idx, mesh in enumerate(self.__meshes):
+            if mesh.name == name:
+                return self.__originalMeshCoords[idx]
+        return None
+
     def update(self, timeDeltaSecs):
         self.__playTime = self.__playTime + timeDeltaSecs
         self._pose()
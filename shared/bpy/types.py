@@ -267,7 +267,7 @@ class Mesh(Rna):
 
         if stuff.meshInfo.shapes:
             self.shape_keys = ShapeKeys()
-            keyblock = KeyBlock("Basis", {}, scale)
+            keyblock = KeyBlock("Basis", (np.zeros(0, np.int32), np.zeros((0,3))), scale)
             self.shape_keys.key_blocks.append(keyblock)
             for (name,shape) in stuff.meshInfo.shapes:
                 keyblock = KeyBlock(name, shape, scale)
@@ -341,10 +341,10 @@ class KeyBlock:
         self.name = name
         self.value = 0.0
         self.data = shape
-        target = list(shape.items())
-        target.sort()                
-        self.indexes = [t[0] for t in target]
-        self.vertices = [scale*t[1] for t in target]
+        verts,deltas = shape
+        order = np.argsort(verts)
+        self.indexes = verts[order].tolist()
+        self.vertices = list(scale*deltas[order])
         
     def __repr__(self):
         return ("<KeyBlock %s>" % self.name)
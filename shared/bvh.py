@@ -35,6 +35,84 @@ import numpy.linalg as la
 from math import pi
 D = pi/180
 
+def _axesTuple(axes):
+    try:
+        firstaxis, parity, repetition, frame = tm._AXES2TUPLE[axes.lower()]
+    except (AttributeError, KeyError):
+        tm._TUPLE2AXES[axes]  # validation
+        firstaxis, parity, repetition, frame = axes
+    i = firstaxis
+    j = tm._NEXT_AXIS[i+parity]
+    k = tm._NEXT_AXIS[i-parity+1]
+    return i, j, k, parity, repetition, frame
+
+def eulerToMatrices(ai, aj, ak, axes='sxyz'):
+    """
+    Vectorized version of transformations.euler_matrix: convert arrays of
+    Euler angles (in radians) to an (n,3,3) array of rotation matrices.
+    """
+    i, j, k, parity, repetition, frame = _axesTuple(axes)
+    ai = np.asarray(ai, dtype=np.float64)
+    aj = np.asarray(aj, dtype=np.float64)
+    ak = np.asarray(ak, dtype=np.float64)
+    if frame:
+        ai, ak = ak, ai
+    if parity:
+        ai, aj, ak = -ai, -aj, -ak
+
+    si, sj, sk = np.sin(ai), np.sin(aj), np.sin(ak)
+    ci, cj, ck = np.cos(ai), np.cos(aj), np.cos(ak)
+    cc, cs = ci*ck, ci*sk
+    sc, ss = si*ck, si*sk
+
+    M = np.empty((len(ai), 3, 3))
+    if repetition:
+        M[:, i, i] = cj
+        M[:, i, j] = sj*si
+        M[:, i, k] = sj*ci
+        M[:, j, i] = sj*sk
+        M[:, j, j] = -cj*ss+cc
+        M[:, j, k] = -cj*cs-sc
+        M[:, k, i] = -sj*ck
+        M[:, k, j] = cj*sc+cs
+        M[:, k, k] = cj*cc-ss
+    else:
+        M[:, i, i] = cj*ck
+        M[:, i, j] = sj*sc-cs
+        M[:, i, k] = sj*cc+ss
+        M[:, j, i] = cj*sk
+        M[:, j, j] = sj*ss+cc
+        M[:, j, k] = sj*cs-sc
+        M[:, k, i] = -sj
+        M[:, k, j] = cj*si
+        M[:, k, k] = cj*ci
+    return M
+
+def matricesToEuler(rot, axes='sxyz'):
+    """
+    Vectorized version of transformations.euler_from_matrix: decompose an
+    (n,3,3) (or (n,4,4)) array of rotation matrices in arrays of Euler
+    angles (ax, ay, az), in radians.
+    """
+    i, j, k, parity, repetition, frame = _axesTuple(axes)
+    M = np.asarray(rot, dtype=np.float64)[:, :3, :3]
+    if repetition:
+        sy = np.sqrt(M[:,i,j]*M[:,i,j] + M[:,i,k]*M[:,i,k])
+        ay = np.arctan2(sy, M[:,i,i])
+        ax = np.where(sy > tm._EPS, np.arctan2(M[:,i,j], M[:,i,k]), np.arctan2(-M[:,j,k], M[:,j,j]))
+        az = np.where(sy > tm._EPS, np.arctan2(M[:,j,i], -M[:,k,i]), 0.0)
+    else:
+        cy = np.sqrt(M[:,i,i]*M[:,i,i] + M[:,j,i]*M[:,j,i])
+        ay = np.arctan2(-M[:,k,i], cy)
+        ax = np.where(cy > tm._EPS, np.arctan2(M[:,k,j], M[:,k,k]), np.arctan2(-M[:,j,k], M[:,j,j]))
+        az = np.where(cy > tm._EPS, np.arctan2(M[:,j,i], M[:,i,i]), 0.0)
+
+    if parity:
+        ax, ay, az = -ax, -ay, -az
+    if frame:
+        ax, az = az, ax
+    return ax, ay, az
+
 class BVH():
     """
     A BVH skeleton. We assume a single root joint.
@@ -128,56 +206,29 @@ class BVH():
         """
         Create an animation track from the motion stored in this BHV file.
         """
-        if jointsOrder == None:
+        if jointsOrder is None:
             jointsData = [joint.matrixPoses for joint in self.getJoints() if not joint.isEndConnector()]
             # We leave out end effectors as they should not have animation data
+
+            nJoints = len(jointsData)
+            nFrames = len(jointsData[0])
+
+            # Interweave joints animation data, per frame with joints in breadth-first order
+            animData = np.hstack(jointsData).reshape(nJoints*nFrames,4,4)
         else:
+            # Joint mappings can contain a rotation compensation, they are
+            # applied to all frames and joints at once
+            if not isinstance(jointsOrder, skeleton.RetargetMapping):
+                jointsOrder = skeleton.RetargetMapping(jointsOrder)
             nFrames = self.frameCount
-            import re
-            # Remove the tail from duplicate bone names
-            for idx,jName in enumerate(jointsOrder):
-                # Joint mappings can contain a rotation compensation
-                if isinstance(jName, tuple):
-                    jName, _ = jName
-                if not jName:
-                    continue
-                r = re.search("(.*)_\d+$",jName)
-                if r:
-                    jointsOrder[idx] = r.group(1)
-
-            jointsData = []
-            for jointName in jointsOrder:
-                if isinstance(jointName, tuple):
-                    jointName, angle = jointName
-                else:
-                    angle = 0.0
+            jointsData = np.empty((nFrames, len(jointsOrder.jointNames), 4, 4), dtype=np.float32)
+            for bIdx, jointName in enumerate(jointsOrder.jointNames):
                 if jointName:
-                    poseMats = self.getJointByCanonicalName(jointName).matrixPoses.copy()
-                    if isinstance(angle, float):
-                        if angle != 0.0:
-                            # Rotate around global Z axis
-                            rot = tm.rotation_matrix(-angle*D, [0,0,1])
-                            # Roll around global Y axis (this is a limitation)
-                            roll = tm.rotation_matrix(angle*D, [0,1,0])
-                            for i in xrange(nFrames):
-                                # TODO make into numpy loop
-                                poseMats[i] = np.dot(poseMats[i], rot)
-                                poseMats[i] = np.dot(poseMats[i], roll)
-                    else:
-                        for i in xrange(nFrames):
-                            # TODO make into numpy loop
-                            #poseMats[i] = np.dot(np.dot(angle, poseMats[i]), angle.transpose())
-                            #poseMats[i] = np.dot(angle, poseMats[i])
-                            poseMats[i] = np.dot(angle, np.dot(poseMats[i], la.inv(angle)))
-                    jointsData.append(poseMats)
+                    jointsData[:,bIdx] = self.getJointByCanonicalName(jointName).matrixPoses
                 else:
-                    jointsData.append(animation.emptyTrack(nFrames))
-
-        nJoints = len(jointsData)
-        nFrames = len(jointsData[0])
+                    jointsData[:,bIdx] = np.identity(4, dtype=np.float32)
+            animData = jointsOrder.retarget(jointsData).astype(np.float32).reshape(-1,4,4)
 
-        # Interweave joints animation data, per frame with joints in breadth-first order
-        animData = np.hstack(jointsData).reshape(nJoints*nFrames,4,4)
         framerate = 1.0/self.frameTime
 
         '''
@@ -232,11 +283,14 @@ class BVH():
         """
         return self.bvhJoints
 
-    def fromFile(self, filepath):
+    def fromFile(self, filepath, channelData = None):
         """
         Parse a BVH skeletal animation file.
         Loads both the skeleton hierarchy and the animation track from the 
         specified BVH file.
+        If channelData (as returned by getChannelData) is given, only the
+        hierarchy is read from the file and the motion is taken from
+        channelData instead.
         """
         fp = open(filepath, "rU")
 
@@ -255,12 +309,30 @@ class BVH():
         words = self.__expectKeyword('Frame', fp) # Time:
         self.frameTime = float(words[2])
 
-        for i in range(self.frameCount):
-            line = fp.readline()
-            words = line.split()
-            data = [float(word) for word in words]
-            for joint in self.getJointsBVHOrder():
-                data = self.__processChannelData(joint, data)
+        nChannels = sum([len(joint.channels) for joint in self.getJointsBVHOrder()])
+        if channelData is None:
+            # Parse all frames at once
+            data = np.asarray(fp.read().split()[:self.frameCount*nChannels], dtype=np.float32)
+            if len(data) < self.frameCount*nChannels:
+                raise RuntimeError('Expected %s frames of %s channels in %s' % (self.frameCount, nChannels, filepath))
+            channelData = data.reshape(self.frameCount, nChannels)
+        fp.close()
+
+        self.setChannelData(channelData)
+
+    def setChannelData(self, channelData):
+        """
+        Distribute animation channel data, an np.array((frameCount, nChannels))
+        with the channels in the order in which they are stored in a BVH file,
+        among the joints of the skeleton structure and calculate their pose
+        matrices.
+        """
+        self.frameCount = len(channelData)
+        offset = 0
+        for joint in self.getJointsBVHOrder():
+            nChannels = len(joint.channels)
+            joint.frames = np.array(channelData[:,offset:offset+nChannels], dtype=np.float32).ravel()
+            offset += nChannels
 
         self.__cacheGetJoints()
 
@@ -300,21 +372,21 @@ class BVH():
             self.frameCount = animationTrack.nFrames
             self.frameTime = 1.0/animationTrack.frameRate
 
-            jointToBoneIdx = {}
-            for joint in nonEndJoints:
-                jointToBoneIdx[joint.name] = skel.getBone(joint.name).index
-
-            for fIdx in xrange(animationTrack.nFrames):
-                offset = fIdx * animationTrack.nBones
-                for jIdx,joint in enumerate(nonEndJoints):
-                    bIdx = jointToBoneIdx[joint.name]
-                    poseMat = animationTrack.data[offset + bIdx]
-                    if len(joint.channels) == 6:
-                        # Add transformation
-                        tx, ty, tz = poseMat[:3,3]
-                        joint.frames.extend([tx, ty, tz])
-                    ay,ax,az = tm.euler_from_matrix(poseMat, "syxz")
-                    joint.frames.extend([az/D, ax/D, ay/D])
+            # Decompose the pose matrices of all frames and joints at once
+            nFrames = animationTrack.nFrames
+            poseData = np.asarray(animationTrack.data[:nFrames*animationTrack.nBones])
+            poseData = poseData.reshape(nFrames, animationTrack.nBones, 4, 4)
+            boneIdxs = [skel.getBone(joint.name).index for joint in nonEndJoints]
+            poses = poseData[:, boneIdxs]
+            ay, ax, az = matricesToEuler(poses.reshape(-1, 4, 4), "syxz")
+            angles = np.column_stack([az, ax, ay]).reshape(nFrames, len(nonEndJoints), 3) / D
+
+            for jIdx,joint in enumerate(nonEndJoints):
+                if len(joint.channels) == 6:
+                    # Add transformation
+                    joint.frames = np.hstack([poses[:,jIdx,:3,3], angles[:,jIdx]]).ravel()
+                else:
+                    joint.frames = angles[:,jIdx].ravel()
         else:
             # Add bogus animation with one frame
             self.frameCount = 1
@@ -344,21 +416,25 @@ class BVH():
         f.write('Frames: %s\n' % self.frameCount)
         f.write('Frame Time: %f\n' % self.frameTime)
 
-        allJoints = [joint for joint in self.getJointsBVHOrder() if not joint.isEndConnector()]
-        jointsData = [joint.matrixPoses for joint in allJoints]
-        nJoints = len(jointsData)
-        nFrames = len(jointsData[0])
-        totalChannels = sum([len(joint.channels) for joint in allJoints])
-
-        for fIdx in xrange(self.frameCount):
-            frameData = []
-            for joint in allJoints:
-                offset = fIdx * len(joint.channels)
-                frameData.extend(joint.frames[offset:offset + len(joint.channels)])
-            frameData = [str(fl) for fl in frameData]
-            f.write('%s\n' % " ".join(frameData))
+        channels = self.getChannelData()
+        if channels.size:
+            rowFmt = " ".join(["%f"] * channels.shape[1]) + "\n"
+            f.write((rowFmt * len(channels)) % tuple(channels.ravel().tolist()))
         f.close()
 
+    def getChannelData(self):
+        """
+        The animation channel data of all joints as one
+        np.array((frameCount, nChannels)), with the channels in the order in
+        which they are stored in a BVH file.
+        """
+        allJoints = [joint for joint in self.getJointsBVHOrder() if not joint.isEndConnector()]
+        data = [np.asarray(joint.frames)[:self.frameCount*len(joint.channels)].reshape(self.frameCount, len(joint.channels))
+                for joint in allJoints]
+        if not data:
+            return np.zeros((self.frameCount, 0), dtype=np.float32)
+        return np.hstack(data)
+
     def _writeJoint(self, f, joint, ident):
         if joint.name == "End effector":
             offset = joint.offset
@@ -433,17 +509,6 @@ class BVH():
             else:
                 raise RuntimeError('Expected %s found %s' % ('JOINT, End Site or }', words[0]))
 
-    def __processChannelData(self, joint, data):
-        """
-        Distribute animation channel data for one frame or motion sample, 
-        loaded from a BVH file, among the joints of the skeleton structure.
-        """
-        nChannels = len(joint.channels)
-        joint.frames.extend(data[:nChannels])
-        data = data[nChannels:]
-
-        return data
-
     def __calcPosition(self, joint, offset):
         """
         Calculate this joint's position using offset (from parent) defined in
@@ -578,24 +643,16 @@ class BVHJoint():
             # TODO allow partial rotation channels too?
             pass
         elif len(rotAngles) >= 3:
-            for frameIdx in range(nFrames):
-                self.matrixPoses[frameIdx,:3,:3] = tm.euler_matrix(rotAngles[2][frameIdx], rotAngles[1][frameIdx], rotAngles[0][frameIdx], axes=rotOrder)[:3,:3]
-
-            # TODO eliminate loop with numpy?
-            '''
-            for rotAngle in rotAngles:  
-                self.matrixPoses[:] = tm.euler_matrix(rotAngle[2], rotAngle[1], rotAngle[0], axes=rotOrder))
-            # unfortunately tm.euler_matrix is not a np ufunc
-            '''
+            self.matrixPoses[:,:3,:3] = eulerToMatrices(rotAngles[2], rotAngles[1], rotAngles[0], rotOrder)
 
         # Add translations to pose matrices
         # Allow partial transformation channels too
-        if rXs != None or rYs != None or rZs != None:
-            if rXs == None:
+        if rXs is not None or rYs is not None or rZs is not None:
+            if rXs is None:
                 rXs = np.zeros(nFrames, dtype=np.float32)
-            if rYs == None:
+            if rYs is None:
                 rYs = np.zeros(nFrames, dtype=np.float32)
-            if rZs == None:
+            if rZs is None:
                 rZs = np.zeros(nFrames, dtype=np.float32)
 
             self.matrixPoses[:,:3,3] = np.column_stack([rXs,rYs,rZs])[:,:]
@@ -619,10 +676,10 @@ class BVHJoint():
     def isEndConnector(self):
         return not self.hasChildren()
 
-def load(filename, convertFromZUp = False):
+def load(filename, convertFromZUp = False, channelData = None):
     result = BVH()
     result.convertFromZUp = convertFromZUp
-    result.fromFile(filename)
+    result.fromFile(filename, channelData)
     return result
 
 def createFromSkeleton(skel, animationTrack = None):
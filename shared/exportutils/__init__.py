@@ -25,7 +25,10 @@ Export utilities available to all exporters.
 from . import collect
 from . import config
 from . import custom
+from . import formatting
 from . import rig
+from . import session
+from . import sequence
 from . import shapekeys
 from . import uvset
 
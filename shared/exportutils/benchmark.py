@@ -0,0 +1,595 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Benchmark of the exporters.
+
+A set of reference characters is loaded into the human, one after the other,
+and exported with every exporter plugin into a temporary folder. For every
+export the wall time, the peak resident memory and the size of the written
+files are recorded, in total and for the stages of the export:
+
+- setupObjects: collecting the meshes, everything before writing
+- proxyFitting: fitting proxies and clothes to the human
+- filterMesh: removing hidden and deleted vertices
+- subdivision: subdividing the meshes
+- shapekeys: reading the targets for shape keys
+- writing: the rest, the time not spent in setupObjects or shapekeys
+
+Stages are timed inclusively, proxyFitting, filterMesh and subdivision are
+part of setupObjects. The results can be saved as JSON and compared against
+the results of an earlier run:
+
+    from exportutils import benchmark
+    results = benchmark.runBenchmark(gui3d.app)
+    benchmark.saveResults('export.json', results)
+    benchmark.compareResults(results, benchmark.loadResults('baseline.json'))
+
+runBenchmark uses the running application, its load handlers and the
+exporters of the export task, but no user interaction; it can be run from the
+scripting or shell tab. The human is restored when it has finished.
+
+runHeadlessBenchmark does the same without the application, for machines
+without a display. It builds its own human from the base mesh, applies the
+characters as parsed by population.parseMhm and calls the writers of the
+exporter plugins with plain Config objects:
+
+    python exportbenchmark.py results.json --baseline baseline.json
+
+Without the modifier tasks of the application only the macro modifiers,
+details and microdetails of the characters are applied, other modifier lines
+are skipped with a warning. Proxies, clothes and skeletons are loaded as
+their libraries do.
+"""
+
+import os
+import imp
+import sys
+import time
+import json
+import types
+import shutil
+import tempfile
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is not recorded there
+    resource = None
+
+import mh
+import log
+import gui3d
+import files3d
+import mh2proxy
+import skeleton
+import animation
+import humanmodifier
+import population
+import catmull_clark_subdivision as cks
+
+from . import collect
+from . import config
+
+ResultsVersion = 1
+
+# Instrumented stages, as (stage, module, function)
+Stages = [
+    ('setupObjects', collect, '_setupObjects'),
+    ('proxyFitting', collect, 'setupProxies'),
+    ('filterMesh', collect, 'filterMesh'),
+    ('subdivision', cks, 'createSubdivisionObject'),
+    ('shapekeys', collect, 'readTargets'),
+    ]
+
+# Relative increase of time, memory or output size reported as a regression
+Tolerance = 0.2
+
+# Exports shorter than this are too noisy to compare their time
+MinTime = 0.05
+
+# Nor are memory increases of less than this many MB
+MinRss = 10.0
+
+def getPeakRss():
+    """
+    The peak resident memory of the process so far, in MB, None if it is not
+    known on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes on Mac OS X, kilobytes elsewhere
+        return peak / 1048576.0
+    return peak / 1024.0
+
+def getFolderSize(folder):
+    """
+    The total size in bytes and the number of the files below folder.
+    """
+    size = 0
+    count = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+            count += 1
+    return size, count
+
+class StageTimer(object):
+    """
+    While active, times the calls to the functions of the stages by
+    replacing them in their modules.
+
+    - **self.times**: *dict* The seconds spent in each stage.
+    - **self.calls**: *dict* The number of calls of each stage.
+    - **self.peakRss**: *dict* The peak memory in MB at the end of the last
+      call of each stage.
+    """
+
+    def __init__(self, stages = Stages):
+        self.stages = stages
+        self.times = {}
+        self.calls = {}
+        self.peakRss = {}
+        self._originals = []
+
+    def _wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            t = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.times[stage] = self.times.get(stage, 0.0) + time.time() - t
+                self.calls[stage] = self.calls.get(stage, 0) + 1
+                self.peakRss[stage] = getPeakRss()
+        return timed
+
+    def __enter__(self):
+        for stage, module, name in self.stages:
+            function = getattr(module, name)
+            self._originals.append((module, name, function))
+            setattr(module, name, self._wrap(stage, function))
+        return self
+
+    def __exit__(self, type, value, traceback):
+        for module, name, function in reversed(self._originals):
+            setattr(module, name, function)
+        self._originals = []
+
+    def getStages(self):
+        return dict((stage, dict(time = self.times[stage], calls = self.calls[stage], peakRss = self.peakRss[stage]))
+                    for stage in self.times)
+
+def timeExport(export, folder):
+    """
+    Run export(), which writes its files into folder, and measure it.
+    Returns a dict with the total time, peak memory, output size and files
+    and the stages.
+    """
+    rss = getPeakRss()
+    with StageTimer() as timer:
+        t = time.time()
+        export()
+        total = time.time() - t
+
+    stages = timer.getStages()
+    writing = total - sum(timer.times.get(stage, 0.0) for stage in ('setupObjects', 'shapekeys'))
+    stages['writing'] = dict(time = max(writing, 0.0), calls = 1, peakRss = getPeakRss())
+    size, files = getFolderSize(folder)
+    peakRss = getPeakRss()
+    return dict(time = total, peakRss = peakRss,
+                peakRssIncrease = peakRss - rss if peakRss is not None else None,
+                outputSize = size, files = files, stages = stages)
+
+class ReferenceCharacter(object):
+    """
+    A character of the benchmark.
+
+    - **self.name**: *string* The name of the character in the results.
+    - **self.lines**: *list of string* The lines of a .mhm file, loaded into
+      the human.
+    - **self.subdivide**: *bool* Whether the human is subdivided.
+    - **self.options**: *dict* Options of the exporters set for this
+      character, by the name of their checkbox on the exporter, such as
+      expressions. Exporters without the checkbox ignore it. Without the
+      application they are set on the Config of every exporter.
+    """
+
+    def __init__(self, name, lines = (), subdivide = False, options = None):
+        self.name = name
+        self.lines = list(lines)
+        self.subdivide = subdivide
+        self.options = options or {}
+
+    def _withFile(self, function):
+        # Call function with the name of a temporary .mhm file of this character
+        fd, filename = tempfile.mkstemp('.mhm', 'benchmark_')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('version 1.0.0\n')
+                for line in self.lines:
+                    f.write(line + '\n')
+            return function(filename)
+        finally:
+            os.remove(filename)
+
+    def apply(self, human):
+        self._withFile(lambda filename: human.load(filename, True))
+        if human.isSubdivided() != self.subdivide:
+            human.setSubdivided(self.subdivide)
+
+    def parse(self):
+        """
+        The values and choices of this character, as returned by
+        population.parseMhm.
+        """
+        return self._withFile(population.parseMhm)
+
+ReferenceCharacters = [
+    ReferenceCharacter('base'),
+    ReferenceCharacter('proxy', ['proxy data/proxymeshes/male/male.proxy']),
+    ReferenceCharacter('clothes', ['clothes data/clothes/tshirt/tshirt_longsleeves_medium.mhclo',
+                                   'clothes data/clothes/jeans/jeans_medium.mhclo']),
+    ReferenceCharacter('subdivided', subdivide = True),
+    ReferenceCharacter('rigged', ['skeleton soft1.rig'], options = dict(expressions = True)),
+    ]
+
+def getExporters(app):
+    """
+    The exporters of the export task, in the order of the export task.
+    """
+    taskview = app.getCategory('Files').getTaskByName('Export')
+    return [exporter for exporter, _, _ in taskview.formats]
+
+def _setOptions(exporter, options):
+    # Returns the previous state of the options that were set
+    previous = {}
+    for name, value in options.items():
+        widget = getattr(exporter, name, None)
+        if widget is not None and hasattr(widget, 'setSelected'):
+            previous[name] = widget.selected
+            widget.setSelected(value)
+    return previous
+
+def _measure(characterName, exporterName, folder, repeat, export):
+    # Export repeat times with export(filename), where filename is the
+    # function building file names passed to Exporter.export, and return the
+    # fastest result or the first error
+    best = None
+    for i in xrange(repeat):
+        output = os.path.join(folder, characterName)
+        os.makedirs(output)
+        filename = lambda ext, *args: os.path.join(output, '%s.%s' % (characterName, ext))
+        try:
+            result = timeExport(lambda: export(filename), output)
+        except Exception as e:
+            log.error('Benchmark: export of %s to %s failed', characterName, exporterName, exc_info=True)
+            result = dict(error = str(e))
+        finally:
+            shutil.rmtree(output, True)
+        if 'error' in result or best is None or result['time'] < best['time']:
+            best = result
+        if 'error' in result:
+            break
+
+    if 'error' not in best:
+        log.message('Benchmark: %s %s %.3f s, %d bytes', characterName, exporterName,
+                    best['time'], best['outputSize'])
+    return best
+
+def runBenchmark(app, characters = None, exporters = None, repeat = 1):
+    """
+    Export every reference character with every exporter and measure the
+    exports. characters is a list of ReferenceCharacter, all of
+    ReferenceCharacters if None; exporters a list of exporter names, all
+    exporters if None. Each export is done repeat times, the fastest is kept.
+    Returns the results, by character and exporter name, as returned by
+    timeExport. Failing exports are logged and recorded with their error.
+    """
+    human = app.selectedHuman
+    if characters is None:
+        characters = ReferenceCharacters
+    selected = [exporter for exporter in getExporters(app)
+                if exporters is None or exporter.name in exporters]
+
+    # Keep the human of the user
+    fd, saved = tempfile.mkstemp('.mhm', 'benchmark_')
+    os.close(fd)
+    human.save(saved, 'benchmark')
+    subdivided = human.isSubdivided()
+    folder = tempfile.mkdtemp(prefix = 'benchmark_')
+
+    results = dict(version = ResultsVersion, platform = sys.platform, characters = {})
+    try:
+        for character in characters:
+            t = time.time()
+            character.apply(human)
+            log.message('Benchmark: loaded %s in %.3f s', character.name, time.time() - t)
+            exports = results['characters'][character.name] = {}
+
+            for exporter in selected:
+                previous = _setOptions(exporter, character.options)
+                try:
+                    exports[exporter.name] = _measure(character.name, exporter.name, folder, repeat,
+                        lambda filename: exporter.export(human, filename))
+                finally:
+                    _setOptions(exporter, previous)
+    finally:
+        shutil.rmtree(folder, True)
+        human.load(saved, True)
+        human.setSubdivided(subdivided)
+        os.remove(saved)
+
+    return results
+
+# The exporters that run without the application, by the names of their
+# exporters in the export task, as (name, plugin, module, function, extension,
+# options). The options are set on a plain Config, in place of the option
+# widgets of the exporter.
+HeadlessExporters = [
+    ('Wavefront obj', '9_export_obj', 'mh2obj', 'exportObj', 'obj', {}),
+    ('Collada (dae)', '9_export_collada', 'mh2collada', 'exportCollada', 'dae',
+     dict(rigtype = 'soft1', rotate90X = False, rotate90Z = False)),
+    ('Filmbox (fbx)', '9_export_fbx', 'mh2fbx', 'exportFbx', 'fbx', dict(rigtype = 'soft1', useRelPaths = False)),
+    ('glTF binary (glb)', '9_export_gltf', 'mh2gltf', 'exportGlb', 'glb', dict(animations = False)),
+    ('MD5', '9_export_md5', 'mh2md5', 'exportMd5', 'md5mesh', dict(encoding = 'ascii')),
+    ('Ogre3D', '9_export_ogre', 'mh2ogre', 'exportOgreMesh', 'mesh.xml', {}),
+    ('Stereolithography (stl)', '9_export_stl', 'mh2stl', 'exportStlAscii', 'stl', {}),
+    ]
+
+# The macro modifiers of the macro modelling task, as (base, name, variable)
+MacroModifiers = [
+    ('macrodetails', None, 'Gender'),
+    ('macrodetails', None, 'Age'),
+    ('macrodetails', 'universal', 'Muscle'),
+    ('macrodetails', 'universal', 'Weight'),
+    ('macrodetails', 'universal-stature', 'Height'),
+    ('macrodetails', None, 'African'),
+    ('macrodetails', None, 'Asian'),
+    ('macrodetails', None, 'Caucasian'),
+    ]
+
+class HeadlessApp(object):
+    """
+    Stands in for the application while exporting without it, the exporters
+    only report their progress to it.
+    """
+
+    def __init__(self, human):
+        self.selectedHuman = human
+
+    def progress(self, *args, **kwargs):
+        pass
+
+def _getSkeleton(human):
+    return human._skeleton
+
+def _getVertexWeights(human):
+    if not human.animated:
+        return None
+    _, bodyWeights = human.animated.getMesh("base.obj")
+    return bodyWeights
+
+def createHuman():
+    """
+    A human of the base mesh, created without the application. It has the
+    skeleton accessors that the skeleton library attaches to the human of the
+    application.
+    """
+    import human
+    result = human.Human(files3d.loadMesh(os.path.join('data', '3dobjs', 'base.obj')))
+    result._skeleton = None
+    result.animated = None
+    result.getSkeleton = types.MethodType(_getSkeleton, result, result.__class__)
+    result.getVertexWeights = types.MethodType(_getVertexWeights, result, result.__class__)
+    return result
+
+def _findRig(filename):
+    for folder in (os.path.join(mh.getPath(''), 'data', 'rigs'), os.path.join('data', 'rigs')):
+        path = os.path.join(folder, filename)
+        if os.path.isfile(path):
+            return path
+    return None
+
+def _addClothes(human, filepath):
+    proxy = mh2proxy.readProxyFile(human.meshData, filepath)
+    if not proxy:
+        return
+    proxy.type = 'Clothes'
+    folder, name = proxy.obj_file
+    mesh = files3d.loadMesh(os.path.join(folder, name))
+    if proxy.texture:
+        mesh.setTexture(os.path.join(folder, proxy.texture[1]))
+    uuid = proxy.getUuid()
+    human.clothesObjs[uuid] = gui3d.Object(human.getPosition(), mesh)
+    human.clothesProxies[uuid] = proxy
+
+def loadCharacter(human, values, choices, subdivide = False):
+    """
+    Apply a character, as parsed by population.parseMhm, to a human created
+    by createHuman.
+    """
+    human.setProxy(None)
+    human.clothesObjs = {}
+    human.clothesProxies = {}
+    human._skeleton = None
+    human.animated = None
+    human.resetMeshValues()
+
+    macros = dict((variable, humanmodifier.MacroModifier(base, name, variable))
+                  for base, name, variable in MacroModifiers)
+    for column, value in sorted(values.items()):
+        if '/' in column:
+            keyword, name = column.split('/', 1)
+        else:
+            keyword, name = 'macro', column
+        if keyword == 'macro' and name in macros:
+            macros[name].setValue(human, value)
+        elif keyword in ('detail', 'microdetail'):
+            human.setDetail('data/targets/%ss/%s.target' % (keyword, name), value)
+        else:
+            log.warning('Benchmark: %s is not applied without the application', column)
+    human.syncRace()
+    for modifier in macros.values():
+        modifier.setValue(human, modifier.getValue(human))
+    human.applyAllTargets()
+
+    for line in choices.get('proxy', []):
+        proxy = mh2proxy.readProxyFile(human.getSeedMesh(), line.split()[0])
+        proxy.type = 'Proxy'
+        human.setProxy(proxy)
+        human.updateProxyMesh()
+
+    for line in choices.get('clothes', []):
+        words = line.split()
+        filepath = config.getExistingProxyFile(words[0], words[1] if len(words) > 1 else None, 'clothes')
+        if filepath:
+            _addClothes(human, filepath)
+        else:
+            log.warning('Benchmark: clothes %s not found', words[0])
+
+    for line in choices.get('skeleton', []):
+        filepath = _findRig(line.split()[0])
+        if filepath:
+            skel, boneWeights = skeleton.loadRig(filepath, human.meshData)
+            skel.file = filepath
+            human._skeleton = skel
+            human.animated = animation.AnimatedMesh(skel, human.meshData, boneWeights)
+        else:
+            log.warning('Benchmark: rig %s not found', line)
+
+    for keyword in choices:
+        if keyword not in ('proxy', 'clothes', 'skeleton'):
+            log.warning('Benchmark: %s is not applied without the application', keyword)
+
+    human.setSubdivided(subdivide)
+
+def _loadPlugin(plugin):
+    # Import the package of a plugin as the application does
+    if plugin not in sys.modules:
+        fp, pathname, description = imp.find_module(plugin, ['plugins/'])
+        try:
+            imp.load_module(plugin, fp, pathname, description)
+        finally:
+            if fp:
+                fp.close()
+    return sys.modules[plugin]
+
+def _exportHeadless(exporter, human, filename, options):
+    name, plugin, module, function, extension, defaults = exporter
+    _loadPlugin(plugin)
+    writer = getattr(__import__('%s.%s' % (plugin, module), fromlist = [function]), function)
+    cfg = config.Config()
+    for key, value in defaults.items() + options.items():
+        setattr(cfg, key, value)
+    if 'rigtype' in defaults and human.getSkeleton():
+        cfg.rigtype = human.getSkeleton().name
+    writer(human, filename(extension), cfg)
+
+def runHeadlessBenchmark(characters = None, exporters = None, repeat = 1):
+    """
+    runBenchmark without the application: the characters are loaded into a
+    human of createHuman by loadCharacter, and exported with the exporters of
+    HeadlessExporters, selected by name as in runBenchmark. Exporters that
+    need the application, such as mhx, are not part of it.
+    """
+    if characters is None:
+        characters = ReferenceCharacters
+    selected = [exporter for exporter in HeadlessExporters
+                if exporters is None or exporter[0] in exporters]
+
+    human = createHuman()
+    previousApp = gui3d.app
+    gui3d.app = HeadlessApp(human)
+    folder = tempfile.mkdtemp(prefix = 'benchmark_')
+
+    results = dict(version = ResultsVersion, platform = sys.platform, characters = {})
+    try:
+        for character in characters:
+            t = time.time()
+            values, choices = character.parse()
+            loadCharacter(human, values, choices, character.subdivide)
+            log.message('Benchmark: loaded %s in %.3f s', character.name, time.time() - t)
+            exports = results['characters'][character.name] = {}
+
+            for exporter in selected:
+                exports[exporter[0]] = _measure(character.name, exporter[0], folder, repeat,
+                    lambda filename: _exportHeadless(exporter, human, filename, character.options))
+    finally:
+        shutil.rmtree(folder, True)
+        gui3d.app = previousApp
+
+    return results
+
+def saveResults(filename, results):
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent = 1, sort_keys = True)
+
+def loadResults(filename):
+    with open(filename, 'r') as f:
+        results = json.load(f)
+    if results.get('version') != ResultsVersion:
+        raise RuntimeError('%s is not a benchmark result of version %d' % (filename, ResultsVersion))
+    return results
+
+def _regression(key, value, base, tolerance, minimum = 0):
+    if value is None or base is None or max(value, base) < minimum:
+        return None
+    if value > base * (1 + tolerance):
+        return (key, base, value)
+    return None
+
+def compareResults(results, baseline, tolerance = Tolerance):
+    """
+    Compare results against the baseline results of an earlier run. Returns
+    the regressions as a list of (character, exporter, measure, baseline
+    value, value), where measure is time, peakRssIncrease, outputSize or
+    the name of a stage, for every value that grew by more than tolerance.
+    Exports that failed now but not in the baseline are regressions too, with
+    measure error.
+    """
+    regressions = []
+    for character, exports in sorted(results['characters'].items()):
+        baseExports = baseline['characters'].get(character, {})
+        for exporter, result in sorted(exports.items()):
+            base = baseExports.get(exporter)
+            if base is None:
+                continue
+            if 'error' in result:
+                if 'error' not in base:
+                    regressions.append((character, exporter, 'error', None, result['error']))
+                continue
+            if 'error' in base:
+                continue
+
+            found = [_regression('time', result['time'], base['time'], tolerance, MinTime),
+                     _regression('peakRssIncrease', result['peakRssIncrease'], base['peakRssIncrease'], tolerance, MinRss),
+                     _regression('outputSize', result['outputSize'], base['outputSize'], tolerance)]
+            for stage, times in sorted(result['stages'].items()):
+                if stage in base['stages']:
+                    found.append(_regression(stage, times['time'], base['stages'][stage]['time'], tolerance, MinTime))
+
+            for regression in found:
+                if regression:
+                    key, old, new = regression
+                    log.warning('Benchmark: %s %s %s went from %s to %s', character, exporter, key, old, new)
+                    regressions.append((character, exporter, key, old, new))
+    return regressions
@@ -31,6 +31,7 @@ import os
 import time
 import numpy
 import shutil
+import threading
 
 import export
 import mh2proxy
@@ -138,7 +139,27 @@ def readTargets(human, config):
 #   setupObjects
 #
 
+# The active export session, see session.ExportSession
+_session = None
+
+def getSession():
+    return _session
+
+def setSession(session):
+    global _session
+    _session = session
+
 def setupObjects(name, human, config=None, rigfile=None, rawTargets=[], helpers=False, hidden=False, eyebrows=True, lashes=True, subdivide = False, progressCallback=None):
+    if not config:
+        config = Config()
+        config.setHuman(human)
+
+    if _session is not None:
+        # Exporters running in a session share the collected objects
+        return _session.setupObjects(name, human, config, rigfile, rawTargets, helpers, hidden, eyebrows, lashes, subdivide, progressCallback)
+    return _setupObjects(name, human, config, rigfile, rawTargets, helpers, hidden, eyebrows, lashes, subdivide, progressCallback)
+
+def _setupObjects(name, human, config, rigfile, rawTargets, helpers, hidden, eyebrows, lashes, subdivide, progressCallback):
     global theStuff, theTextures, theTexFiles, theMaterials
 
     def progress(prog):
@@ -147,10 +168,6 @@ def setupObjects(name, human, config=None, rigfile=None, rawTargets=[], helpers=
         else:
             progressCallback (prog)
 
-    if not config:
-        config = Config()
-        config.setHuman(human)
-        
     obj = human.meshData
     theTextures = {}
     theTexFiles = {}
@@ -201,7 +218,12 @@ def setupObjects(name, human, config=None, rigfile=None, rawTargets=[], helpers=
 
     # Apply subtextures.
     stuffs[0].textureImage = mh.Image(os.path.join(stuffs[0].texture[0], stuffs[0].texture[1]))
-    mhstx = mh.G.app.getCategory('Textures').getTaskByName('Texture').eyeTexture
+    # Without the application, as in the headless benchmark, there is no
+    # texture library to take the eye texture from
+    if hasattr(mh.G.app, 'getCategory'):
+        mhstx = mh.G.app.getCategory('Textures').getTaskByName('Texture').eyeTexture
+    else:
+        mhstx = None
     if mhstx:
         stuffs[0].textureImage = subtextures.combine(stuffs[0].textureImage, mhstx)
     
@@ -250,22 +272,14 @@ def setupProxies(typename, name, obj, stuffs, meshInfo, config, deleteGroups, de
 def filterMesh(meshInfo, scale, deleteGroups, deleteVerts, eyebrows, lashes, useFaceMask = False):
     """
     Filter out vertices and faces from the mesh that are not desired for exporting.
+
+    On return meshInfo.vertexMapping and meshInfo.uvMapping are integer arrays
+    that map each vertex (uv) index of the unfiltered object to its index in
+    the filtered object, or -1 if it was removed.
     """
     # TODO scaling does not belong in a filter method
     obj = meshInfo.object
 
-    killUvs = numpy.zeros(len(obj.texco), bool)
-    killFaces = numpy.zeros(len(obj.fvert), bool)
-        
-    if deleteVerts is not None:
-        killVerts = deleteVerts
-        for fn,fverts in enumerate(obj.fvert):
-            for vn in fverts:
-                if killVerts[vn]:
-                    killFaces[fn] = True             
-    else:
-        killVerts = numpy.zeros(len(obj.coord), bool)
-
     killGroups = []        
     for fg in obj.faceGroups:
         if (("joint" in fg.name) or 
@@ -281,89 +295,84 @@ def filterMesh(meshInfo, scale, deleteGroups, deleteVerts, eyebrows, lashes, use
     if useFaceMask:
         # Apply the facemask set on the module3d object (the one used for rendering within MH)
         faceMask = numpy.logical_or(faceMask, numpy.logical_not(obj.getFaceMask()))
-    killFaces[faceMask] = True
-
-    #verts = obj.fvert[faceMask]
-    verts = obj.fvert[numpy.logical_not(faceMask)]
-    vertMask = numpy.ones(len(obj.coord), bool)
-    vertMask[verts] = False
-    verts = numpy.argwhere(vertMask)
-    del vertMask
-    killVerts[verts] = True
-
-    #uvs = obj.fuvs[faceMask]
-    uvs = obj.fuvs[numpy.logical_not(faceMask)]
-    uvMask = numpy.ones(len(obj.texco), bool)
-    uvMask[uvs] = False
-    uvs = numpy.argwhere(uvMask)
-    del uvMask
-    killUvs[uvs] = True
-    
-    n = 0
-    newVerts = {}
-    coords = []
-    for m,co in enumerate(obj.coord):
-        if not killVerts[m]:
-            coords.append(scale*co)
-            newVerts[m] = n
-            n += 1
-    
-    n = 0
-    texVerts = []
-    newUvs = {}
-    for m,uv in enumerate(obj.texco):
-        if not killUvs[m]:
-            texVerts.append(uv)
-            newUvs[m] = n
-            n += 1   
-    
-    faceVerts = []
-    faceUvs = []
-    for fn,fverts in enumerate(obj.fvert):
-        if not killFaces[fn]:
-            fverts2 = []
-            fuvs2 = []
-            for vn in fverts:
-                fverts2.append(newVerts[vn])
-            for uv in obj.fuvs[fn]:
-                fuvs2.append(newUvs[uv])
-            faceVerts.append(fverts2)
-            faceUvs.append(fuvs2)
-    
+
+    # Faces are removed if they are masked or use a deleted vertex
+    if deleteVerts is not None:
+        killVerts = numpy.array(deleteVerts, dtype=bool)
+        killFaces = numpy.logical_or(faceMask, killVerts[obj.fvert].any(axis=1))
+    else:
+        killVerts = numpy.zeros(len(obj.coord), bool)
+        killFaces = faceMask
+
+    # Vertices and uvs are removed if no unmasked face references them
+    keptFaces = numpy.logical_not(faceMask)
+    vertUsed = numpy.zeros(len(obj.coord), bool)
+    vertUsed[obj.fvert[keptFaces]] = True
+    killVerts |= numpy.logical_not(vertUsed)
+    uvUsed = numpy.zeros(len(obj.texco), bool)
+    uvUsed[obj.fuvs[keptFaces]] = True
+    killUvs = numpy.logical_not(uvUsed)
+
+    vertexMask = numpy.logical_not(killVerts)
+    uvMask = numpy.logical_not(killUvs)
+    faceKeep = numpy.logical_not(killFaces)
+
+    # Reindexing tables: new index for kept elements, -1 for removed ones
+    newVerts = numpy.cumsum(vertexMask, dtype=numpy.int32) - 1
+    newVerts[killVerts] = -1
+    newUvs = numpy.cumsum(uvMask, dtype=numpy.int32) - 1
+    newUvs[killUvs] = -1
+
+    coords = scale * obj.coord[vertexMask]
+    texVerts = obj.texco[uvMask]
+    faceVerts = newVerts[obj.fvert[faceKeep]]
+    faceUvs = newUvs[obj.fuvs[faceKeep]]
+
     weights = {}
     if meshInfo.weights:
         for (b, wts1) in meshInfo.weights.items():
-            wts2 = []
-            for (v1,w) in wts1:
-                if not killVerts[v1]:
-                   wts2.append((newVerts[v1],w))
-            weights[b] = wts2
-    
+            if not wts1:
+                weights[b] = []
+                continue
+            verts1,ws1 = zip(*wts1)
+            verts1 = numpy.asarray(verts1, dtype=numpy.int32)
+            keep = vertexMask[verts1]
+            verts2 = newVerts[verts1[keep]]
+            ws2 = numpy.asarray(ws1)[keep]
+            weights[b] = zip(verts2.tolist(), ws2.tolist())
+
     shapes = []
     if meshInfo.shapes:
-        for (name, morphs1) in meshInfo.shapes:
-            morphs2 = {}
-            for (v1,dx) in morphs1.items():
-                if not killVerts[v1]:
-                    morphs2[newVerts[v1]] = scale*dx
-            shapes.append((name, morphs2))
+        for (name, (verts1, dxs1)) in meshInfo.shapes:
+            keep = vertexMask[verts1]
+            verts2 = newVerts[verts1[keep]]
+            dxs2 = scale * dxs1[keep]
+            shapes.append((name, (verts2, dxs2)))
 
     meshInfo.fromProxy(coords, texVerts, faceVerts, faceUvs, weights, shapes)
-    meshInfo.vertexMask = numpy.logical_not(killVerts)
+    meshInfo.vertexMask = vertexMask
     meshInfo.vertexMapping = newVerts
-    meshInfo.faceMask = numpy.logical_not(faceMask)
+    meshInfo.uvMapping = newUvs
+    meshInfo.faceMask = keptFaces
     return meshInfo
  
 #
 #   getTextureNames(stuff):
 #
 
-def getTextureNames(stuff):
-    global theTextures, theTexFiles, theMaterials
+# Exporters of a session may run in several threads
+_textureLock = threading.Lock()
 
+def getTextureNames(stuff):
     if not stuff.type:
         return ("SkinShader", None, "SkinShader")
-        
+
+    with _textureLock:
+        return _getTextureNames(stuff)
+
+def _getTextureNames(stuff):
+    global theTextures, theTexFiles, theMaterials
+
     try:
         texname = theTextures[stuff.name]
         texfile = theTexFiles[stuff.name]
@@ -50,6 +50,8 @@ class Config:
         self.cage               = False
         self.texFolder          = None
         self.customPrefix       = ""
+        self.expressions        = False
+        self.useCustomShapes    = False
         self.human              = None
 
 
@@ -26,6 +26,7 @@ import sys
 import os
 import numpy
 import mh
+import algos3d
 import log
 
 
@@ -50,19 +51,15 @@ def readCustomFolder(folder, config):
 
 
 def readCustomTarget(path):
-    try:
-        fp = open(path, "rU")
-    except:
-        return []
-    shape = {}
-    for line in fp:
-        words = line.split()
-        try:
-            shape[int(words[0])] = numpy.array((float(words[1]), float(words[2]), float(words[3])))
-        except:
-            return {}
-    fp.close()
-    return shape
+    """
+    Read a custom target as an (indices, deltas) shape, empty if it can not
+    be read.
+    """
+    target = algos3d.loadTargetData(path)
+    if target is None:
+        return (numpy.zeros(0, numpy.int32), numpy.zeros((0,3), float))
+    indices, deltas = target
+    return (numpy.asarray(indices, dtype=numpy.int32), numpy.asarray(deltas, dtype=float))
         
 
 def setupCustomRig(config): 
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+Bulk text formatting of numpy arrays for the text based exporters.
+Instead of one write call per element, blocks of rows are formatted with a
+single string format operation and written at once.
+"""
+
+import numpy as np
+
+# Number of rows formatted into one string before it is written to file
+ChunkSize = 16384
+
+
+def formatRows(rowFmt, array):
+    """
+    Return the rows of array formatted with rowFmt, concatenated.
+    rowFmt contains one conversion specifier per column.
+    """
+    array = np.asarray(array)
+    if len(array) == 0:
+        return ""
+    array = array.reshape(len(array), -1)
+    return (rowFmt * len(array)) % tuple(array.ravel().tolist())
+
+
+def writeRows(fp, rowFmt, array, chunkSize=ChunkSize):
+    """
+    Write each row of array formatted with rowFmt, in chunks of chunkSize
+    rows.
+    """
+    array = np.asarray(array)
+    for start in xrange(0, len(array), chunkSize):
+        fp.write(formatRows(rowFmt, array[start:start+chunkSize]))
+
+
+def faceRuns(isTri):
+    """
+    Split a face list in runs of faces of equal type.
+    Returns a list of (start, end, isTri) tuples.
+    """
+    isTri = np.asarray(isTri, dtype=bool)
+    bounds = np.flatnonzero(isTri[1:] != isTri[:-1]) + 1
+    bounds = [0] + bounds.tolist() + [len(isTri)]
+    return [(start, end, bool(isTri[start])) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+def writeFaceRows(fp, quadFmt, triFmt, corners, isTri, chunkSize=ChunkSize):
+    """
+    Write face rows from a (nFaces, 4, ...) array of corner values.
+    Faces flagged in isTri are written with triFmt using only their first
+    three corners, the others with quadFmt. Faces are written in runs of
+    equal type so that the face order is preserved.
+    """
+    for start, end, tri in faceRuns(isTri):
+        if tri:
+            writeRows(fp, triFmt, corners[start:end,:3], chunkSize)
+        else:
+            writeRows(fp, quadFmt, corners[start:end], chunkSize)
+
+
+def formatFaceRows(quadFmt, triFmt, corners, isTri):
+    """
+    Return the face rows written by writeFaceRows as a string, for blocks
+    that are written more than once.
+    """
+    return "".join([
+        formatRows(triFmt, corners[start:end,:3]) if tri else formatRows(quadFmt, corners[start:end])
+        for start, end, tri in faceRuns(isTri)])
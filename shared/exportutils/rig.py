@@ -25,6 +25,9 @@ TODO
 
 import numpy as np
 import os
+import json
+import hashlib
+import mh
 import mh2proxy
 import log
 
@@ -81,70 +84,311 @@ def setupRigJoint (words, obj, coord, locations):
         raise NameError("Unknown %s" % typ)
 
 #
-#   readRigFile(filename, obj, coord=None, locations={}):
+#   Compiled rigs
 #
 
-def readRigFile(filename, obj, coord=None, locations={}):
+# Cache directory for compiled rigs, None for <home>/cache/rigs
+CacheDir = None
+
+CompiledVersion = 1
+
+def getCacheDir():
+    if CacheDir is None:
+        return os.path.join(mh.getPath(''), 'cache', 'rigs')
+    return CacheDir
+
+def _csr(lists, dtype):
+    """
+    Concatenate a list of sequences into (indptr, values) arrays.
+    """
+    indptr = np.zeros(len(lists)+1, dtype=np.int32)
+    indptr[1:] = np.cumsum([len(l) for l in lists])
+    if lists:
+        values = np.concatenate([np.asarray(l, dtype=dtype) for l in lists])
+    else:
+        values = np.zeros(0, dtype=dtype)
+    return indptr, values.astype(dtype)
+
+def _parseOptions(words):
+    options = {}
+    for word in words:
+        try:
+            float(word)
+            values.append(word)
+            continue
+        except:
+            pass
+        if word[0] == '-':
+            values = []
+            options[word] = values
+        else:
+            values.append(word)
+    return options
+
+def meshTopologyDigest(obj):
+    """
+    Hash of the faces and face groups of a mesh, the part of the mesh a
+    compiled rig depends on.
+    """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(obj.fvert).view(np.uint8))
+    digest.update(np.ascontiguousarray(obj.group).view(np.uint8))
+    digest.update('\n'.join(fg.name for fg in obj.faceGroups))
+    return digest.hexdigest()
+
+class CompiledRig(object):
+    """
+    A .rig file compiled into arrays, so that it can be fitted to a mesh
+    with a few array operations instead of parsing and evaluating the file.
+
+    Locations are evaluated by a small program:
+
+    - **self.jointTargets**, **self.jointIndptr**, **self.jointVerts**: The
+      locations that are the centroid of a joint vertex group, with the
+      vertices of each group in CSR form.
+    - **self.vertTargets**, **self.vertIndices**, **self.vertOffsets**: The
+      locations that are a mesh vertex plus an offset (vertex and voffset).
+    - **self.steps**: The remaining location lines, evaluated in order with
+      setupRigJoint.
+
+    The bone list is kept as (bone, head, tail, roll, parent, options) with
+    head and tail the names of locations, the weights as CSR arrays
+    self.weightIndptr, self.weightVerts and self.weightValues with one row
+    per name in self.weightNames.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.jointTargets = np.zeros(0, dtype=np.int32)
+        self.jointIndptr = np.zeros(1, dtype=np.int32)
+        self.jointVerts = np.zeros(0, dtype=np.int32)
+        self.vertTargets = np.zeros(0, dtype=np.int32)
+        self.vertIndices = np.zeros(0, dtype=np.int32)
+        self.vertOffsets = np.zeros((0,3), dtype=np.float64)
+        self.steps = []
+        self.bones = []
+        self.weightNames = []
+        self.weightIndptr = np.zeros(1, dtype=np.int32)
+        self.weightVerts = np.zeros(0, dtype=np.int32)
+        self.weightValues = np.zeros(0, dtype=np.float64)
+
+    @classmethod
+    def fromFile(cls, path, obj):
+        """
+        Parse a .rig file, resolving the joint vertex groups on mesh obj.
+        """
+        self = cls()
+        doLocations = 1
+        doBones = 2
+        doWeights = 3
+        status = 0
+
+        joints = []
+        verts = []
+        weights = {}
+        fp = open(path, "rU")
+        for line in fp:
+            words = line.split()
+            if len(words) == 0:
+                pass
+            elif words[0] == '#':
+                if words[1] == 'locations':
+                    status = doLocations
+                elif words[1] == 'bones':
+                    status = doBones
+                elif words[1] == 'weights':
+                    status = doWeights
+                    wts = []
+                    weights[words[2]] = wts
+            elif status == doWeights:
+                wts.append(line)
+            elif status == doLocations:
+                typ = words[1]
+                if typ == 'joint':
+                    joints.append((len(self.names), obj.getVerticesForGroups(["joint-"+words[2]])))
+                elif typ == 'vertex':
+                    verts.append((len(self.names), int(words[2]), (0.0, 0.0, 0.0)))
+                elif typ == 'voffset':
+                    verts.append((len(self.names), int(words[2]), tuple(float(w) for w in words[3:6])))
+                else:
+                    self.steps.append(words)
+                    continue
+                self.names.append(words[0])
+            elif status == doBones:
+                self.bones.append((words[0], words[1], words[2], float(words[3]), words[4], _parseOptions(words[5:])))
+            else:
+                raise NameError("Unknown status %d" % status)
+        fp.close()
+
+        if joints:
+            self.jointTargets = np.asarray([j[0] for j in joints], dtype=np.int32)
+            self.jointIndptr, self.jointVerts = _csr([j[1] for j in joints], np.int32)
+        if verts:
+            self.vertTargets = np.asarray([v[0] for v in verts], dtype=np.int32)
+            self.vertIndices = np.asarray([v[1] for v in verts], dtype=np.int32)
+            self.vertOffsets = np.asarray([v[2] for v in verts], dtype=np.float64)
+
+        self.weightNames = list(weights.keys())
+        values = [np.asarray(''.join(weights[name]).split(), dtype=np.float64).reshape(-1, 2) for name in self.weightNames]
+        self.weightIndptr, pairs = _csr(values, np.float64)
+        pairs = pairs.reshape(-1, 2)
+        self.weightVerts = pairs[:,0].astype(np.int32)
+        self.weightValues = pairs[:,1]
+        return self
+
+    def save(self, filename):
+        header = json.dumps(dict(version = CompiledVersion, names = self.names,
+                                 steps = self.steps, bones = self.bones,
+                                 weightNames = self.weightNames))
+        with open(filename, 'wb') as f:
+            np.savez(f, header = np.array(header),
+                     jointTargets = self.jointTargets, jointIndptr = self.jointIndptr, jointVerts = self.jointVerts,
+                     vertTargets = self.vertTargets, vertIndices = self.vertIndices, vertOffsets = self.vertOffsets,
+                     weightIndptr = self.weightIndptr, weightVerts = self.weightVerts, weightValues = self.weightValues)
+
+    @classmethod
+    def load(cls, filename):
+        self = cls()
+        data = np.load(filename)
+        try:
+            header = json.loads(str(data['header']))
+            if header.get('version') != CompiledVersion:
+                raise ValueError('Compiled rig %s has version %s' % (filename, header.get('version')))
+            self.names = [str(name) for name in header['names']]
+            self.steps = [[str(w) for w in words] for words in header['steps']]
+            self.bones = [(str(b), str(h), str(t), r, str(p), dict((str(k), [str(v) for v in vs]) for k, vs in o.items()))
+                          for b, h, t, r, p, o in header['bones']]
+            self.weightNames = [str(name) for name in header['weightNames']]
+            for key in ('jointTargets', 'jointIndptr', 'jointVerts', 'vertTargets', 'vertIndices',
+                        'vertOffsets', 'weightIndptr', 'weightVerts', 'weightValues'):
+                setattr(self, key, data[key])
+        finally:
+            data.close()
+        return self
+
+    def getLocationArray(self, obj, coord=None):
+        """
+        The (n,3) coordinates of the vertex based locations (in the order of
+        self.names) on mesh obj. Vertices beyond the end of obj.coord are
+        taken from coord.
+        """
+        result = np.zeros((len(self.names), 3), dtype=np.float64)
+        if len(self.jointTargets):
+            counts = np.diff(self.jointIndptr)
+            groups = np.repeat(np.arange(len(counts)), counts)
+            coords = obj.coord[self.jointVerts].astype(np.float64)
+            sums = np.column_stack([np.bincount(groups, coords[:,k], minlength=len(counts)) for k in xrange(3)])
+            # The mean of no vertices is NaN, as it is for an empty joint
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[self.jointTargets] = sums / counts[:,None]
+        if len(self.vertTargets):
+            nVerts = len(obj.coord)
+            inMesh = self.vertIndices < nVerts
+            locs = np.empty((len(self.vertTargets), 3), dtype=np.float64)
+            locs[inMesh] = obj.coord[self.vertIndices[inMesh]]
+            if not np.all(inMesh):
+                locs[~inMesh] = np.asarray(coord, dtype=np.float64)[self.vertIndices[~inMesh]]
+            result[self.vertTargets] = locs + self.vertOffsets
+        return result
+
+    def evaluate(self, obj, coord=None, locations=None):
+        """
+        Evaluate the locations of this rig on mesh obj, into the dict
+        locations.
+        """
+        if locations is None:
+            locations = {}
+        if coord is None or len(coord) == 0:
+            coord = obj.coord
+        for name, loc in zip(self.names, self.getLocationArray(obj, coord)):
+            locations[name] = loc
+        for words in self.steps:
+            setupRigJoint(words, obj, coord, locations)
+        return locations
+
+    def getArmature(self, locations):
+        return [(bone, locations[head], locations[tail], roll, parent, options)
+                for bone, head, tail, roll, parent, options in self.bones]
+
+    def getWeights(self):
+        """
+        The weights as {bone: [(vertIdx, weight), ...]}, as in the .rig file.
+        """
+        weights = {}
+        for i, name in enumerate(self.weightNames):
+            start, end = self.weightIndptr[i], self.weightIndptr[i+1]
+            weights[name] = zip(self.weightVerts[start:end].tolist(), self.weightValues[start:end].tolist())
+        return weights
+
+    def getBoneWeights(self, nVerts):
+        """
+        The weights normalized per vertex, as {bone: (verts, weights)}
+        arrays, and the vertices that have no weights.
+        """
+        wtot = np.bincount(self.weightVerts, self.weightValues, minlength=nVerts)
+        normalized = (self.weightValues / wtot[self.weightVerts]).astype(np.float32)
+        boneWeights = {}
+        for i, name in enumerate(self.weightNames):
+            start, end = self.weightIndptr[i], self.weightIndptr[i+1]
+            boneWeights[name] = (self.weightVerts[start:end], normalized[start:end])
+        return boneWeights, np.flatnonzero(wtot == 0)
+
+_compiledRigs = {}
+
+def getCompiledRig(filename, obj):
+    """
+    The CompiledRig of a .rig file for mesh obj. Compiled rigs are kept in
+    memory and in the cache directory, keyed by a hash of the file and of the
+    mesh topology, so that a rig file is only parsed once.
+    """
     if type(filename) == tuple:
         (folder, fname) = filename
         filename = os.path.join(folder, fname)
     path = os.path.realpath(os.path.expanduser(filename))
-    try:
-        fp = open(path, "rU")
-    except:
-        log.error("*** Cannot open %s" % path)
-        return
+    with open(path, "rb") as fp:
+        fileDigest = hashlib.sha1(fp.read()).hexdigest()
+    key = '%s_%s' % (fileDigest, meshTopologyDigest(obj)[:16])
+    if key in _compiledRigs:
+        return _compiledRigs[key]
 
-    doLocations = 1
-    doBones = 2
-    doWeights = 3
-    status = 0
+    cacheFile = os.path.join(getCacheDir(), key + '.npz')
+    rig = None
+    if os.path.isfile(cacheFile):
+        try:
+            rig = CompiledRig.load(cacheFile)
+        except (IOError, ValueError, KeyError):
+            log.warning('Could not load compiled rig %s', cacheFile, exc_info=True)
 
-    armature = []
-    weights = {}
+    if rig is None:
+        log.debug('Compiling rig %s', path)
+        rig = CompiledRig.fromFile(path, obj)
+        try:
+            if not os.path.isdir(getCacheDir()):
+                os.makedirs(getCacheDir())
+            tmpname = cacheFile + '.tmp'
+            rig.save(tmpname)
+            if os.path.exists(cacheFile):
+                os.remove(cacheFile)
+            os.rename(tmpname, cacheFile)
+        except (IOError, OSError):
+            log.warning('Could not write compiled rig %s', cacheFile, exc_info=True)
 
-    if not coord:
-        coord = obj.coord
-    for line in fp: 
-        words = line.split()
-        if len(words) == 0:
-            pass
-        elif words[0] == '#':
-            if words[1] == 'locations':
-                status = doLocations
-            elif words[1] == 'bones':
-                status = doBones
-            elif words[1] == 'weights':
-                status = doWeights
-                wts = []
-                weights[words[2]] = wts
-        elif status == doWeights:
-            wts.append((int(words[0]), float(words[1])))
-        elif status == doLocations:
-            setupRigJoint (words, obj, coord, locations)
-        elif status == doBones:
-            bone = words[0]
-            head = locations[words[1]]
-            tail = locations[words[2]]
-            roll = float(words[3])
-            parent = words[4]
-            options = {}
-            for word in words[5:]:
-                try:
-                    float(word)
-                    values.append(word)
-                    continue
-                except:
-                    pass
-                if word[0] == '-':
-                    values = []
-                    options[word] = values
-                else:
-                    values.append(word)
-            armature.append((bone, head, tail, roll, parent, options))
-        else:
-            raise NameError("Unknown status %d" % status)
+    _compiledRigs[key] = rig
+    return rig
+
+def clearRigCache():
+    _compiledRigs.clear()
+
+#
+#   readRigFile(filename, obj, coord=None, locations={}):
+#
 
-    fp.close()
-    return (locations, armature, weights)
+def readRigFile(filename, obj, coord=None, locations={}):
+    try:
+        rig = getCompiledRig(filename, obj)
+    except (IOError, OSError):
+        log.error("*** Cannot open %s" % str(filename))
+        return
 
+    rig.evaluate(obj, coord, locations)
+    return (locations, rig.getArmature(locations), rig.getWeights())
@@ -0,0 +1,407 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+Export of skinned geometry for every frame of an animation.
+
+All static data (topology, uvs, filtering and proxy fitting) is prepared once
+from the stuffs returned by collect.setupObjects. Per frame only the base mesh
+is skinned and the vertex positions (and normals) of all stuffs are derived
+from it with a few array operations. Proxy and clothes vertices follow their
+reference vertices on the base mesh, their offset from the surface is turned
+with the skinning of those reference vertices. Frames are produced by a
+generator, so only one frame is kept in memory at any time.
+
+Supported outputs are binary PLY and OBJ files (one file per frame), and a
+single packed .npy array of shape (nFrames, nVerts, 3) or (nFrames, nVerts, 6)
+when normals are included, which can be memory-mapped by numpy.load.
+"""
+
+import os
+import StringIO
+import numpy as np
+
+from . import collect
+from .config import Config
+from . import formatting
+
+
+class CMeshSequence(object):
+    """
+    Static data of the exported meshes, and per frame evaluation of their
+    vertex positions.
+
+    stuffs          the stuffs returned by collect.setupObjects (unsubdivided)
+    baseMesh        the human mesh the stuffs were collected from
+    skel            skeleton used for skinning
+    restCoords      homogenous (n,4) rest coordinates of baseMesh
+    boneWeights     vertex weights of baseMesh as {boneName: (verts, weights)}
+    scale           the scale the stuffs were collected with
+    labels          optional per vertex integer labels of baseMesh (eg. body
+                    part indices), -1 for unlabeled vertices
+    """
+
+    def __init__(self, stuffs, baseMesh, skel, restCoords, boneWeights, scale=1.0, labels=None):
+        self.skeleton = skel
+        self.restCoords = restCoords
+        self.boneWeights = boneWeights
+        self.scale = scale
+        self.names = [stuff.name for stuff in stuffs]
+
+        baseCoords = np.asarray(baseMesh.coord, dtype=np.float64)
+
+        self._parts = []
+        faces = []
+        isTri = []
+        texco = []
+        fuvs = []
+        vertLabels = []
+        self.hasUVs = True
+        nVerts = 0
+        nTexVerts = 0
+        for stuff in stuffs:
+            obj = stuff.meshInfo.object
+            count = len(obj.coord)
+            if stuff.proxy:
+                refVerts = stuff.proxy.refVerts
+                verts = np.array([rv.getHumanVerts() for rv in refVerts], dtype=np.int32)
+                weights = np.array([rv.getWeights() for rv in refVerts], dtype=np.float64)
+                if len(verts) != count:
+                    raise RuntimeError("Cannot export %s as a sequence: subdivided meshes are not supported." % stuff.name)
+                # Everything that does not follow the reference vertices is an
+                # offset, turned with the skinning of the reference vertices
+                offsets = obj.coord - scale*np.sum(weights[:,:,None] * baseCoords[verts], axis=1)
+                part = (verts, weights, offsets)
+                if labels is not None:
+                    vertLabels.append(labels[verts[np.arange(count), np.argmax(weights, axis=1)]])
+            else:
+                if stuff.meshInfo.vertexMask is not None:
+                    verts = np.flatnonzero(stuff.meshInfo.vertexMask).astype(np.int32)
+                else:
+                    verts = np.arange(len(baseCoords), dtype=np.int32)
+                if len(verts) != count:
+                    raise RuntimeError("Cannot export %s as a sequence: subdivided meshes are not supported." % stuff.name)
+                part = (verts, None, None)
+                if labels is not None:
+                    vertLabels.append(labels[verts])
+            self._parts.append(part)
+
+            faces.append(obj.fvert + nVerts)
+            isTri.append(obj.fvert[:,0] == obj.fvert[:,3])
+            if obj.has_uv:
+                texco.append(obj.texco)
+                fuvs.append(obj.fuvs + nTexVerts)
+                nTexVerts += len(obj.texco)
+            else:
+                self.hasUVs = False
+            nVerts += count
+
+        self.nVerts = nVerts
+        self.faces = np.vstack(faces).astype(np.int32)
+        self.isTri = np.concatenate(isTri)
+        if self.hasUVs:
+            self.texco = np.vstack(texco)
+            self.fuvs = np.vstack(fuvs).astype(np.int32)
+        else:
+            self.texco = None
+            self.fuvs = None
+        if labels is not None:
+            self.labels = np.concatenate(vertLabels).astype(np.int32)
+        else:
+            self.labels = None
+
+        # Skin weights of the base mesh vertices the proxies refer to, as
+        # (boneName, indices in self._refVerts, weights)
+        proxyVerts = [verts.ravel() for verts, weights, _ in self._parts if weights is not None]
+        if proxyVerts:
+            self._refVerts = np.unique(np.concatenate(proxyVerts))
+        else:
+            self._refVerts = np.zeros(0, dtype=np.int32)
+        self._refWeights = []
+        if len(self._refVerts):
+            for bname, (bverts, bweights) in boneWeights.items():
+                bverts = np.asarray(bverts)
+                ix = np.minimum(np.searchsorted(self._refVerts, bverts), len(self._refVerts)-1)
+                found = self._refVerts[ix] == bverts
+                if np.any(found):
+                    self._refWeights.append((bname, ix[found], np.asarray(bweights, dtype=np.float64)[found]))
+
+        # Triangle corners used for normal calculation (quads are split)
+        quads = self.faces[np.logical_not(self.isTri)]
+        self._tris = np.vstack([self.faces[:,:3], quads[:,[0,2,3]]])
+
+    def getSkinMatrices(self):
+        """
+        The linear part (n,3,3) of the skinning transformation of the base
+        mesh vertices the proxies refer to, in the current pose of the
+        skeleton.
+        """
+        mats = np.zeros((len(self._refVerts), 3, 3), dtype=np.float64)
+        for bname, ix, weights in self._refWeights:
+            # A vertex occurs only once in the weights of a bone
+            mats[ix] += weights[:,None,None] * np.asarray(self.skeleton.getBone(bname).matPoseVerts)[None,:3,:3]
+        return mats
+
+    def getCoords(self, baseCoords, skinMatrices=None):
+        """
+        Vertex positions of all stuffs, concatenated, for the given (posed)
+        base mesh coordinates. The offsets of proxy vertices are turned by
+        skinMatrices, as returned by getSkinMatrices, and kept as in the rest
+        pose if it is None.
+        """
+        coords = np.empty((self.nVerts, 3), dtype=np.float32)
+        start = 0
+        for verts, weights, offsets in self._parts:
+            end = start + len(verts)
+            if weights is None:
+                coords[start:end] = self.scale * baseCoords[verts]
+            else:
+                if skinMatrices is not None:
+                    mats = skinMatrices[np.searchsorted(self._refVerts, verts)]
+                    offsets = np.einsum('nk,nkij,nj->ni', weights, mats, offsets)
+                coords[start:end] = self.scale * np.sum(weights[:,:,None] * baseCoords[verts], axis=1) + offsets
+            start = end
+        return coords
+
+    def getNormals(self, coords):
+        """
+        Area weighted vertex normals of all stuffs.
+        """
+        tris = self._tris
+        v0 = coords[tris[:,0]]
+        fnorm = np.cross(coords[tris[:,1]] - v0, coords[tris[:,2]] - v0)
+        norms = np.empty((self.nVerts, 3), dtype=np.float32)
+        for axis in xrange(3):
+            w = np.repeat(fnorm[:,axis], 3)
+            norms[:,axis] = np.bincount(tris.ravel(), weights=w, minlength=self.nVerts)
+        length = np.sqrt(np.sum(norms ** 2, axis=-1))
+        length[length == 0] = 1
+        norms /= length[:,None]
+        return norms
+
+    def frames(self, anim, frameIndices=None, normals=True):
+        """
+        Generator over the frames of animation track anim, yielding
+        (frameIdx, coords, normals) with normals None if not requested.
+        """
+        if frameIndices is None:
+            frameIndices = xrange(anim.nFrames)
+        for frameIdx in frameIndices:
+            self.skeleton.setPose(anim.getAtFramePos(frameIdx))
+            baseCoords = self.skeleton.skinMesh(self.restCoords, self.boneWeights)[:,:3]
+            coords = self.getCoords(baseCoords, self.getSkinMatrices())
+            if normals:
+                yield frameIdx, coords, self.getNormals(coords)
+            else:
+                yield frameIdx, coords, None
+
+#
+#   PLY output
+#
+
+def _plyVertexType(normals, labels):
+    fields = [('co', '<f4', (3,))]
+    if normals:
+        fields.append(('no', '<f4', (3,)))
+    if labels:
+        fields.append(('label', '<i4'))
+    return np.dtype(fields)
+
+
+def _plyHeader(seq, nVerts, normals, faces):
+    header = [
+        "ply",
+        "format binary_little_endian 1.0",
+        "comment MakeHuman exported mesh sequence",
+        "element vertex %d" % nVerts,
+        "property float x",
+        "property float y",
+        "property float z"]
+    if normals:
+        header += [
+            "property float nx",
+            "property float ny",
+            "property float nz"]
+    if seq.labels is not None:
+        header.append("property int label")
+    if faces:
+        header += [
+            "element face %d" % len(seq.faces),
+            "property list uchar int vertex_indices"]
+    header.append("end_header\n")
+    return "\n".join(header)
+
+
+def _plyFaceData(seq):
+    buf = StringIO.StringIO()
+    for start, end, tri in formatting.faceRuns(seq.isTri):
+        n = 3 if tri else 4
+        rec = np.empty(end-start, dtype=[('n', 'u1'), ('v', '<i4', (n,))])
+        rec['n'] = n
+        rec['v'] = seq.faces[start:end,:n]
+        buf.write(rec.tostring())
+    return buf.getvalue()
+
+
+def writePly(seq, anim, filepattern, frameIndices=None, normals=True, faces=True):
+    """
+    Write one binary PLY file per frame. filepattern is formatted with the
+    frame index, eg. "walk_%04d.ply". With faces False only the point cloud
+    is written.
+    """
+    vertexType = _plyVertexType(normals, seq.labels is not None)
+    vertexData = np.zeros(seq.nVerts, dtype=vertexType)
+    if seq.labels is not None:
+        vertexData['label'] = seq.labels
+    header = _plyHeader(seq, seq.nVerts, normals, faces)
+    if faces:
+        faceData = _plyFaceData(seq)
+    else:
+        faceData = ""
+
+    for frameIdx, coords, norms in seq.frames(anim, frameIndices, normals):
+        vertexData['co'] = coords
+        if normals:
+            vertexData['no'] = norms
+        fp = open(filepattern % frameIdx, 'wb')
+        fp.write(header)
+        fp.write(vertexData.tostring())
+        fp.write(faceData)
+        fp.close()
+
+#
+#   OBJ output
+#
+
+def _objStaticData(seq, normals):
+    buf = StringIO.StringIO()
+    if seq.hasUVs:
+        formatting.writeRows(buf, "vt %.4g %.4g\n", seq.texco)
+    columns = [seq.faces + 1]
+    if seq.hasUVs:
+        columns.append(seq.fuvs + 1)
+    if normals:
+        columns.append(seq.faces + 1)
+    corners = np.dstack(columns)
+    if normals:
+        token = "%d/%d/%d" if seq.hasUVs else "%d//%d"
+    else:
+        token = "%d/%d" if seq.hasUVs else "%d"
+    formatting.writeFaceRows(buf,
+        "f %s\n" % " ".join([token]*4),
+        "f %s\n" % " ".join([token]*3),
+        corners, seq.isTri)
+    return buf.getvalue()
+
+
+def writeObj(seq, anim, filepattern, frameIndices=None, normals=True):
+    """
+    Write one OBJ file per frame. filepattern is formatted with the frame
+    index, eg. "walk_%04d.obj". The uv and face sections are formatted only
+    once.
+    """
+    staticData = _objStaticData(seq, normals)
+    for frameIdx, coords, norms in seq.frames(anim, frameIndices, normals):
+        fp = open(filepattern % frameIdx, 'w')
+        fp.write("# MakeHuman exported OBJ sequence, frame %d\n" % frameIdx)
+        formatting.writeRows(fp, "v %.4g %.4g %.4g\n", coords)
+        if normals:
+            formatting.writeRows(fp, "vn %.4g %.4g %.4g\n", norms)
+        fp.write(staticData)
+        fp.close()
+
+#
+#   Packed array output
+#
+
+def writePacked(seq, anim, filepath, frameIndices=None, normals=True):
+    """
+    Write all frames to one .npy file of float32 values with shape
+    (nFrames, nVerts, 3), or (nFrames, nVerts, 6) with normals. The faces
+    and labels are written next to it as <name>_faces.npy and
+    <name>_labels.npy.
+    """
+    if frameIndices is None:
+        frameIndices = range(anim.nFrames)
+    else:
+        frameIndices = list(frameIndices)
+    nCols = 6 if normals else 3
+    base = os.path.splitext(filepath)[0]
+
+    fp = open(filepath, 'wb')
+    np.lib.format.write_array_header_1_0(fp, {
+        'descr': np.lib.format.dtype_to_descr(np.dtype('<f4')),
+        'fortran_order': False,
+        'shape': (len(frameIndices), seq.nVerts, nCols) })
+    frame = np.empty((seq.nVerts, nCols), dtype='<f4')
+    for frameIdx, coords, norms in seq.frames(anim, frameIndices, normals):
+        frame[:,:3] = coords
+        if normals:
+            frame[:,3:] = norms
+        fp.write(frame.tostring())
+    fp.close()
+
+    np.save(base + "_faces.npy", seq.faces)
+    if seq.labels is not None:
+        np.save(base + "_labels.npy", seq.labels)
+
+#
+#   exportSequence(human, animated, anim, filepath, ...):
+#
+
+Formats = {
+    'ply':  writePly,
+    'obj':  writeObj,
+    'npy':  writePacked,
+}
+
+def exportSequence(human, animated, anim, filepath, format='ply', config=None, frameIndices=None, normals=True, labels=None, **kwargs):
+    """
+    Export the skinned geometry of human for the frames of animation track
+    anim. animated is the AnimatedMesh the human mesh is attached to.
+    For the per frame formats filepath should contain a frame number
+    conversion specifier, eg. "walk_%04d.ply".
+    """
+    mesh, boneWeights = animated.getMesh(human.meshData.name)
+    if mesh is None:
+        raise RuntimeError("Human mesh is not attached to the animated mesh.")
+    if config is None:
+        config = Config()
+        config.setHuman(human)
+
+    # Subdivision is not applied, the subdivided topology can not be posed
+    # from the base mesh.
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    stuffs = collect.setupObjects(
+        name,
+        human,
+        config=config,
+        helpers=config.helpers,
+        eyebrows=config.eyebrows,
+        lashes=config.lashes,
+        subdivide=False)
+
+    seq = CMeshSequence(stuffs, human.meshData, animated.getSkeleton(), animated.getRestCoordinates(mesh.name), boneWeights, config.scale, labels)
+    time = animated.getTime()
+    try:
+        Formats[format](seq, anim, filepath, frameIndices, normals, **kwargs)
+    finally:
+        # Restore the pose the skeleton was in
+        animated.setToTime(time)
+    return seq
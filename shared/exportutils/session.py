@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Export of one human to several formats in a single pass.
+
+Every exporter starts with collect.setupObjects, which gathers the meshes of
+the human and its proxies, filters and scales them and, if requested,
+subdivides them. While an ExportSession is active, setupObjects is done only
+once for every distinct set of arguments, and repeated until the human
+changes. The exporters themselves can be run concurrently in a pool of
+threads, with the time spent in each one reported.
+
+    with ExportSession(human) as session:
+        session.addJob('obj', mh2obj.exportObj, human, 'out.obj')
+        session.addJob('stl', mh2stl.exportStlBinary, human, 'out.stl')
+        session.run()
+
+Exporters that update the progress bar or otherwise touch the GUI should be
+run with threads = 1.
+"""
+
+import time
+import hashlib
+import threading
+import multiprocessing.pool
+import numpy as np
+
+import log
+
+from . import collect
+
+class ExportSession(object):
+    """
+    Shares the objects collected by setupObjects between the exporters run
+    while it is active, and runs exporters in a thread pool.
+
+    - **self.threads**: *int* The number of exporters run at once, one per
+      cpu if None, in the calling thread if 1.
+    - **self.timings**: *dict* The seconds spent in each job of the last run.
+    - **self.hits**, **self.misses**: *int* The number of setupObjects calls
+      answered from the session and the number that collected the objects.
+    """
+
+    def __init__(self, human, threads = None):
+        self.human = human
+        self.threads = threads
+        self.jobs = []
+        self.timings = {}
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._previous = []
+
+    def __enter__(self):
+        self._previous.append(collect.getSession())
+        collect.setSession(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        collect.setSession(self._previous.pop())
+
+    def _targetDigest(self, rawTargets):
+        # readTargets builds new arrays on every call, so the targets are
+        # compared by name and content
+        digest = hashlib.sha1()
+        for name, shape in rawTargets:
+            digest.update(name)
+            for array in shape:
+                array = np.ascontiguousarray(array)
+                digest.update(array.dtype.str)
+                digest.update(str(array.shape))
+                digest.update(array.view(np.uint8))
+        return digest.hexdigest()
+
+    def _key(self, name, human, config, rigfile, rawTargets, helpers, hidden, eyebrows, lashes, subdivide):
+        # The coordinate revision of the mesh changes whenever the human is
+        # modified, the face mask when clothes hide parts of the body
+        obj = human.meshData
+        proxies = tuple((pfile.type, pfile.file) for pfile in config.getProxyList())
+        mask = hashlib.sha1(obj.face_mask.tostring()).hexdigest()
+        return (id(human), obj.coordRevision, mask, obj.texture, name, config.scale, proxies,
+                rigfile, self._targetDigest(rawTargets), bool(helpers), bool(hidden), bool(eyebrows),
+                bool(lashes), bool(subdivide))
+
+    def setupObjects(self, name, human, config, rigfile, rawTargets, helpers, hidden, eyebrows, lashes, subdivide, progressCallback):
+        """
+        collect.setupObjects, done once for every set of arguments while the
+        human does not change. Exporters get the same list of CStuff objects
+        and must not modify them.
+        """
+        key = self._key(name, human, config, rigfile, rawTargets, helpers, hidden, eyebrows, lashes, subdivide)
+        # setupObjects keeps its state in module globals of collect, so only
+        # one thread can collect at a time
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                stuffs, collect.theStuff = self._cache[key]
+                if progressCallback:
+                    progressCallback(1)
+                return stuffs
+
+            if not self._cache:
+                # Texture names are shared by all exporters of the session
+                collect.theTextures = {}
+                collect.theTexFiles = {}
+                collect.theMaterials = {}
+            textures = (collect.theTextures, collect.theTexFiles, collect.theMaterials)
+
+            self.misses += 1
+            t = time.time()
+            stuffs = collect._setupObjects(name, human, config, rigfile, rawTargets, helpers, hidden, eyebrows, lashes, subdivide, progressCallback)
+            log.message('Collected %d objects for export in %.3f s', len(stuffs), time.time() - t)
+
+            collect.theTextures, collect.theTexFiles, collect.theMaterials = textures
+            self._cache[key] = (stuffs, collect.theStuff)
+            return stuffs
+
+    def clear(self):
+        """
+        Forget the collected objects.
+        """
+        with self._lock:
+            self._cache = {}
+
+    def addJob(self, name, function, *args, **kwargs):
+        """
+        Add an exporter to be run by run(), as function(*args, **kwargs).
+        """
+        self.jobs.append((name, function, args, kwargs))
+
+    def _runJob(self, job):
+        name, function, args, kwargs = job
+        t = time.time()
+        try:
+            function(*args, **kwargs)
+            error = None
+        except Exception as e:
+            log.error('Export %s failed', name, exc_info=True)
+            error = e
+        return name, time.time() - t, error
+
+    def run(self):
+        """
+        Run all added jobs and wait for them to finish. Returns the timings,
+        the seconds spent in each job. If a job failed, the error of the
+        first one that failed is raised after all jobs have finished.
+        """
+        jobs, self.jobs = self.jobs, []
+        t = time.time()
+        with self:
+            if self.threads == 1 or len(jobs) <= 1:
+                results = map(self._runJob, jobs)
+            else:
+                pool = multiprocessing.pool.ThreadPool(self.threads)
+                try:
+                    results = pool.map(self._runJob, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+
+        self.timings = dict((name, seconds) for name, seconds, _ in results)
+        for name, seconds, _ in results:
+            log.message('Export %s: %.3f s', name, seconds)
+        log.message('Export of %d formats: %.3f s (setupObjects %d times, reused %d times)',
+                    len(jobs), time.time() - t, self.misses, self.hits)
+
+        errors = [error for _, _, error in results if error is not None]
+        if errors:
+            raise errors[0]
+        return self.timings
@@ -19,11 +19,16 @@
 Abstract
 --------
 
-TODO
+Shapekeys for the exporters. A shape is a pair of arrays (indices, deltas)
+with the vertex indices and the (n,3) vertex translations of the shape.
+Compiled shapes are cached until the human changes, so that exporting the
+same human again does not recompile them.
 """
 
 import os
 import math
+import hashlib
+import numpy
 import gui3d
 import warp
 import warpmodifier
@@ -86,36 +91,25 @@ def loopGendersAges(name, human, typ):
                 continue
             filename = targetFileName(typ, name, gender, age) 
             ashape = readShape(filename)
-            if ashape:
+            if ashape is not None:
                 gshapes[age] = ashape
                 asums[gender] += aval
-                    
-    shape = {}
-    wsum = 0.0
+
+    # Accumulate in a dense buffer, keep track of the vertices touched
+    shape = numpy.zeros((algos3d.NMHVerts, 3), float)
+    used = numpy.zeros(algos3d.NMHVerts, bool)
     for (gender, gval) in genders:
         if gval < epsilon or asums[gender] < epsilon:
             continue
         gw = gval/gsum
         gshapes = shapes[gender]
         for (age, aval) in ages:
-            if aval < epsilon:
-                continue
-            aw = aval/asums[gender]
-            w = gw*aw
-            try:
-                ashape = gshapes[age]
-            except:
-                ashape = None
-            if not ashape:
+            if aval < epsilon or age not in gshapes:
                 continue
-            wsum += w
-            for v in ashape.keys():
-                try:
-                    (x,y,z) = shape[v]
-                    (dx,dy,dz) = ashape[v]
-                    shape[v] = (x+w*dx, y+w*dy, z+w*dz)
-                except:
-                    shape[v] = ashape[v]
+            w = gw*aval/asums[gender]
+            indices, deltas = gshapes[age]
+            shape[indices] += w*deltas
+            used[indices] = True
                             
     dwarf = 0.8324
     giant = 1.409
@@ -125,12 +119,10 @@ def loopGendersAges(name, human, typ):
     elif height > 0:
         k = 1 + (giant-1)*height
     else:
-        return shape
-        
-    for v in shape.keys():
-        (x,y,z) = shape[v]
-        shape[v] = (k*x, k*y, k*z)    
-    return shape
+        k = 1
+
+    indices = numpy.flatnonzero(used).astype(numpy.int32)
+    return indices, k*shape[indices]
 
 
 def targetFileName(typ, name, gender, age):                
@@ -146,60 +138,96 @@ def targetFileName(typ, name, gender, age):
         
 
 def readShape(filename):                
-    #print ("Try", filename)        
-    try:
-        fp = open(filename, "rU")
-    except:
+    """
+    Read a target as an (indices, deltas) shape, using the compiled target
+    if there is one. Returns None if the target can not be read.
+    """
+    shape = warpmodifier.readTarget(filename)
+    if shape is None:
         log.error("*** Cannot open %s", filename)
         return None
-        
-    shape = {}                    
-    for line in fp:
-        words = line.split()
-        n = int(words[0])
-        if n < algos3d.NMHVerts:
-            shape[n] = (float(words[1]), float(words[2]), float(words[3]))    
-    fp.close()
     log.message("    %s copied", filename)
     return shape
 
+#----------------------------------------------------------
+#   Shape cache
+#----------------------------------------------------------
+
+_shapeCache = {}
+_humanState = None
+
+def getHumanState(human):
+    """
+    A digest of the mesh of human. Warped shapes only depend on the shape
+    of the human, so they can be reused as long as this does not change.
+    """
+    return hashlib.sha1(numpy.ascontiguousarray(human.meshData.coord).data).hexdigest()
+
+
+def compileShapes(templates, fallback, human, bodypart):
+    """
+    The warped (indices, deltas) shapes of templates for human. Shapes are
+    compiled once for every state of the human, the missing ones together
+    so that their landmark system is solved once.
+    """
+    global _humanState
+    state = getHumanState(human)
+    if state != _humanState:
+        _shapeCache.clear()
+        _humanState = state
+
+    keys = [(template, fallback, bodypart) for template in templates]
+    missing = [key[0] for key in keys if key not in _shapeCache]
+    if missing:
+        shapes = warpmodifier.compileWarpTargetsArrays(missing, fallback, human, bodypart)
+        for template, shape in zip(missing, shapes):
+            _shapeCache[(template, fallback, bodypart)] = shape
+    return [_shapeCache[key] for key in keys]
+
+
+def compileShape(template, fallback, human, bodypart):
+    return compileShapes([template], fallback, human, bodypart)[0]
+
+
+def clearShapeCache():
+    global _humanState
+    _shapeCache.clear()
+    _humanState = None
+
 #----------------------------------------------------------
 #   
 #----------------------------------------------------------
 
 def readFaceShapes(human, drivers, t0, t1):
-    shapeList = []
-    shapes = {}
-    t,dt = initTimes(drivers.keys(), 0.0, 1.0)
+    gui3d.app.progress(t0, text="Reading face shapes")
 
+    fnames = []
+    for name,value in drivers.items():
+        fname = value[0]
+        if fname not in fnames:
+            fnames.append(fname)
+    shapes = compileShapes(
+        ['shared/mhx/targets/body_language/${gender}-${age}/%s.target' % fname for fname in fnames],
+        "GenderAge",
+        human, 
+        "face")
+    shapes = dict(zip(fnames, shapes))
+
+    shapeList = []
+    loaded = set()
     for name,value in drivers.items():
         (fname, bone, channel, sign, min, max) = value
         if (name[-2:] in ["_L", "_R"]):
             lr = "LR"
             sname = name[:-2]
-            t += 2*dt
         else:
             lr = "Sym"
             sname = name
-            t += dt
-
-        try:
-            shape = shapes[fname]
-            doLoad = False
-        except:
-            doLoad = True
-        if doLoad:
-            gui3d.app.progress(t, text="Reading face shape %s" % fname)
-                
-            shape = warpmodifier.compileWarpTarget(
-                    'shared/mhx/targets/body_language/${gender}-${age}/%s.target' % fname, 
-                    "GenderAge",
-                    human, 
-                    "face")
-
-            shapes[fname] = shape                
-            shapeList.append((sname, shape, lr, min, max))
-    shapeList.sort()
+
+        if fname not in loaded:
+            loaded.add(fname)
+            shapeList.append((sname, shapes[fname], lr, min, max))
+    shapeList.sort(key = lambda item: item[0])
     return shapeList
         
 """
@@ -222,39 +250,26 @@ def readExpressions(human, t0, t1):
 """
 
 def readExpressionUnits(human, t0, t1):
-    shapeList = []
-    t,dt = initTimes(ExpressionUnits, 0.0, 1.0)
-    
-    for name in ExpressionUnits:
-        gui3d.app.progress(t, text="Reading expression %s" % name)
+    gui3d.app.progress(t0, text="Reading expressions")
 
-        shape = warpmodifier.compileWarpTarget(
-                'data/targets/expression/units/${ethnic}/${gender}_${age}/%s.target' % name,
-                "GenderAgeEthnic",
-                human, 
-                "face")
-
-        shapeList.append((name, shape))
-        t += dt
-    return shapeList
+    shapes = compileShapes(
+        ['data/targets/expression/units/${ethnic}/${gender}_${age}/%s.target' % name for name in ExpressionUnits],
+        "GenderAgeEthnic",
+        human, 
+        "face")
+    return zip(ExpressionUnits, shapes)
 
 
 def readCorrectives(drivers, human, folder, landmarks, t0, t1):
-    shapeList = []
-    t,dt = initTimes(drivers, 0.0, 1.0)
-    
-    for (pose, lr, expr, vars) in drivers:
-        gui3d.app.progress(t, text="Reading corrective %s %s" % (folder, pose))
-
-        shape = warpmodifier.compileWarpTarget(
-                "shared/mhx/targets/correctives/%s/caucasian/${gender}-${age}-${tone}-${weight}/%s.target" % (folder, pose),
-                'GenderAgeToneWeight',
-                human, 
-                landmarks)
-
-        shapeList.append((shape, pose, lr))
-        t += dt
-    return shapeList        
+    gui3d.app.progress(t0, text="Reading correctives %s" % folder)
+
+    shapes = compileShapes(
+        ["shared/mhx/targets/correctives/%s/caucasian/${gender}-${age}-${tone}-${weight}/%s.target" % (folder, pose) 
+            for (pose, lr, expr, vars) in drivers],
+        'GenderAgeToneWeight',
+        human, 
+        landmarks)
+    return [(shape, pose, lr) for ((pose, lr, expr, vars), shape) in zip(drivers, shapes)]        
 
 def readCorrective(human, part, pose):
     #for e in list(shape.items())[:10]:
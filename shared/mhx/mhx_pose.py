@@ -22,6 +22,7 @@ Abstract
 Pose
 """
 
+import numpy
 import log
 
 import mh2proxy
@@ -127,23 +128,26 @@ def writeShape(fp, pose, lr, shape, min, max, proxy, scale):
     if proxy:
         pshapes = mh2proxy.getProxyShapes([("shape",shape)], proxy, scale)
         if len(pshapes) > 0:
-            name,pshape = pshapes[0]
-            if len(pshape.keys()) > 0:
+            name,(pverts,pdeltas) = pshapes[0]
+            if len(pverts) > 0:
                 writeShapeHeader(fp, pose, lr, min, max)        
-                for (pv, dr) in pshape.items():
-                    (dx, dy, dz) = dr
-                    fp.write("  sv %d %.4f %.4f %.4f ;\n" %  (pv, dx, -dz, dy))
+                writeShapeVerts(fp, pverts, pdeltas)
                 fp.write("end ShapeKey\n")
                 return False          
     else:
+        verts,deltas = shape
         writeShapeHeader(fp, pose, lr, min, max)        
-        for (vn, dr) in shape.items():
-           fp.write("  sv %d %.4f %.4f %.4f ;\n" %  (vn, scale*dr[0], -scale*dr[2], scale*dr[1]))
+        writeShapeVerts(fp, verts, scale*deltas)
         fp.write("end ShapeKey\n")
         return False
     return True
 
 
+def writeShapeVerts(fp, verts, deltas):
+    rows = numpy.column_stack([verts, deltas[:,0], -deltas[:,2], deltas[:,1]])
+    exportutils.formatting.writeRows(fp, "  sv %d %.4f %.4f %.4f ;\n", rows)
+
+
 def writeShapeKeys(fp, amt, config, name, proxy):
 
     isHuman = ((not proxy) or proxy.type == 'Proxy')
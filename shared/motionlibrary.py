@@ -0,0 +1,343 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+A library of BVH motions with a binary cache.
+
+A folder of BVH files is scanned once: the motion of every file is parsed
+and stored as an array of channel data, and its frame count, frame rate and
+joints are kept in an index. Motions retargeted to a skeleton are cached
+too, keyed by the hash of the BVH file, the source and target rig, the
+retarget mapping and the scale. Cached arrays are memory mapped when a
+clip is loaded, so that the text of a BVH file is only parsed when the
+file changed.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+import mh
+import log
+import bvh
+import skeleton
+import animation
+
+# Cache directory, None for <home>/cache/motions
+CacheDir = None
+
+IndexVersion = 1
+
+def getCacheDir():
+    if CacheDir is None:
+        return os.path.join(mh.getPath(''), 'cache', 'motions')
+    return CacheDir
+
+def fileDigest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class MotionClip(object):
+    """
+    The index entry of a BVH file in a MotionLibrary.
+
+    - **self.name**: *string* The name of the clip, the file name without
+      extension.
+    - **self.path**: *string* The BVH file.
+    - **self.digest**: *string* SHA1 hash of the file.
+    - **self.frameCount**, **self.frameRate**, **self.duration**: The length
+      of the motion, in frames, frames per second and seconds.
+    - **self.joints**: *list of string* The joints of the BVH rig, in the order
+      of the file.
+    - **self.channelCount**: *int* The number of channels per frame.
+    """
+
+    def __init__(self, path, digest, mtime, size, frameCount, frameTime, joints, channelCount):
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.path = path
+        self.digest = digest
+        self.mtime = mtime
+        self.size = size
+        self.frameCount = frameCount
+        self.frameTime = frameTime
+        self.joints = joints
+        self.channelCount = channelCount
+
+    @property
+    def frameRate(self):
+        return 1.0 / self.frameTime
+
+    @property
+    def duration(self):
+        return self.frameCount * self.frameTime
+
+    def toDict(self):
+        return dict(digest = self.digest, mtime = self.mtime, size = self.size,
+                    frameCount = self.frameCount, frameTime = self.frameTime,
+                    joints = self.joints, channelCount = self.channelCount)
+
+    @classmethod
+    def fromDict(cls, path, d):
+        return cls(path, str(d['digest']), d['mtime'], d['size'], d['frameCount'],
+                   d['frameTime'], [str(j) for j in d['joints']], d['channelCount'])
+
+class MotionLibrary(object):
+    """
+    The BVH files below a folder, indexed and cached in cacheDir.
+    """
+
+    def __init__(self, folder, cacheDir = None):
+        self.folder = folder
+        self.cacheDir = cacheDir if cacheDir is not None else getCacheDir()
+        self.clips = {}             # Clips by path
+        self._loadIndex()
+
+    def __len__(self):
+        return len(self.clips)
+
+    def __iter__(self):
+        return iter(self.getClips())
+
+    def __contains__(self, name):
+        return self.getClip(name) is not None
+
+    def getClips(self):
+        return sorted(self.clips.values(), key = lambda clip: clip.path)
+
+    def getClip(self, name):
+        """
+        The clip with the given name or path, None if it is not in the
+        library.
+        """
+        path = os.path.normpath(os.path.abspath(name))
+        if path in self.clips:
+            return self.clips[path]
+        for clip in self.clips.values():
+            if clip.name == name:
+                return clip
+        return None
+
+    def _indexPath(self):
+        return os.path.join(self.cacheDir, 'index.json')
+
+    def _loadIndex(self):
+        filename = self._indexPath()
+        if not os.path.isfile(filename):
+            return
+        try:
+            with open(filename, 'r') as f:
+                index = json.load(f)
+            if index.get('version') != IndexVersion:
+                return
+            folder = os.path.join(os.path.abspath(self.folder), '')
+            for path, entry in index['clips'].items():
+                path = path.encode('utf-8')
+                if path.startswith(folder):
+                    self.clips[path] = MotionClip.fromDict(path, entry)
+        except (IOError, ValueError, KeyError):
+            log.warning('Could not read motion library index %s', filename, exc_info=True)
+
+    def _saveIndex(self):
+        # Keep the entries of other folders sharing the cache directory
+        filename = self._indexPath()
+        folder = os.path.join(os.path.abspath(self.folder), '')
+        clips = {}
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'r') as f:
+                    index = json.load(f)
+                if index.get('version') == IndexVersion:
+                    clips = dict((path, entry) for path, entry in index['clips'].items()
+                                 if not path.startswith(folder))
+            except (IOError, ValueError, KeyError):
+                pass
+        for path, clip in self.clips.items():
+            clips[path] = clip.toDict()
+        self._save(filename, lambda f: json.dump(dict(version = IndexVersion, clips = clips), f))
+
+    def _save(self, filename, write):
+        try:
+            if not os.path.isdir(self.cacheDir):
+                os.makedirs(self.cacheDir)
+            tmpname = filename + '.tmp'
+            with open(tmpname, 'wb') as f:
+                write(f)
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpname, filename)
+        except (IOError, OSError):
+            log.warning('Could not write motion cache %s', filename, exc_info=True)
+
+    def _channelPath(self, clip):
+        return os.path.join(self.cacheDir, clip.digest + '.npy')
+
+    def _trackPath(self, clip, sourceRig, targetRig, mappingDigest, scale):
+        return os.path.join(self.cacheDir, '%s_%s_%s_%s_%g.npy' % (clip.digest, sourceRig, targetRig, mappingDigest, scale))
+
+    def scan(self, progress = None):
+        """
+        Index and cache all BVH files below the folder of this library.
+        Only files that are new or were modified since the last scan are
+        parsed. Returns the number of files parsed.
+        """
+        filenames = []
+        for root, dirs, files in os.walk(self.folder):
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() == '.bvh':
+                    filenames.append(os.path.normpath(os.path.abspath(os.path.join(root, name))))
+
+        parsed = 0
+        found = set(filenames)
+        for path in self.clips.keys():
+            if path not in found:
+                del self.clips[path]
+
+        for i, path in enumerate(filenames):
+            if progress:
+                progress(float(i) / len(filenames))
+            stat = os.stat(path)
+            clip = self.clips.get(path)
+            if clip and clip.mtime == stat.st_mtime and clip.size == stat.st_size and \
+               os.path.isfile(self._channelPath(clip)):
+                continue
+            try:
+                self._addFile(path, stat)
+                parsed += 1
+            except Exception:
+                log.warning('Could not add %s to the motion library', path, exc_info=True)
+
+        self._saveIndex()
+        if progress:
+            progress(1.0)
+        return parsed
+
+    def _addFile(self, path, stat):
+        digest = fileDigest(path)
+        old = self.clips.get(path)
+        if old and old.digest == digest and os.path.isfile(self._channelPath(old)):
+            # Touched, but not changed
+            old.mtime, old.size = stat.st_mtime, stat.st_size
+            return old
+
+        bvhRig = bvh.load(path)
+        channels = bvhRig.getChannelData()
+        joints = [joint.name for joint in bvhRig.getJointsBVHOrder() if not joint.isEndConnector()]
+        clip = MotionClip(path, digest, stat.st_mtime, stat.st_size, bvhRig.frameCount,
+                          bvhRig.frameTime, joints, channels.shape[1])
+        self._save(self._channelPath(clip), lambda f: np.save(f, channels))
+        self.clips[path] = clip
+        return clip
+
+    def _getClip(self, clip):
+        if isinstance(clip, MotionClip):
+            return clip
+        result = self.getClip(clip)
+        if result is None:
+            if not os.path.isfile(clip):
+                raise KeyError('%s is not in the motion library' % clip)
+            # A file added after the last scan
+            path = os.path.normpath(os.path.abspath(clip))
+            result = self._addFile(path, os.stat(path))
+            self._saveIndex()
+        return result
+
+    def getChannelData(self, clip):
+        """
+        The channel data of a clip, as returned by BVH.getChannelData,
+        memory mapped from the cache.
+        """
+        clip = self._getClip(clip)
+        filename = self._channelPath(clip)
+        if os.path.isfile(filename):
+            try:
+                return np.load(filename, mmap_mode='r')
+            except (IOError, ValueError):
+                log.warning('Could not load motion cache %s', filename, exc_info=True)
+        stat = os.stat(clip.path)
+        clip = self._addFile(clip.path, stat)
+        self._saveIndex()
+        return np.load(self._channelPath(clip), mmap_mode='r')
+
+    def getBVH(self, clip, scale = 1.0):
+        """
+        A bvh.BVH of a clip. Only the hierarchy is read from the BVH file, the
+        motion comes from the cache.
+        """
+        clip = self._getClip(clip)
+        bvhRig = bvh.load(clip.path, channelData = self.getChannelData(clip))
+        if scale != 1.0:
+            bvhRig.scale(scale)
+        bvhRig.filename = clip.path
+        return bvhRig
+
+    def getAnimationTrack(self, clip, skel, targetRig, sourceRig = 'mb', scale = 1.0, name = None):
+        """
+        The motion of a clip retargeted from sourceRig to the skeleton skel
+        of targetRig, scaled by scale, as an AnimationTrack. The pose data is
+        memory mapped from the cache, it is only computed if the clip was not
+        retargeted to this rig and scale before.
+        """
+        clip = self._getClip(clip)
+        if name is None:
+            name = unicode(clip.name)
+
+        retarget = skeleton.getRetarget(sourceRig, targetRig, skel)
+        filename = self._trackPath(clip, sourceRig, targetRig, retarget.digest[:8], scale)
+        if os.path.isfile(filename):
+            try:
+                poseData = np.load(filename, mmap_mode='r')
+                return animation.AnimationTrack(name, poseData, clip.frameCount, clip.frameRate)
+            except (IOError, ValueError, RuntimeError):
+                log.warning('Could not load motion cache %s', filename, exc_info=True)
+
+        bvhRig = self.getBVH(clip, scale)
+        track = bvhRig.createAnimationTrack(retarget, name)
+        poseData = np.ascontiguousarray(track.data, dtype=np.float32)
+        self._save(filename, lambda f: np.save(f, poseData))
+        track.data = poseData
+        return track
+
+    def clearCache(self):
+        """
+        Remove all cached arrays of the clips of this library.
+        """
+        digests = set(clip.digest for clip in self.clips.values())
+        if os.path.isdir(self.cacheDir):
+            for name in os.listdir(self.cacheDir):
+                if name.endswith('.npy') and name.split('_')[0].split('.')[0] in digests:
+                    os.remove(os.path.join(self.cacheDir, name))
+        self.clips = {}
+        self._saveIndex()
+
+_libraries = {}
+
+def getMotionLibrary(folder):
+    """
+    The MotionLibrary of a folder, scanned on first use.
+    """
+    folder = os.path.normpath(os.path.abspath(folder))
+    if folder not in _libraries:
+        _libraries[folder] = MotionLibrary(folder)
+        _libraries[folder].scan()
+    return _libraries[folder]
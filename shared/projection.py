@@ -27,7 +27,11 @@ UV map creator
 
 """
 
+import os
+import shutil
+import hashlib
 import numpy as np
+from multiprocessing.pool import ThreadPool
 import gui3d
 import mh
 import log
@@ -42,36 +46,99 @@ def v4to3(v): #unused.
 def vnorm(v):
     return v / np.sqrt(np.sum(v ** 2, axis=-1))[...,None]
 
-class Shader(object):
-    pass
+# Size in pixels of the square screen tiles of the software rasterizer
+TileSize = 64
 
-class UvAlphaShader(Shader):
-    def __init__(self, dst, texture, uva):
-        self.dst = dst
-        self.texture = texture
-        self.size = np.array([texture.width, texture.height])
-        self.uva = uva
+# Number of threads rasterizing tiles, None for one per processor
+Threads = None
 
-    def shade(self, i, xy, uvw):
-        dst = self.dst.data[xy[...,1],xy[...,0]]
-        uva = np.sum(self.uva[i][None,None,:,:] * uvw[...,[1,2,0]][:,:,:,None], axis=2)
-        ix = np.floor(uva[:,:,:2] * self.size[None,None,:]).astype(int)
-        ix = np.minimum(ix, self.size - 1)
-        ix = np.maximum(ix, 0)
-        src = self.texture.data[ix[...,1], ix[...,0]]
-        a = uva[:,:,2]
-        return a[:,:,None] * (src.astype(float) - dst) + dst
+class Shader(object):
+    """
+    Computes the colors of a batch of pixels.
+    shade(i, xy, uvw) gets, for n pixels, the index of the triangle covering
+    each pixel, the (n,2) integer pixel coordinates and the (n,3) edge
+    function values, and returns the (n,components) pixel colors.
+    """
+    pass
 
 class ColorShader(Shader):
     def __init__(self, colors):
         self.colors = colors
 
     def shade(self, i, xy, uvw):
-        return np.sum(self.colors[i][None,None,:,:] * uvw[...,[1,2,0]][:,:,:,None], axis=2)
+        return np.sum(self.colors[i] * uvw[:,[1,2,0],None], axis=1)
+
+def binTriangles(cmin, cmax, width, height, tileSize = TileSize):
+    """
+    Assign triangles to the tiles of the screen their bounding boxes
+    overlap. Returns (tiles, starts, tris): the numbers of the tiles that
+    have triangles and, for tile tiles[k], the triangles
+    tris[starts[k]:starts[k+1]] in ascending order.
+    """
+    ntx = (width + tileSize - 1) / tileSize
+    nty = (height + tileSize - 1) / tileSize
+
+    valid = np.all(cmax > 0, axis=1) & (cmin[:,0] < width) & (cmin[:,1] < height) & np.all(cmax > cmin, axis=1)
+    tx0 = np.clip(cmin[:,0] / tileSize, 0, ntx - 1)
+    ty0 = np.clip(cmin[:,1] / tileSize, 0, nty - 1)
+    tx1 = np.clip((cmax[:,0] - 1) / tileSize, 0, ntx - 1)
+    ty1 = np.clip((cmax[:,1] - 1) / tileSize, 0, nty - 1)
+    nx = tx1 - tx0 + 1
+    count = np.where(valid, nx * (ty1 - ty0 + 1), 0)
+
+    tris = np.repeat(np.arange(len(cmin)), count)
+    k = np.arange(len(tris)) - np.repeat(np.cumsum(count) - count, count)
+    tile = (ty0[tris] + k / nx[tris]) * ntx + tx0[tris] + k % nx[tris]
+    del k
+
+    # A stable sort keeps the triangles of each tile in ascending order
+    order = np.argsort(tile, kind='mergesort')
+    tile = tile[order]
+    tris = tris[order]
+    tiles, starts = np.unique(tile, return_index=True)
+    return tiles, np.append(starts, len(tile)), tris
+
+def rasterizeTile(dst, perp, base, cmin, cmax, shader, tris, x0, y0, x1, y1):
+    """
+    Rasterize triangles tris into the tile (x0, y0)-(x1, y1) of dst.
+    The edge functions are evaluated at once for all pixels of the bounding
+    boxes of the triangles within the tile. Where triangles overlap, the one
+    with the highest index is drawn.
+    """
+    bx0 = np.maximum(cmin[tris,0], x0)
+    by0 = np.maximum(cmin[tris,1], y0)
+    bw = np.maximum(np.minimum(cmax[tris,0], x1) - bx0, 0)
+    bh = np.maximum(np.minimum(cmax[tris,1], y1) - by0, 0)
+    count = bw * bh
+
+    t = np.repeat(np.arange(len(tris)), count)
+    k = np.arange(len(t)) - np.repeat(np.cumsum(count) - count, count)
+    ixy = np.column_stack((bx0[t] + k % bw[t], by0[t] + k / bw[t]))
+    del k
+
+    i = tris[t]
+    uvw = np.sum(perp[i] * (ixy + 0.5)[:,None,:], axis=-1) - base[i]
+    inside = np.all(uvw > 0, axis=-1)
+    i, ixy, uvw = i[inside], ixy[inside], uvw[inside]
+    if len(i) == 0:
+        return
+
+    # Keep the last triangle drawn at each pixel
+    pixel = (ixy[:,1] - y0) * (x1 - x0) + (ixy[:,0] - x0)
+    _, last = np.unique(pixel[::-1], return_index=True)
+    last = len(pixel) - 1 - last
+    i, ixy, uvw = i[last], ixy[last], uvw[last]
+
+    col = shader.shade(i, ixy, uvw)
+    dst.data[ixy[:,1],ixy[:,0],:] = col
 
 def RasterizeTriangles(dst, coords, shader, progress = None):
     """
     Software rasterizer.
+    Triangles are binned into square tiles of the destination image, each
+    tile is rasterized for all its triangles at once and tiles are processed
+    by a pool of threads.
+    The shader is called once per tile with all pixels covered in it.
     """
     delta = coords - coords[:,[1,2,0],:]
     perp = np.concatenate((delta[:,:,1,None], -delta[:,:,0,None]), axis=-1)
@@ -82,23 +149,24 @@ def RasterizeTriangles(dst, coords, shader, progress = None):
     cmin = np.floor(np.amin(coords, axis=1)).astype(int)
     cmax = np.ceil( np.amax(coords, axis=1)).astype(int)
 
-    minx = cmin[:,0]
-    maxx = cmax[:,0]
-    miny = cmin[:,1]
-    maxy = cmax[:,1]
-
-    for i in xrange(len(coords)):
-        if progress is not None and i % 100 == 0:
-            progress(i, len(coords))
-
-        ixy = np.mgrid[miny[i]:maxy[i],minx[i]:maxx[i]].transpose([1,2,0])[:,:,::-1]
-        xy = ixy + 0.5
-        uvw = np.sum(perp[i,None,None,:,:] * xy[:,:,None,:], axis=-1) - base[i,None,None,:]
-        mask = np.all(uvw > 0, axis=-1)
-        col = shader.shade(i, ixy, uvw)
-        # log.debug('dst: %s', dst.data[miny[i]:maxy[i],minx[i]:maxx[i]].shape)
-        # log.debug('src: %s', col.shape)
-        dst.data[miny[i]:maxy[i],minx[i]:maxx[i],:][mask] = col[mask]
+    height, width = dst.data.shape[:2]
+    ntx = (width + TileSize - 1) / TileSize
+    tiles, starts, tris = binTriangles(cmin, cmax, width, height)
+
+    def work(k):
+        ty, tx = divmod(tiles[k], ntx)
+        x0, y0 = tx * TileSize, ty * TileSize
+        x1, y1 = min(x0 + TileSize, width), min(y0 + TileSize, height)
+        rasterizeTile(dst, perp, base, cmin, cmax, shader, tris[starts[k]:starts[k+1]], x0, y0, x1, y1)
+
+    pool = ThreadPool(Threads)
+    try:
+        for i, _ in enumerate(pool.imap_unordered(work, xrange(len(tiles)))):
+            if progress is not None and i % 16 == 0:
+                progress(i, len(tiles))
+    finally:
+        pool.close()
+        pool.join()
 
 def getCamera(mesh):
     ex, ey, ez = gui3d.app.modelCamera.eye
@@ -129,49 +197,34 @@ def mapImageSoft(srcImg, mesh, leftTop, rightBottom):
     srcImg = srcImg.convert(dstImg.components)
 
     camera = getCamera(mesh)
-    faces = getFaces(mesh)
-
-    # log.debug('matrix: %s', gui3d.app.modelCamera.getConvertToScreenMatrix())
-
-    texco = np.asarray([0,dstH])[None,None,:] + mesh.texco[mesh.fuvs[faces]] * np.asarray([dstW,-dstH])[None,None,:]
-    matrix = np.asarray(gui3d.app.modelCamera.getConvertToScreenMatrix(mesh))
-    coord = np.concatenate((mesh.coord[mesh.fvert[faces]], np.ones((len(faces),4,1))), axis=-1)
-    # log.debug('texco: %s, coord: %s', texco.shape, coord.shape)
-    coord = np.sum(matrix[None,None,:,:] * coord[:,:,None,:], axis = -1)
-    # log.debug('coord: %s', coord.shape)
-    coord = coord[:,:,:2] / coord[:,:,3:]
-    # log.debug('coord: %s', coord.shape)
-    # log.debug('coords: %f-%f, %f-%f',
-    #           np.amin(coord[...,0]), np.amax(coord[...,0]),
-    #           np.amin(coord[...,1]), np.amax(coord[...,1]))
-    # log.debug('rect: %s %s', leftTop, rightBottom)
-    coord -= np.asarray([leftTop[0], leftTop[1]])[None,None,:]
-    coord /= np.asarray([rightBottom[0] - leftTop[0], rightBottom[1] - leftTop[1]])[None,None,:]
-    alpha = np.sum(mesh.vnorm[mesh.fvert[faces]] * camera[None,None,:], axis=-1)
-    alpha = np.maximum(0, alpha)
-    # alpha[...] = 1 # debug
-    # log.debug('alpha: %s', alpha.shape)
-    # log.debug('coords: %f-%f, %f-%f',
-    #           np.amin(coord[...,0]), np.amax(coord[...,0]),
-    #           np.amin(coord[...,1]), np.amax(coord[...,1]))
-    uva = np.concatenate((coord, alpha[...,None]), axis=-1)
-    # log.debug('uva: %s', uva.shape)
-    valid = np.any(alpha >= 0, axis=1)
-    # log.debug('valid: %s', valid.shape)
-    texco = texco[valid,:,:]
-    uva = uva[valid,:,:]
 
-    # log.debug('%s %s', texco.shape, uva.shape)
+    def progress(i, n):
+        gui3d.app.progress(0.5 * i / n)
 
-    def progress(base, i, n):
-        gui3d.app.progress(base + 0.5 * i / n)
-
-    # log.debug('src: %s, dst: %s', srcImg.data.shape, dstImg.data.shape)
+    coverage = getUVCoverage(mesh, dstW, dstH, progress = progress)
 
     log.debug("mapImage: begin render")
 
-    RasterizeTriangles(dstImg, texco[:,[0,1,2],:], UvAlphaShader(dstImg, srcImg, uva[:,[0,1,2],:]), progress = lambda i,n: progress(0.0,i,n))
-    RasterizeTriangles(dstImg, texco[:,[2,3,0],:], UvAlphaShader(dstImg, srcImg, uva[:,[2,3,0],:]), progress = lambda i,n: progress(0.5,i,n))
+    # Screen position and facing of every vertex
+    m = np.asarray(gui3d.app.modelCamera.getConvertToScreenMatrix(mesh))
+    coord = np.concatenate((mesh.coord, np.ones((len(mesh.coord),1))), axis=-1)
+    coord = np.dot(coord, m.T)
+    coord = coord[:,:2] / coord[:,3:]
+    coord -= np.asarray([leftTop[0], leftTop[1]])[None,:]
+    coord /= np.asarray([rightBottom[0] - leftTop[0], rightBottom[1] - leftTop[1]])[None,:]
+    alpha = np.sum(mesh.vnorm * camera[None,:], axis=-1)
+    alpha = np.maximum(0, alpha)
+    uva = coverage.shade(np.concatenate((coord, alpha[:,None]), axis=-1))
+
+    size = np.array([srcImg.width, srcImg.height])
+    ix = np.floor(uva[:,:2] * size[None,:]).astype(int)
+    ix = np.minimum(ix, size - 1)
+    ix = np.maximum(ix, 0)
+    src = srcImg.data[ix[:,1], ix[:,0]]
+
+    dst = dstImg.data.reshape(-1, dstImg.components)
+    col = dst[coverage.pixels]
+    dst[coverage.pixels] = uva[:,2,None] * (src.astype(float) - col) + col
     gui3d.app.progress(1.0)
 
     log.debug("mapImage: end render")
@@ -218,79 +271,319 @@ def mapImage(imgMesh, mesh, leftTop, rightBottom):
     else:
         return mapImageSoft(mh.Image(imgMesh.getTexture()), mesh, leftTop, rightBottom)
 
-def fixSeams(img):
+def seamNeighbors(covered):
+    """
+    The pixels of a (h,w) coverage mask that are not covered but have a
+    covered neighbor, and the flat indices of their 3x3 neighborhoods,
+    wrapping around the image borders.
+    Returns (pixels, neighbors) with shapes (n,) and (n,9).
+    """
+    h, w = covered.shape
+    near = np.zeros(covered.shape, dtype=bool)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            near |= np.roll(np.roll(covered, dy, axis=0), dx, axis=1)
+    y, x = np.nonzero(near & ~covered)
+    dy, dx = np.mgrid[1:-2:-1,1:-2:-1]
+    ny = (y[:,None] + dy.ravel()[None,:]) % h
+    nx = (x[:,None] + dx.ravel()[None,:]) % w
+    return y * w + x, ny * w + nx
+
+def fixSeams(img, coverage = None):
+    """
+    Fill the transparent pixels next to opaque ones with the alpha weighted
+    average of their neighbors, so that texture filtering does not bleed
+    the background in at UV seams.
+    When the UVCoverage the image was baked with is given, its cached seam
+    neighborhoods are used instead of searching the image.
+    """
     h,w,c = img.data.shape
-    neighbors = np.empty((3,3,h,w,c), dtype=np.uint8)
-
-    neighbors[1,1,:,:,:] = img.data
+    flat = img.data.reshape(-1, c)
 
-    neighbors[1,0,:,:,:] = np.roll(neighbors[1,1,:,:,:], -1, axis=-2)
-    neighbors[1,2,:,:,:] = np.roll(neighbors[1,1,:,:,:],  1, axis=-2)
-
-    neighbors[0,:,:,:,:] = np.roll(neighbors[1,:,:,:,:], -1, axis=-3)
-    neighbors[2,:,:,:,:] = np.roll(neighbors[1,:,:,:,:],  1, axis=-3)
-
-    chroma = neighbors[...,:-1]
-    alpha = neighbors[...,-1]
-
-    chroma_f = chroma.reshape(9,h,w,c-1)
-    alpha_f = alpha.reshape(9,h,w)
+    if coverage is not None and (coverage.width, coverage.height) == (w, h):
+        pixels, neighbors = coverage.seamPixels, coverage.seamNeighbors
+    else:
+        pixels, neighbors = seamNeighbors(img.data[...,-1] != 0)
 
-    border = np.logical_and(alpha[1,1,:,:] == 0, np.any(alpha_f[:,:,:] != 0, axis=0))
+    alpha = flat[neighbors,-1].astype(np.float32)
+    border = (flat[pixels,-1] == 0) & np.any(alpha != 0, axis=1)
+    pixels = pixels[border]
+    neighbors = neighbors[border]
+    alpha = alpha[border]
 
-    alpha_f = alpha_f.astype(np.float32)[...,None]
-    fill = np.sum(chroma_f[:,:,:,:] * alpha_f[:,:,:,:], axis=0) / np.sum(alpha_f[:,:,:,:], axis=0)
+    chroma = np.zeros((len(pixels), c-1), dtype=np.float32)
+    total = np.zeros(len(pixels), dtype=np.float32)
+    for k in xrange(neighbors.shape[1]):
+        chroma += flat[neighbors[:,k],:-1] * alpha[:,k,None]
+        total += alpha[:,k]
+    fill = chroma / total[:,None]
 
-    img.data[...,:-1][border] = fill.astype(np.uint8)[border]
-    img.data[...,-1:][border] = 255
+    flat[pixels,:-1] = fill.astype(np.uint8)
+    flat[pixels,-1] = 255
 
-def mapLightingSoft(lightpos = (-10.99, 20.0, 20.0), progressCallback = None):
+class CoverageShader(Shader):
     """
-    Create a lightmap for the selected human (software renderer).
+    Records the triangle and the barycentric weights of its corners at each
+    pixel instead of a color.
     """
 
-    mesh = gui3d.app.selectedHuman.mesh
+    def shade(self, i, xy, uvw):
+        return np.column_stack((i, uvw[:,[1,2,0]]))
 
-    W = 1024
-    H = 1024
-    
-    dstImg = mh.Image(width=W, height=H, components=4)
-    dstImg.data[...] = 0
+class UVCoverage(object):
+    """
+    The rasterization of the UV layout of a mesh: for every texel covered by
+    a face, the face, the vertices of the triangle of the face it lies in
+    and the barycentric weights of these vertices, the seam neighborhoods
+    used by fixSeams and the texels on the edges of the UV layout.
+    Any per vertex quantity can then be baked to a texture with a gather and
+    weighted sum, without rasterizing again.
+
+    The arrays are computed when first used. If a cache directory is given,
+    they are stored there as .npy files and later memory mapped from it.
+
+    - **self.pixels**: *int array (n,)* The covered texels, as y * width + x.
+    - **self.faces**: *int array (n,)* The face covering each texel.
+    - **self.verts**: *int array (n,3)* The triangle vertices at each texel.
+    - **self.weights**: *float array (n,3)* Their barycentric weights.
+    - **self.seamPixels**, **self.seamNeighbors**: *int arrays (m,), (m,9)*
+      The uncovered texels next to covered ones and their neighborhoods.
+    - **self.edges**: *int array (k,)* The texels on the edges of the faces.
+    """
 
-    delta = lightpos - mesh.coord
+    def __init__(self, mesh, width, height, faces, path = None):
+        self.mesh = mesh
+        self.width = width
+        self.height = height
+        self.faceList = faces
+        self.path = path
+        self.progress = None
+        self._arrays = {}
+
+    def _get(self, name, compute):
+        if name in self._arrays:
+            return self._arrays[name]
+
+        if self.path is not None:
+            filename = os.path.join(self.path, name + '.npy')
+            if os.path.isfile(filename):
+                try:
+                    self._arrays[name] = np.load(filename, mmap_mode='r')
+                    _touch(self.path)
+                    return self._arrays[name]
+                except (IOError, ValueError):
+                    log.warning('Could not load UV cache %s', filename, exc_info=True)
+
+        arrays = compute()
+        for key, array in arrays.items():
+            self._arrays[key] = array
+            if self.path is not None:
+                self._save(key, array)
+        return self._arrays[name]
+
+    def _save(self, name, array):
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+                pruneCache(os.path.dirname(self.path), self.path)
+            filename = os.path.join(self.path, name + '.npy')
+            tmpname = filename + '.tmp'
+            with open(tmpname, 'wb') as f:
+                np.save(f, array)
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpname, filename)
+        except (IOError, OSError):
+            log.warning('Could not write UV cache %s', self.path, exc_info=True)
+
+    def _rasterize(self):
+        mesh = self.mesh
+        faces = self.faceList
+        nFaces = len(faces)
+        width, height = self.width, self.height
+
+        log.debug('UVCoverage: rasterizing UV map %dx%d', width, height)
+
+        coords = np.asarray([0,height])[None,None,:] + mesh.texco[mesh.fuvs[faces]] * np.asarray([width,-height])[None,None,:]
+        # Both halves of the quads, the second half is drawn after the first
+        coords = np.concatenate((coords[:,[0,1,2],:], coords[:,[2,3,0],:]))
+
+        dst = mh.Image(data = np.zeros((height, width, 4), dtype=np.float64))
+        dst.data[...,0] = -1
+        RasterizeTriangles(dst, coords, CoverageShader(), self.progress)
+
+        tri = dst.data[...,0].ravel()
+        pixels = np.flatnonzero(tri >= 0)
+        tri = tri[pixels].astype(np.int32)
+        corners = np.array([[0,1,2],[2,3,0]])[tri / nFaces]
+        faceIdx = faces[tri % nFaces]
+        verts = mesh.fvert[faceIdx[:,None], corners].astype(np.int32)
+        weights = dst.data[...,1:].reshape(-1, 3)[pixels]
+        return dict(pixels = pixels, faces = faceIdx, verts = verts, weights = weights)
+
+    def _seams(self):
+        covered = np.zeros(self.width * self.height, dtype=bool)
+        covered[self.pixels] = True
+        pixels, neighbors = seamNeighbors(covered.reshape(self.height, self.width))
+        return dict(seamPixels = pixels, seamNeighbors = neighbors)
+
+    def _edges(self):
+        dstImg = mh.Image(data = np.zeros((self.height, self.width, 1), dtype=np.uint8))
+        hedges, hdelta, vedges, vdelta = getUVEdges(self.mesh, self.faceList, self.width, self.height)
+        rasterizeHLines(dstImg, hedges, hdelta)
+        rasterizeVLines(dstImg, vedges, vdelta)
+        return dict(edges = np.flatnonzero(dstImg.data))
+
+    pixels = property(lambda self: self._get('pixels', self._rasterize))
+    faces = property(lambda self: self._get('faces', self._rasterize))
+    verts = property(lambda self: self._get('verts', self._rasterize))
+    weights = property(lambda self: self._get('weights', self._rasterize))
+    seamPixels = property(lambda self: self._get('seamPixels', self._seams))
+    seamNeighbors = property(lambda self: self._get('seamNeighbors', self._seams))
+    edges = property(lambda self: self._get('edges', self._edges))
+
+    def shade(self, values):
+        """
+        Interpolate per vertex values, of shape (nVerts,) + shape, at the
+        covered texels. Returns an array of shape (nTexels,) + shape.
+        """
+        values = np.asarray(values)
+        weights = self.weights.reshape(self.weights.shape + (1,) * (values.ndim - 1))
+        return np.sum(values[self.verts] * weights, axis=1)
+
+    def image(self, values, components, dtype = np.uint8):
+        """
+        Bake per texel values into an image array of the size of the UV
+        map, uncovered texels are 0.
+        """
+        data = np.zeros((self.height * self.width, components), dtype=dtype)
+        data[self.pixels] = np.asarray(values).reshape(len(self.pixels), components)
+        return data.reshape(self.height, self.width, components)
+
+_coverageCache = {}
+
+# Number of UV layouts kept in memory
+CoverageCacheSize = 4
+
+# Directory of the persistent UV layout cache, None for the default
+CacheDir = None
+
+# Number of UV layouts kept in the cache directory
+CacheDirSize = 16
+
+def getCacheDir():
+    if CacheDir is None:
+        return os.path.join(mh.getPath(''), 'cache', 'uvmaps')
+    return CacheDir
+
+def _touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+def pruneCache(cacheDir, keep = None, size = None):
+    """
+    Remove the least recently used UV layouts from cacheDir, so that at most
+    size (CacheDirSize by default) of them are left. The layout in the
+    directory keep is never removed.
+    """
+    if size is None:
+        size = CacheDirSize
+    try:
+        entries = [os.path.join(cacheDir, name) for name in os.listdir(cacheDir)]
+        entries = [(os.path.getmtime(path), path) for path in entries
+                   if os.path.isdir(path) and path != keep]
+    except OSError:
+        log.warning('Could not read UV cache %s', cacheDir, exc_info=True)
+        return
+    if keep is not None:
+        size -= 1
+    entries.sort(reverse = True)
+    for _, path in entries[max(size, 0):]:
+        log.debug('Removing UV cache %s', path)
+        shutil.rmtree(path, True)
+
+def getUVCoverage(mesh, width, height, faces = None, progress = None):
+    """
+    The UVCoverage of mesh for a texture of width x height.
+    Coverages are identified by a hash of the faces and UV map of the mesh,
+    they are kept in memory and in the cache directory, so that a UV layout
+    is only rasterized once.
+    """
+    if faces is None:
+        faces = getFaces(mesh)
+    digest = hashlib.sha1()
+    for array in (faces, mesh.fvert[faces], mesh.fuvs[faces], mesh.texco):
+        digest.update(np.ascontiguousarray(array).data)
+    key = '%s_%dx%d' % (digest.hexdigest(), width, height)
+
+    if key not in _coverageCache:
+        if len(_coverageCache) >= CoverageCacheSize:
+            _coverageCache.clear()
+        _coverageCache[key] = UVCoverage(mesh, width, height, faces, os.path.join(getCacheDir(), key))
+    coverage = _coverageCache[key]
+    coverage.progress = progress
+    return coverage
+
+def lambertShading(mesh, lightpositions):
+    """
+    The per vertex Lambert shading of mesh by each of the point lights at
+    lightpositions, as a (nLights, nVerts) uint8 array.
+    """
+    lightpositions = np.asarray(lightpositions, dtype=np.float64).reshape(-1, 3)
+    delta = lightpositions[:,None,:] - mesh.coord[None,:,:]
     ld = vnorm(delta)
     del delta
-    s = np.sum(ld * mesh.vnorm, axis=-1)
+    s = np.sum(ld * mesh.vnorm[None,:,:], axis=-1)
     del ld
-    s = np.maximum(0, np.minimum(255, (s * 256))).astype(np.uint8)
-    mesh.color[...,:3] = s[...,None]
-    mesh.color[...,3] = 255
-    del s
+    return np.maximum(0, np.minimum(255, (s * 256))).astype(np.uint8)
+
+def mapLightingBatch(meshes, lightpositions, width = 1024, height = 1024, progressCallback = None):
+    """
+    Create lightmaps for several meshes and lights (software renderer).
+    The UV rasterization of each mesh is cached, so that every lightmap
+    only takes a gather and blend of the per vertex shading.
+    Returns, for each mesh, a list with a lightmap per light.
+    """
+    result = []
+    for m, mesh in enumerate(meshes):
+        def progress(i, n):
+            if progressCallback is not None:
+                progressCallback((m + float(i) / n) / len(meshes))
+
+        coverage = getUVCoverage(mesh, width, height, progress = progress)
+        lightmaps = []
+        for s in lambertShading(mesh, lightpositions):
+            texels = np.empty((len(coverage.pixels), 4), dtype=np.uint8)
+            texels[:,:3] = coverage.shade(s.astype(np.float64))[:,None]
+            texels[:,3] = 255
+            dstImg = mh.Image(data = coverage.image(texels, 4))
+            fixSeams(dstImg, coverage)
+            lightmaps.append(dstImg)
+        result.append(lightmaps)
+    return result
 
-    faces = getFaces(mesh)
+def mapLightingSoft(lightpos = (-10.99, 20.0, 20.0), progressCallback = None):
+    """
+    Create a lightmap for the selected human (software renderer).
+    """
 
-    coords = np.asarray([0,H])[None,None,:] + mesh.texco[mesh.fuvs[faces]] * np.asarray([W,-H])[None,None,:]
-    colors = mesh.color[mesh.fvert[faces]]
-    # log.debug("mapLighting: %s %s %s", faces.shape, coords.shape, colors.shape)
+    mesh = gui3d.app.selectedHuman.mesh
 
     log.debug("mapLighting: begin render")
 
-    def progress(base, i, n):
+    def progress(prog):
         if progressCallback == None:
-            gui3d.app.progress(base + 0.5 * i / n, "Projecting lightmap")
+            gui3d.app.progress(prog, "Projecting lightmap")
         else:
-            progressCallback(base + 0.5 * i / n)
+            progressCallback(prog)
 
-    RasterizeTriangles(dstImg, coords[:,[0,1,2],:], ColorShader(colors[:,[0,1,2],:]), progress = lambda i,n: progress(0.0,i,n))
-    RasterizeTriangles(dstImg, coords[:,[2,3,0],:], ColorShader(colors[:,[2,3,0],:]), progress = lambda i,n: progress(0.5,i,n))
+    dstImg = mapLightingBatch([mesh], [lightpos], 1024, 1024, progress)[0][0]
     gui3d.app.progress(1.0)
 
-    fixSeams(dstImg)
-
     log.debug("mapLighting: end render")
 
-    mesh.setColor([255, 255, 255, 255])
-
     return dstImg
 
 def mapLightingGL(lightpos = (-10.99, 20.0, 20.0)):
@@ -352,7 +645,13 @@ def mapSceneLighting(scn, progressCallback = None):
             pass
 
     lnum = float(len(scn.lights))
-    if (lnum>0):    # Add up all the lightmaps.
+    if (lnum>0 and not mh.hasRenderSkin()):
+        # Bake all lights from the same UV rasterization
+        mesh = gui3d.app.selectedHuman.mesh
+        lmaps = mapLightingBatch([mesh], [light.position for light in scn.lights], progressCallback = progress)[0]
+        data = np.sum([lmap.data.astype(int) for lmap in lmaps], axis=0)
+        return image_operations.clipped(mh.Image(data = data))
+    elif (lnum>0):    # Add up all the lightmaps.
         lmap = mapLighting(scn.lights[0].position, lambda p: progress(p/lnum))
         i = 1.0        
         for light in scn.lights[1:]:
@@ -384,12 +683,14 @@ def rasterizeHLines(dstImg, edges, delta, progress = None):
 
     data = dstImg.data[::-1]
 
-    for i in xrange(len(x0)):
-        if progress is not None and i % 100 == 0:
-            progress(i, len(x0))
-        x = np.arange(x0[i], x1[i])
-        y = m[i] * (x + 0.5) + c[i]
-        data[np.floor(y).astype(int),x,:] = 255
+    # All pixels of all lines at once
+    count = np.maximum(x1 - x0, 0)
+    i = np.repeat(np.arange(len(x0)), count)
+    x = x0[i] + np.arange(len(i)) - np.repeat(np.cumsum(count) - count, count)
+    y = m[i] * (x + 0.5) + c[i]
+    data[np.floor(y).astype(int),x,:] = 255
+    if progress is not None:
+        progress(len(x0), len(x0))
 
 def rasterizeVLines(dstImg, edges, delta, progress = None):
     flip = delta[:,1] < 0
@@ -412,33 +713,22 @@ def rasterizeVLines(dstImg, edges, delta, progress = None):
 
     data = dstImg.data[::-1]
 
-    for i in xrange(len(y0)):
-        if progress is not None and i % 100 == 0:
-            progress(i, len(y0))
-        y = np.arange(y0[i], y1[i]) + 0.5
-        x = m[i] * y + c[i]
-        data[y.astype(int),np.floor(x).astype(int),:] = 255
+    # All pixels of all lines at once
+    count = np.maximum(y1 - y0, 0)
+    i = np.repeat(np.arange(len(y0)), count)
+    y = y0[i] + np.arange(len(i)) - np.repeat(np.cumsum(count) - count, count) + 0.5
+    x = m[i] * y + c[i]
+    data[y.astype(int),np.floor(x).astype(int),:] = 255
+    if progress is not None:
+        progress(len(y0), len(y0))
 
-def mapUVSoft():
+def getUVEdges(mesh, faces, W, H):
     """
-    Project the UV map topology of the selected human mesh onto a texture 
-    (software rasterizer).
+    The edges of the UV layout of faces in a W x H texture, split in mostly
+    horizontal and mostly vertical ones, as (hedges, hdelta, vedges, vdelta)
+    for rasterizeHLines and rasterizeVLines.
     """
-
-    mesh = gui3d.app.selectedHuman.mesh
-
-    W = 2048
-    H = 2048
-    
-    dstImg = mh.Image(width=W, height=H, components=3)
-    dstImg.data[...] = 0
-
-    faces = getFaces(mesh)
-
-    log.debug("mapUV: begin setup")
-
     fuvs = mesh.fuvs[faces]
-    del faces
     edges = np.array([fuvs, np.roll(fuvs, 1, axis=-1)]).transpose([1,2,0]).reshape((-1,2))
     del fuvs
     edges = np.where((edges[:,0] < edges[:,1])[:,None], edges, edges[:,::-1])
@@ -451,22 +741,28 @@ def mapUVSoft():
 
     delta = edges[:,1,:] - edges[:,0,:]
     vertical = np.abs(delta[:,1]) > np.abs(delta[:,0])
-    horizontal = -vertical
+    horizontal = ~vertical
 
-    hdelta = delta[horizontal]
-    vdelta = delta[vertical]
-    del delta
-    hedges = edges[horizontal]
-    vedges = edges[vertical]
-    del edges, horizontal, vertical
+    return edges[horizontal], delta[horizontal], edges[vertical], delta[vertical]
 
-    log.debug("mapUV: begin render")
+def mapUVSoft():
+    """
+    Project the UV map topology of the selected human mesh onto a texture 
+    (software rasterizer).
+    """
+
+    mesh = gui3d.app.selectedHuman.mesh
 
-    def progress(base, i, n):
-        gui3d.app.progress(base + 0.5 * i / n, "Projecting UV map")
+    W = 2048
+    H = 2048
+    
+    dstImg = mh.Image(width=W, height=H, components=3)
+    dstImg.data[...] = 0
+
+    log.debug("mapUV: begin render")
 
-    rasterizeHLines(dstImg, hedges, hdelta, progress = lambda i,n: progress(0.0,i,n))
-    rasterizeVLines(dstImg, vedges, vdelta, progress = lambda i,n: progress(0.5,i,n))
+    coverage = getUVCoverage(mesh, W, H)
+    dstImg.data.reshape(-1, 3)[coverage.edges] = 255
     gui3d.app.progress(1.0)
 
     log.debug("mapUV: end render")
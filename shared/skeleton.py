@@ -34,6 +34,7 @@ assignments.
 import math
 from math import pi
 
+import hashlib
 import numpy as np
 import numpy.linalg as la
 import transformations as tm
@@ -76,50 +77,28 @@ class Skeleton(object):
         # TODO the .rig file parser does not belong in exportutils package (it is an importer...)
         import exportutils.rig
 
-        joints, bones, vertexWeights = exportutils.rig.readRigFile(filename, mesh)
+        # The rig file is compiled once, fitting it to the mesh only takes a few array operations
+        rig = exportutils.rig.getCompiledRig(filename, mesh)
+        locations = rig.evaluate(mesh)
         # TODO exportutils.rig uses mh2proxy.calcJointPosition(). I would prefer something like Skeleton.getHumanJointPosition()
 
-        for boneName, headPos, tailPos, roll, parentName, _ in bones:
+        for boneName, headPos, tailPos, roll, parentName, _ in rig.getArmature(locations):
             if not parentName or parentName == "-":
                 parentName = None
             self.addBone(boneName, parentName, headPos, tailPos, roll)
 
         self.build()
 
-        # Normalize weights and put them in np format
-        boneWeights = {}
-        wtot = np.zeros(mesh.getVertexCount(), np.float32)
-        for vgroup in vertexWeights.values():
-            for vn,w in vgroup:
-                wtot[vn] += w
-
-        for bname,vgroup in vertexWeights.items():
-            weights = np.zeros(len(vgroup), np.float32)
-            verts = []
-            n = 0
-            for vn,w in vgroup:
-                verts.append(vn)
-                weights[n] = w/wtot[vn]
-                n += 1
-            boneWeights[bname] = (verts, weights)
+        # Normalize weights
+        boneWeights, unweighted = rig.getBoneWeights(mesh.getVertexCount())
 
         # Assign unweighted vertices to root bone with weight 1
         rootBone = self.roots[0].name
-        informed = False
-        if rootBone not in boneWeights.keys():
-            boneWeights[rootBone] = ([], [])
-        else:
-            vs,ws = boneWeights[rootBone]
-            boneWeights[rootBone] = (list(vs), list(ws))
-        vs,ws = boneWeights[rootBone]
-        for vIdx, wCount in enumerate(wtot):
-            if wCount == 0:
-                vs.append(vIdx)
-                ws.append(1.0)
-                if not informed:
-                    log.debug("Adding trivial bone weights to bone %s for unweighted vertices.", rootBone)
-                    informed = True
-        boneWeights[rootBone] = (vs, np.asarray(ws, dtype=np.float32))
+        if len(unweighted):
+            log.debug("Adding trivial bone weights to bone %s for unweighted vertices.", rootBone)
+        vs, ws = boneWeights.get(rootBone, (np.zeros(0, np.int32), np.zeros(0, np.float32)))
+        boneWeights[rootBone] = (np.hstack([vs, unweighted]).astype(np.int32),
+                                 np.hstack([ws, np.ones(len(unweighted), np.float32)]).astype(np.float32))
 
         return boneWeights
 
@@ -204,6 +183,94 @@ class Skeleton(object):
 
         return coords
 
+    def getPoseLocalMatrices(self, poseData):
+        """
+        Calculate the transformation of every bone relative to its parent
+        (matRestRelative * matPose) for a series of poses at once, without
+        changing the pose of this skeleton.
+
+        poseData    np.array((nFrames*nBones, 4, 4))
+            pose matrices ordered per frame - per bone, as in an
+            AnimationTrack
+
+        returns     np.array((nFrames, nBones, 4, 4))
+        """
+        bones = self.getBones()
+        nBones = len(bones)
+        poseData = np.asarray(poseData, dtype=np.float64).reshape(-1, nBones, 4, 4)
+        nFrames = len(poseData)
+
+        matLocal = np.empty((nFrames, nBones, 4, 4))
+        matPose = np.zeros((nFrames, 4, 4))
+        for bIdx, bone in enumerate(bones):
+            # Same as setPose() and Bone.update(), for all frames
+            invRest = la.inv(bone.matRestGlobal)
+            matPose[:] = 0
+            matPose[:,:3,:3] = poseData[:,bIdx,:3,:3]
+            matPose[:,3,3] = 1
+            pose = np.einsum('ij,fjk,kl->fil', invRest, matPose, bone.matRestGlobal)
+            pose[:,:3,3] = poseData[:,bIdx,:3,3]
+            matLocal[:,bIdx] = np.einsum('ij,fjk->fik', bone.matRestRelative, pose)
+        return matLocal
+
+    def getPoseVertsMatrices(self, poseData):
+        """
+        Calculate the matPoseVerts matrices of all bones for a series of
+        poses at once, without changing the pose of this skeleton.
+
+        poseData    np.array((nFrames*nBones, 4, 4))
+            pose matrices ordered per frame - per bone, as in an
+            AnimationTrack
+
+        returns     np.array((nFrames, nBones, 4, 4))
+        """
+        matLocal = self.getPoseLocalMatrices(poseData)
+        matPoseGlobal = np.empty(matLocal.shape)
+        matPoseVerts = np.empty(matLocal.shape)
+        for bIdx, bone in enumerate(self.getBones()):
+            pose = matLocal[:,bIdx]
+            if bone.parent:
+                pose = np.einsum('fij,fjk->fik', matPoseGlobal[:,bone.parent.index], pose)
+            matPoseGlobal[:,bIdx] = pose
+            matPoseVerts[:,bIdx] = np.einsum('fij,jk->fik', pose, la.inv(bone.matRestGlobal))
+        return matPoseVerts
+
+    def skinBounds(self, poseData, meshCoords, vertBoneMapping, chunkSize = 32):
+        """
+        The bounding box of a mesh skinned with linear blend skinning, for
+        every pose in poseData (ordered as in an AnimationTrack). Frames are
+        skinned chunkSize at a time. Vertices that are not assigned to any
+        bone are left out.
+
+        returns     np.array((nFrames, 2, 3)) with the minimum and maximum
+                    coordinates of every frame
+        """
+        matPoseVerts = self.getPoseVertsMatrices(poseData)
+        nFrames = len(matPoseVerts)
+        meshCoords = np.asarray(meshCoords, dtype=np.float64)[:,:3]
+
+        used = np.zeros(len(meshCoords), dtype=bool)
+        mapping = []
+        for bname, (verts, weights) in vertBoneMapping.items():
+            verts = np.asarray(verts)
+            used[verts] = True
+            mapping.append((self.getBone(bname).index, verts, meshCoords[verts], np.asarray(weights, dtype=np.float64)))
+        usedVerts = np.flatnonzero(used)
+
+        bounds = np.zeros((nFrames, 2, 3))
+        for start in xrange(0, nFrames, chunkSize):
+            mats = matPoseVerts[start:start+chunkSize]
+            coords = np.zeros((len(mats), len(meshCoords), 3))
+            for bIdx, verts, vcoords, weights in mapping:
+                mat = mats[:,bIdx]
+                vec = np.einsum('fij,vj->fvi', mat[:,:3,:3], vcoords) + mat[:,None,:3,3]
+                coords[:,verts] += weights[None,:,None] * vec
+            if len(usedVerts):
+                coords = coords[:,usedVerts]
+                bounds[start:start+len(mats),0] = coords.min(axis=1)
+                bounds[start:start+len(mats),1] = coords.max(axis=1)
+        return bounds
+
     def getBones(self):
         """
         Returns linear list of all bones in breadth-first order.
@@ -691,30 +758,54 @@ def getProxyWeights(proxy, humanWeights, mesh):
 
     return boneWeights
 
-__referenceRig = None       # TODO this cache is not refreshed if human changes
-# TODO code replication is not nice...
-def loadTargetMapping(rigName, skel):
+def getShapeDigest(mesh):
     """
-    Returns mapping of skeleton bones to reference rig bone names.
-    Return format is a breadth-first ordered list with for each bone in the
-    skeleton respectively a reference bone name. Entries can be None if no
-    mapping to a bone exists.
-    This reference rig to skeleton mapping assumes both rigs have the same rest
-    pose.
+    A digest of the shape (vertex coordinates) of a mesh.
     """
-    global __referenceRig
-    import os
+    return hashlib.sha1(np.ascontiguousarray(mesh.coord).data).hexdigest()
 
-    path = os.path.join("tools/blender26x/mh_mocap_tool/target_rigs/", "%s.trg" % rigName)
-    if not os.path.isfile(path):
-        raise RuntimeError("File %s with skeleton rig mapping does not exist.", path)
+def getRestDigest(skel):
+    """
+    A digest of the bones and rest pose of a skeleton.
+    """
+    digest = hashlib.sha1()
+    for bone in skel.getBones():
+        digest.update(bone.name)
+        digest.update(np.ascontiguousarray(bone.matRestRelative, dtype=np.float32).data)
+    return digest.hexdigest()
+
+_referenceRig = (None, None)    # (shape digest, skeleton) of the reference rig
 
-    if not __referenceRig:
-        from core import G
+def getReferenceRig(mesh = None):
+    """
+    The soft1 reference rig fitted to mesh (the mesh of the selected human
+    by default). It is loaded again when the shape of the mesh changed.
+    """
+    global _referenceRig
+    import os
+
+    if mesh is None:
+        mesh = _getHumanMesh()
+    digest = getShapeDigest(mesh)
+    if _referenceRig[0] != digest:
         filename = os.path.join('data', 'rigs', 'soft1.rig')
-        __referenceRig, _ = loadRig(filename, G.app.selectedHuman.meshData)
-        print [bone.name for bone in __referenceRig.getBones()]
+        _referenceRig = (digest, loadRig(filename, mesh)[0])
+    return _referenceRig[1]
+
+_mappingFiles = {}
+
+def _readMappingFile(path, parse):
+    """
+    Parse a mapping file with parse(path), once as long as it is not modified.
+    """
+    import os
+
+    mtime = os.path.getmtime(path)
+    if path not in _mappingFiles or _mappingFiles[path][0] != mtime:
+        _mappingFiles[path] = (mtime, parse(path))
+    return _mappingFiles[path][1]
 
+def _parseTargetFile(path):
     fp = open(path, "r")
     status = 0
     bones = []
@@ -743,27 +834,46 @@ def loadTargetMapping(rigName, skel):
             elif status == 3:
                 renames[words[0]] = nameOrNone(words[1])
     fp.close()
-    #return (name, bones,renames,ikbones)
-
-    boneMap = {}
-    print [bone.name for bone in __referenceRig.getBones()]
-    print [bone.name for bone in skel.getBones()]
-    for (skelBone, refBone) in bones:
-        # Determine compensation orientation between source (ref) and target bone
-        tgtBone = skel.getBone(skelBone)
-        refBone = __referenceRig.getBone(refBone)
-        rotA = refBone.matRestRelative.copy()
-        rotB = tgtBone.matRestRelative.copy()
+    return bones
+
+_targetMappings = {}
+
+# TODO code replication is not nice...
+def loadTargetMapping(rigName, skel, mesh = None):
+    """
+    Returns mapping of skeleton bones to reference rig bone names.
+    Return format is a breadth-first ordered list with for each bone in the
+    skeleton respectively a reference bone name. Entries can be None if no
+    mapping to a bone exists.
+    This reference rig to skeleton mapping assumes both rigs have the same rest
+    pose.
+    Mappings are cached per target rig, rest pose of skel and shape of the
+    mesh the reference rig is fitted to.
+    """
+    import os
+
+    path = os.path.join("tools/blender26x/mh_mocap_tool/target_rigs/", "%s.trg" % rigName)
+    if not os.path.isfile(path):
+        raise RuntimeError("File %s with skeleton rig mapping does not exist.", path)
+
+    referenceRig = getReferenceRig(mesh)
+    bones = _readMappingFile(path, _parseTargetFile)
+
+    key = (path, _referenceRig[0], getRestDigest(skel))
+    if key not in _targetMappings:
+        # Determine compensation orientations between source (ref) and target bones, all at once
+        rotA = np.array([referenceRig.getBone(refBone).matRestRelative for _, refBone in bones], dtype=np.float64).reshape(-1, 4, 4)
+        rotB = np.array([skel.getBone(skelBone).matRestRelative for skelBone, _ in bones], dtype=np.float64).reshape(-1, 4, 4)
         # Rotation only
-        rotA[:3,3] = 0
-        rotB[:3,3] = 0
-        rotation = np.dot(rotA, la.inv(rotB))
-        #rotation = np.dot(rotA.transpose(), rotB)
-        boneMap[skelBone] = (refBone.name, rotation)
-        '''
-        boneMap[skelBone] = refBone
-        '''
-    return boneMap
+        rotA[:,:3,3] = 0
+        rotB[:,:3,3] = 0
+        rotations = np.einsum('nij,njk->nik', rotA, la.inv(rotB)).astype(np.float32)
+
+        boneMap = {}
+        for (skelBone, refBone), rotation in zip(bones, rotations):
+            boneMap[skelBone] = (referenceRig.getBone(refBone).name, rotation)
+        _cachePut(_targetMappings, key, boneMap)
+    return dict(_targetMappings[key])
 
 def loadTargetJointsMapping(rigName, skel):
     boneMap = loadTargetMapping(rigName, skel)
@@ -780,6 +890,9 @@ def loadSourceMapping(srcName):
     if not os.path.isfile(path):
         raise RuntimeError("File %s with skeleton source rig mapping does not exist.", path)
 
+    return dict(_readMappingFile(path, _parseSourceFile))
+
+def _parseSourceFile(path):
     log.message("Read source file %s", path)
     sourceMapping = {}
     fp = open(path, "r")
@@ -827,9 +940,42 @@ def __getRotation(bone, sourceMapping, targetMapping):
             return rot
     return 0.0
         
+# Number of retarget mappings kept in memory
+RetargetCacheSize = 16
+
+_retargetMappings = {}
+
+def _retargetKey(sourceRig, targetRig, skel):
+    key = (sourceRig, targetRig, getRestDigest(skel))
+    if _usesTargetMapping(targetRig):
+        key += (getShapeDigest(_getHumanMesh()), )
+    return key
+
+def _cachePut(cache, key, value):
+    if len(cache) >= RetargetCacheSize:
+        cache.clear()
+    cache[key] = value
+
 def getRetargetMapping(sourceRig, targetRig, skel):
-    import os
+    """
+    The mapping of the bones of skel to the joints of a BVH rig of type
+    sourceRig, as used by BVH.createAnimationTrack. Mappings are cached per
+    source rig, target rig, rest pose of skel and, for target rigs that are
+    mapped through the reference rig, the shape of the human.
+    """
+    key = _retargetKey(sourceRig, targetRig, skel)
+    if key not in _retargetMappings:
+        _cachePut(_retargetMappings, key, _getRetargetMapping(sourceRig, targetRig, skel))
+    return list(_retargetMappings[key])
 
+def _usesTargetMapping(targetRig):
+    return targetRig and targetRig != "soft1" and targetRig != "rigid" and targetRig != "mhx"
+
+def _getHumanMesh():
+    from core import G
+    return G.app.selectedHuman.meshData
+
+def _getRetargetMapping(sourceRig, targetRig, skel):
     sourceMapping = None
     targetMapping = None
     result = []
@@ -839,7 +985,7 @@ def getRetargetMapping(sourceRig, targetRig, skel):
         sourceMapping = loadSourceMapping(sourceRig)
 
     # Remap from reference rig to target rig
-    if targetRig and targetRig != "soft1" and targetRig != "rigid" and targetRig != "mhx":
+    if _usesTargetMapping(targetRig):
         targetMapping = loadTargetMapping(targetRig, skel)
 
     # Combine source and target mappings
@@ -876,3 +1022,81 @@ def getRetargetMapping(sourceRig, targetRig, skel):
         return [(bone.name, 0.0) for bone in skel.getBones()]
 
     return result
+
+class RetargetMapping(object):
+    """
+    A retarget mapping (as returned by getRetargetMapping) compiled into
+    stacked compensation matrices, so that it can be applied to all frames
+    and bones of a motion at once.
+
+    - **self.jointNames**: *list* The source joint of each target bone, None
+      for bones that are not animated.
+    - **self.left**, **self.right**: *float array (nBones,4,4)* The
+      compensation of each bone, the retargeted pose of a bone is
+      left * pose * right.
+    - **self.digest**: *string* A hash of the mapping.
+    """
+
+    def __init__(self, mapping):
+        import re
+
+        nBones = len(mapping)
+        self.jointNames = []
+        self.left = np.tile(np.identity(4), (nBones,1,1))
+        self.right = np.tile(np.identity(4), (nBones,1,1))
+        for bIdx, jName in enumerate(mapping):
+            if isinstance(jName, tuple):
+                jName, angle = jName
+            else:
+                angle = 0.0
+            if not jName:
+                self.jointNames.append(None)
+                continue
+            # Remove the tail from duplicate bone names, this also drops their compensation
+            r = re.search("(.*)_\d+$",jName)
+            if r:
+                jName = r.group(1)
+                angle = 0.0
+            self.jointNames.append(jName)
+
+            if isinstance(angle, float):
+                if angle != 0.0:
+                    # Rotate around global Z axis
+                    rot = tm.rotation_matrix(-angle*D, [0,0,1])
+                    # Roll around global Y axis (this is a limitation)
+                    roll = tm.rotation_matrix(angle*D, [0,1,0])
+                    self.right[bIdx] = np.dot(rot, roll)
+            else:
+                self.left[bIdx] = angle
+                self.right[bIdx] = la.inv(angle)
+
+        digest = hashlib.sha1(repr(self.jointNames))
+        digest.update(self.left.data)
+        digest.update(self.right.data)
+        self.digest = digest.hexdigest()
+
+    def retarget(self, poseData):
+        """
+        Apply the compensations to pose matrices of shape (nFrames, nBones, 4, 4),
+        ordered as the bones of the mapping.
+        """
+        return np.einsum('bij,fbjk,bkl->fbil', self.left, poseData, self.right)
+
+_compiledMappings = {}
+
+def getRetarget(sourceRig, targetRig, skel):
+    """
+    getRetargetMapping as a RetargetMapping, cached in the same way.
+    """
+    key = _retargetKey(sourceRig, targetRig, skel)
+    if key not in _compiledMappings:
+        _cachePut(_compiledMappings, key, RetargetMapping(getRetargetMapping(sourceRig, targetRig, skel)))
+    return _compiledMappings[key]
+
+def clearRetargetCache():
+    global _referenceRig
+    _referenceRig = (None, None)
+    _mappingFiles.clear()
+    _targetMappings.clear()
+    _retargetMappings.clear()
+    _compiledMappings.clear()
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Quaternion conversions, pose decomposition and resampling of animation
+tracks.
+"""
+
+import testpath
+
+import unittest
+import numpy as np
+
+import animation
+
+def rotationsZ(angles):
+    """
+    (n,4,4) pose matrices rotating by angles around the z axis.
+    """
+    poses = np.tile(np.identity(4), (len(angles), 1, 1))
+    poses[:,0,0] = poses[:,1,1] = np.cos(angles)
+    poses[:,1,0] = np.sin(angles)
+    poses[:,0,1] = -np.sin(angles)
+    return poses
+
+def randomRotations(n, seed = 0):
+    rs = np.random.RandomState(seed)
+    q = rs.normal(size=(n, 4))
+    q /= np.sqrt(np.sum(q ** 2, axis=-1))[:,None]
+    return animation.quaternionsToMatrices(q)
+
+class QuaternionTest(unittest.TestCase):
+
+    def testRoundTrip(self):
+        rot = randomRotations(1000)
+        np.testing.assert_allclose(np.einsum('nij,nkj->nik', rot, rot), np.tile(np.identity(3), (1000, 1, 1)), atol=1e-12)
+        q = animation.matricesToQuaternions(rot)
+        np.testing.assert_allclose(np.sum(q ** 2, axis=-1), 1, atol=1e-12)
+        np.testing.assert_allclose(animation.quaternionsToMatrices(q), rot, atol=1e-12)
+
+    def testDecompose(self):
+        rs = np.random.RandomState(1)
+        poses = np.tile(np.identity(4), (100, 1, 1))
+        poses[:,:3,:3] = randomRotations(100) * rs.uniform(0.5, 2, (100, 1, 3))
+        poses[:,:3,3] = rs.normal(size=(100, 3))
+        # Reflections are kept in the scale
+        poses[::7,:3,0] *= -1
+        quats, trans, scale = animation.decomposePoses(poses)
+        self.assertTrue(np.all(scale[::7,0] < 0))
+        np.testing.assert_allclose(animation.composePoses(quats, trans, scale, np.float64), poses, atol=1e-12)
+
+    def testInterpolation(self):
+        q = animation.matricesToQuaternions(rotationsZ(np.array([0.0, 2.0]))[:,:3,:3])
+        for fraction in (0.0, 0.25, 0.5, 1.0):
+            result = animation.slerp(q[:1], q[1:], fraction)
+            expected = animation.matricesToQuaternions(rotationsZ(np.array([2.0 * fraction]))[:,:3,:3])
+            np.testing.assert_allclose(np.abs(np.sum(result * expected, axis=-1)), 1, atol=1e-12)
+        # nlerp takes the same path, at a different speed
+        result = animation.nlerp(q[:1], q[1:], 0.5)
+        expected = animation.matricesToQuaternions(rotationsZ(np.array([1.0]))[:,:3,:3])
+        np.testing.assert_allclose(np.abs(np.sum(result * expected, axis=-1)), 1, atol=1e-12)
+
+class ResampleTest(unittest.TestCase):
+
+    def makeTrack(self, nFrames, frameRate, speed = 0.3):
+        # Two bones, one turning at a constant speed and moving along x, one
+        # at rest
+        frames = np.arange(nFrames)
+        poses = np.tile(np.identity(4), (nFrames, 2, 1, 1))
+        poses[:,0] = rotationsZ(speed * frames)
+        poses[:,0,0,3] = frames
+        return animation.AnimationTrack('test', poses.reshape(-1, 4, 4).astype(np.float32), nFrames, frameRate)
+
+    def testUpsample(self):
+        for interpolationType in (1, 2):
+            track = self.makeTrack(11, 10)
+            track.resample(30, interpolationType)
+            self.assertEqual(track.nFrames, 31)
+            self.assertEqual(track.frameRate, 30)
+            self.assertEqual(track.data.shape, (62, 4, 4))
+            self.assertEqual(track.data.dtype, np.float32)
+
+            poses = track.data.reshape(31, 2, 4, 4)
+            original = self.makeTrack(11, 10).data.reshape(11, 2, 4, 4)
+            np.testing.assert_allclose(poses[::3], original, atol=1e-6)
+            np.testing.assert_allclose(poses[:,1], np.tile(np.identity(4), (31, 1, 1)), atol=1e-6)
+            np.testing.assert_allclose(poses[:,0,0,3], np.arange(31) / 3.0, atol=1e-5)
+            if interpolationType == 2:
+                # Spherical interpolation keeps the speed constant
+                np.testing.assert_allclose(poses[:,0,:3,:3], rotationsZ(0.1 * np.arange(31))[:,:3,:3], atol=1e-5)
+
+    def testDownsample(self):
+        track = self.makeTrack(31, 30)
+        expected = track.data.reshape(31, 2, 4, 4)[::3].copy()
+        track.resample(10, 0)
+        self.assertEqual(track.nFrames, 11)
+        np.testing.assert_array_equal(track.data.reshape(11, 2, 4, 4), expected)
+        self.assertRaises(RuntimeError, track.sparsify, 20)
+
+    def testGetAtTime(self):
+        track = self.makeTrack(11, 10)
+        track.interpolationType = 2
+        np.testing.assert_allclose(track.getAtTime(0.2), track.getAtFramePos(2))
+        pose = track.getAtTime(0.25)
+        np.testing.assert_allclose(pose[0,:3,:3], rotationsZ(np.array([0.75]))[0,:3,:3], atol=1e-6)
+        self.assertAlmostEqual(pose[0,0,3], 2.5, 5)
+
+if __name__ == '__main__':
+    unittest.main()
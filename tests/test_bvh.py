@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Conversions between Euler angles and rotation matrices for all axis orders,
+and the round trip of motions through BVH files.
+"""
+
+import testpath
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import transformations as tm
+import bvh
+
+class EulerTest(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.angles = rs.uniform(-np.pi, np.pi, (3, 200))
+        # Gimbal lock
+        self.angles[1,:20] = np.pi/2
+        self.angles[1,20:40] = 0
+
+    def testAxes(self):
+        self.assertEqual(len(tm._AXES2TUPLE), 24)
+        ai, aj, ak = self.angles
+        for axes, axesTuple in tm._AXES2TUPLE.items():
+            rot = bvh.eulerToMatrices(ai, aj, ak, axes)
+            np.testing.assert_allclose(bvh.eulerToMatrices(ai, aj, ak, axesTuple), rot)
+            for n in range(0, len(ai), 13):
+                np.testing.assert_allclose(rot[n], tm.euler_matrix(ai[n], aj[n], ak[n], axes)[:3,:3], atol=1e-12, err_msg=axes)
+
+            angles = bvh.matricesToEuler(rot, axes)
+            for n in range(0, len(ai), 13):
+                np.testing.assert_allclose([a[n] for a in angles], tm.euler_from_matrix(rot[n], axes), atol=1e-12, err_msg=axes)
+            # Angles can differ at gimbal lock, the rotations do not
+            np.testing.assert_allclose(bvh.eulerToMatrices(angles[0], angles[1], angles[2], axes), rot, atol=1e-7, err_msg=axes)
+
+    def testPoseMatrices(self):
+        poses = np.tile(np.identity(4), (len(self.angles[0]), 1, 1))
+        poses[:,:3,:3] = bvh.eulerToMatrices(self.angles[0], self.angles[1], self.angles[2], 'rzxy')
+        poses[:,:3,3] = 1
+        np.testing.assert_allclose(bvh.matricesToEuler(poses, 'rzxy'), bvh.matricesToEuler(poses[:,:3,:3], 'rzxy'))
+
+class BVHTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, True)
+
+    def testReadWrite(self):
+        original = bvh.load(os.path.join('data', 'bvhs', '10_01.bvh'))
+        filename = os.path.join(self.folder, 'copy.bvh')
+        original.writeToFile(filename)
+        result = bvh.load(filename)
+        self.assertEqual([joint.name for joint in result.getJointsBVHOrder()],
+                         [joint.name for joint in original.getJointsBVHOrder()])
+        self.assertEqual(result.frameCount, original.frameCount)
+        self.assertAlmostEqual(result.frameTime, original.frameTime, 6)
+        np.testing.assert_allclose(result.getChannelData(), original.getChannelData(), atol=1e-5)
+        for joint, resultJoint in zip(original.getJointsBVHOrder(), result.getJointsBVHOrder()):
+            np.testing.assert_allclose(resultJoint.offset, joint.offset, atol=1e-5)
+
+        # Motion given as channel data
+        channelData = original.getChannelData()
+        result = bvh.load(filename, channelData = channelData)
+        for joint, resultJoint in zip(original.getJointsBVHOrder(), result.getJointsBVHOrder()):
+            np.testing.assert_array_equal(resultJoint.matrixPoses, joint.matrixPoses)
+
+    def testFromSkeleton(self):
+        original = bvh.load(os.path.join('data', 'bvhs', '10_01.bvh'))
+        skel = original.createSkeleton()
+        jointsOrder = [bone.name for bone in skel.getBones()]
+        track = original.createAnimationTrack(jointsOrder)
+
+        filename = os.path.join(self.folder, 'skeleton.bvh')
+        bvh.createFromSkeleton(skel, track).writeToFile(filename)
+        result = bvh.load(filename)
+        self.assertEqual(result.frameCount, track.nFrames)
+        self.assertAlmostEqual(1.0 / result.frameTime, track.frameRate, 3)
+        resultTrack = result.createAnimationTrack(jointsOrder)
+        np.testing.assert_allclose(resultTrack.data, track.data, atol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Structure of the .glb files written by the glTF exporter: the chunks, buffer
+views and accessors, and the mesh data read back from the binary chunk.
+"""
+
+import testpath
+testpath.addPluginPath('9_export_gltf')
+
+import os
+import json
+import struct
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import files3d
+import exportutils.config
+import mh2gltf
+
+class MeshInfo(object):
+    def __init__(self, obj, shapes):
+        self.object = obj
+        self.shapes = shapes
+
+class Stuff(object):
+    def __init__(self, name, obj, shapes):
+        self.name = name
+        self.meshInfo = MeshInfo(obj, shapes)
+        self.material = None
+        self.type = None
+        self.proxy = None
+        self.texture = None
+
+class Config(exportutils.config.Config):
+    def getTexturePath(self, filename, folder, isTexture, human):
+        return filename
+
+def readGlb(filepath):
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    magic, version, length = struct.unpack_from('<4sII', data, 0)
+    jsonLength, jsonType = struct.unpack_from('<I4s', data, 12)
+    gltf = json.loads(data[20:20+jsonLength])
+    binLength, binType = struct.unpack_from('<I4s', data, 20+jsonLength)
+    binary = data[28+jsonLength:28+jsonLength+binLength]
+    return (magic, version, length, len(data)), (jsonLength, jsonType), (binLength, binType), gltf, binary
+
+ComponentSizes = {mh2gltf.UnsignedShort: 2, mh2gltf.UnsignedInt: 4, mh2gltf.Float: 4}
+TypeSizes = {'SCALAR': 1, 'VEC2': 2, 'VEC3': 3, 'VEC4': 4, 'MAT4': 16}
+
+class GlbTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mesh = files3d.loadMesh(os.path.join('data', '3dobjs', 'base.obj'))
+        cls.folder = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder, True)
+
+    def writeMesh(self, shapes):
+        gltf = {'asset': {'version': '2.0'}, 'meshes': [], 'materials': [], 'textures': [], 'images': []}
+        buf = mh2gltf.GlbBuffer()
+        stuff = Stuff('base', self.mesh, shapes)
+        mh2gltf.addMesh(gltf, buf, None, stuff, None, Config())
+        filepath = os.path.join(self.folder, 'base.glb')
+        mh2gltf.writeGlb(filepath, gltf, buf)
+        return filepath
+
+    def testUnweld(self):
+        # The same unwelding and normals as the render buffers, without
+        # touching those of the mesh
+        reference = files3d.loadMesh(os.path.join('data', '3dobjs', 'base.obj'))
+        reference.calcFaceNormals()
+        reference.calcVertexNormals()
+        reference.updateIndexBuffer()
+        vmap, tmap, faces = mh2gltf.unweldMesh(self.mesh)
+        np.testing.assert_array_equal(vmap, reference.vmap)
+        np.testing.assert_array_equal(tmap, reference.tmap)
+        np.testing.assert_array_equal(faces, reference.r_faces)
+        np.testing.assert_allclose(mh2gltf.getVertexNormals(self.mesh), reference.vnorm, atol=1e-5)
+
+    def testMeshUnchanged(self):
+        rCoord = getattr(self.mesh, 'r_coord', None)
+        vnorm = self.mesh.vnorm.copy()
+        self.writeMesh([])
+        self.assertTrue(getattr(self.mesh, 'r_coord', None) is rCoord)
+        np.testing.assert_array_equal(self.mesh.vnorm, vnorm)
+
+    def testStructure(self):
+        verts = np.arange(100, 200, dtype=np.int32)
+        deltas = np.ones((100, 3), dtype=np.float32) * 0.5
+        filepath = self.writeMesh([('test', (verts, deltas)), ('empty', (np.zeros(0, np.int32), np.zeros((0,3), np.float32)))])
+        (magic, version, length, size), (jsonLength, jsonType), (binLength, binType), gltf, binary = readGlb(filepath)
+
+        self.assertEqual((magic, version, length), ('glTF', 2, size))
+        self.assertEqual(jsonType, 'JSON')
+        self.assertEqual(binType, 'BIN\x00')
+        self.assertEqual(jsonLength % 4, 0)
+        self.assertEqual(binLength % 4, 0)
+        self.assertEqual(20 + jsonLength + 8 + binLength, size)
+        self.assertEqual(gltf['buffers'], [{'byteLength': binLength}])
+
+        for view in gltf['bufferViews']:
+            self.assertEqual(view['byteOffset'] % 4, 0)
+            self.assertTrue(view['byteOffset'] + view['byteLength'] <= binLength)
+
+        for accessor in gltf['accessors']:
+            elementSize = ComponentSizes[accessor['componentType']] * TypeSizes[accessor['type']]
+            if 'bufferView' in accessor:
+                view = gltf['bufferViews'][accessor['bufferView']]
+                stride = view.get('byteStride', elementSize)
+                end = accessor.get('byteOffset', 0) + stride * (accessor['count'] - 1) + elementSize
+                self.assertTrue(end <= view['byteLength'])
+            if 'sparse' in accessor:
+                sparse = accessor['sparse']
+                indexView = gltf['bufferViews'][sparse['indices']['bufferView']]
+                indices = np.frombuffer(binary, np.uint32, sparse['count'], indexView['byteOffset'])
+                self.assertTrue(np.all(indices < accessor['count']))
+                self.assertTrue(np.all(np.diff(indices.astype(np.int64)) > 0))
+
+        # Vertex data read back
+        vmap, tmap, faces = mh2gltf.unweldMesh(self.mesh)
+        primitive = gltf['meshes'][0]['primitives'][0]
+        position = gltf['accessors'][primitive['attributes']['POSITION']]
+        view = gltf['bufferViews'][position['bufferView']]
+        records = np.frombuffer(binary, mh2gltf.VertexRecord, position['count'], view['byteOffset'])
+        np.testing.assert_array_equal(records['position'], self.mesh.coord[vmap])
+        np.testing.assert_allclose(position['min'], self.mesh.coord.min(axis=0), rtol=1e-6)
+        np.testing.assert_allclose(position['max'], self.mesh.coord.max(axis=0), rtol=1e-6)
+        np.testing.assert_allclose(np.sum(records['normal'] ** 2, axis=-1), 1, atol=1e-4)
+
+        indices = gltf['accessors'][primitive['indices']]
+        self.assertEqual(indices['count'] % 3, 0)
+        self.assertEqual(indices['count'], 3 * (2 * len(faces) - np.sum(self.mesh.fvert[:,0] == self.mesh.fvert[:,3])))
+
+        # Only the shape key that moves vertices, with the moved vertices
+        self.assertEqual(len(primitive['targets']), 1)
+        self.assertEqual(gltf['meshes'][0]['extras']['targetNames'], ['test'])
+        target = gltf['accessors'][primitive['targets'][0]['POSITION']]
+        self.assertEqual(target['sparse']['count'], np.sum(np.in1d(vmap, verts)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Indexing and caching of BVH files by the motion library.
+"""
+
+import testpath
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import files3d
+import skeleton
+import bvh
+import motionlibrary
+
+class MotionLibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.folder, 'cache')
+        self.motions = os.path.join(self.folder, 'motions')
+        os.makedirs(os.path.join(self.motions, 'walks'))
+        self.files = [os.path.join(self.motions, 'cmu_mb_01_01.bvh'),
+                      os.path.join(self.motions, 'walks', '10_01.bvh')]
+        shutil.copy(os.path.join('data', 'people_export', 'cmu_mb_01_01.bvh'), self.files[0])
+        shutil.copy(os.path.join('data', 'bvhs', '10_01.bvh'), self.files[1])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, True)
+
+    def testScan(self):
+        library = motionlibrary.MotionLibrary(self.motions, self.cacheDir)
+        self.assertEqual(len(library), 0)
+        self.assertEqual(library.scan(), 2)
+        self.assertEqual(library.scan(), 0)
+        self.assertEqual([clip.path for clip in library], self.files)
+        self.assertTrue('10_01' in library)
+
+        for filename in self.files:
+            original = bvh.load(filename)
+            clip = library.getClip(filename)
+            self.assertEqual((clip.frameCount, clip.channelCount), original.getChannelData().shape)
+            self.assertAlmostEqual(clip.frameTime, original.frameTime)
+            np.testing.assert_array_equal(library.getChannelData(clip), original.getChannelData())
+            result = library.getBVH(clip)
+            for joint, resultJoint in zip(original.getJointsBVHOrder(), result.getJointsBVHOrder()):
+                np.testing.assert_array_equal(resultJoint.matrixPoses, joint.matrixPoses)
+
+        # The index is shared with a new library of the same folder
+        library = motionlibrary.MotionLibrary(self.motions, self.cacheDir)
+        self.assertEqual([clip.path for clip in library], self.files)
+        self.assertEqual(library.scan(), 0)
+
+        # Changed and removed files
+        with open(self.files[1], 'r') as f:
+            lines = f.readlines()
+        with open(self.files[1], 'w') as f:
+            for line in lines:
+                f.write('Frames: 100\n' if line.startswith('Frames:') else line)
+        os.remove(self.files[0])
+        self.assertEqual(library.scan(), 1)
+        self.assertEqual([clip.path for clip in library], self.files[1:])
+        self.assertEqual(library.getChannelData(self.files[1]).shape[0], 100)
+
+        digest = library.getClip(self.files[1]).digest
+        library.clearCache()
+        self.assertEqual(len(library), 0)
+        self.assertEqual([name for name in os.listdir(self.cacheDir) if name.startswith(digest)], [])
+
+    def testAnimationTrack(self):
+        mesh = files3d.loadMesh(os.path.join('data', '3dobjs', 'base.obj'))
+        skel, _ = skeleton.loadRig(os.path.join('data', 'rigs', 'soft1.rig'), mesh)
+        library = motionlibrary.MotionLibrary(self.motions, self.cacheDir)
+        library.scan()
+
+        expected = bvh.load(self.files[0])
+        expected.scale(0.25)
+        expected = expected.createAnimationTrack(skeleton.getRetarget('mb', 'soft1', skel))
+        for i in range(2):
+            # Computed, then memory mapped from the cache
+            track = library.getAnimationTrack(self.files[0], skel, 'soft1', 'mb', 0.25)
+            self.assertEqual(track.name, 'cmu_mb_01_01')
+            self.assertEqual((track.nFrames, track.nBones), (expected.nFrames, len(skel.getBones())))
+            self.assertAlmostEqual(track.frameRate, expected.frameRate, 3)
+            np.testing.assert_allclose(track.data, expected.data, atol=1e-6)
+        self.assertTrue(isinstance(track.data, np.memmap))
+
+if __name__ == '__main__':
+    unittest.main()
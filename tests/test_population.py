@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Parsing of .mhm files into model tables and the round trip of model tables
+through population files.
+"""
+
+import testpath
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import population
+
+Characters = [
+    """version 1.0.0
+tags test
+macro Gender 0.250000
+macro Age 0.500000
+detail l-eye-move-down 0.100000
+custom belly 0.750000
+proxy data/proxymeshes/male/male.proxy
+clothes data/clothes/tshirt/tshirt_longsleeves_medium.mhclo
+clothes data/clothes/jeans/jeans_medium.mhclo
+skeleton soft1.rig
+""",
+    """version 1.0.0
+macro Gender 1.000000
+expression expression-units-mouth-open 0.300000
+skeleton game.rig
+""",
+    """# An old file
+Gender 0.5
+Age 0.2
+""",
+    ]
+
+class PopulationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filenames = []
+        for i, text in enumerate(Characters):
+            filename = os.path.join(self.folder, 'character%d.mhm' % i)
+            with open(filename, 'w') as f:
+                f.write(text)
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, True)
+
+    def testParse(self):
+        values, choices = population.parseMhm(self.filenames[0])
+        self.assertEqual(values, {'macro/Gender': 0.25, 'macro/Age': 0.5,
+                                  'detail/l-eye-move-down': 0.1, 'custom/belly': 0.75})
+        self.assertEqual(choices, {'proxy': ['data/proxymeshes/male/male.proxy'],
+                                   'clothes': ['data/clothes/tshirt/tshirt_longsleeves_medium.mhclo',
+                                               'data/clothes/jeans/jeans_medium.mhclo'],
+                                   'skeleton': ['soft1.rig']})
+
+        values, choices = population.parseMhm(self.filenames[2])
+        self.assertEqual(values, {'Gender': 0.5, 'Age': 0.2})
+        self.assertEqual(choices, {})
+
+    def testModelTable(self):
+        table = population.loadModels(self.filenames + [os.path.join(self.folder, 'missing.mhm')], processes = 1)
+        self.assertEqual(table.names, self.filenames)
+        self.assertEqual(table.values.shape, (3, len(table.columns)))
+        self.assertTrue(np.isnan(table.column('custom/belly')[1]))
+        for i, filename in enumerate(self.filenames):
+            values, choices = table.getCharacter(i)
+            expected, expectedChoices = population.parseMhm(filename)
+            self.assertEqual(sorted(values.keys()), sorted(expected.keys()))
+            for key, value in expected.items():
+                self.assertAlmostEqual(values[key], value, 6)
+            self.assertEqual(choices, expectedChoices)
+
+    def testRoundTrip(self):
+        table = population.loadModels(self.filenames, processes = 1)
+        for dtype, tolerance in ((np.float32, 0), (np.float16, 1e-3)):
+            filename = os.path.join(self.folder, 'population.mhpop')
+            population.writePopulation(filename, table, dtype)
+            pop = population.readPopulation(filename)
+            self.assertEqual(len(pop), len(table))
+            self.assertEqual(pop.columns, table.columns)
+            self.assertEqual(pop.choiceKeys, table.choiceKeys)
+            result = pop.getTable()
+            np.testing.assert_array_equal(np.isnan(result.values), np.isnan(table.values))
+            np.testing.assert_allclose(np.nan_to_num(result.values), np.nan_to_num(table.values), atol=tolerance)
+            self.assertEqual(result.choices, table.choices)
+            del pop, result
+
+    def testStreaming(self):
+        table = population.loadModels(self.filenames * 5, processes = 1)
+        filename = os.path.join(self.folder, 'population.mhpop')
+        with population.PopulationWriter(filename, table.columns, table.choiceKeys) as writer:
+            writer.writeTable(table, 0, 7)
+            writer.writeTable(table, 7)
+        pop = population.readPopulation(filename)
+        tables = list(pop.iterTables(4))
+        self.assertEqual([len(t) for t in tables], [4, 4, 4, 3])
+        values = np.vstack([t.values for t in tables])
+        np.testing.assert_array_equal(np.nan_to_num(values), np.nan_to_num(table.values))
+        self.assertEqual(pop.getCharacter(11), table.getCharacter(11))
+        del pop, tables
+
+if __name__ == '__main__':
+    unittest.main()
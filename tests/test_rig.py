@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Compiled .rig files must give the same locations, armature and weights as
+parsing and evaluating the file line by line.
+"""
+
+import testpath
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import files3d
+import skeleton
+import exportutils.rig
+
+def parseRigFile(path, obj):
+    """
+    The .rig file parser that compiled rigs replace, as reference.
+    """
+    locations = {}
+    armature = []
+    weights = {}
+    status = None
+    for line in open(path, "rU"):
+        words = line.split()
+        if len(words) == 0:
+            pass
+        elif words[0] == '#':
+            status = words[1]
+            if status == 'weights':
+                wts = weights[words[2]] = []
+        elif status == 'weights':
+            wts.append((int(words[0]), float(words[1])))
+        elif status == 'locations':
+            exportutils.rig.setupRigJoint(words, obj, obj.coord, locations)
+        elif status == 'bones':
+            armature.append((words[0], locations[words[1]], locations[words[2]], float(words[3]), words[4],
+                             exportutils.rig._parseOptions(words[5:])))
+    return locations, armature, weights
+
+def getRigFiles():
+    folder = os.path.join('data', 'rigs')
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith('.rig')]
+
+class CompiledRigTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mesh = files3d.loadMesh(os.path.join('data', '3dobjs', 'base.obj'))
+        cls.cacheDir = tempfile.mkdtemp()
+        exportutils.rig.CacheDir = cls.cacheDir
+
+    @classmethod
+    def tearDownClass(cls):
+        exportutils.rig.CacheDir = None
+        exportutils.rig.clearRigCache()
+        shutil.rmtree(cls.cacheDir, True)
+
+    def assertSameRig(self, expected, result):
+        locations, armature, weights = expected
+        newLocations, newArmature, newWeights = result
+        self.assertEqual(sorted(locations.keys()), sorted(newLocations.keys()))
+        for key, loc in locations.items():
+            np.testing.assert_allclose(newLocations[key], loc, atol=1e-5, err_msg=key)
+
+        self.assertEqual(len(armature), len(newArmature))
+        for (bone, head, tail, roll, parent, options), newBone in zip(armature, newArmature):
+            self.assertEqual((bone, roll, parent, options),
+                             (newBone[0], newBone[3], newBone[4], newBone[5]))
+            np.testing.assert_allclose(newBone[1], head, atol=1e-5, err_msg=bone)
+            np.testing.assert_allclose(newBone[2], tail, atol=1e-5, err_msg=bone)
+
+        self.assertEqual(weights, newWeights)
+
+    def testRigFiles(self):
+        rigFiles = getRigFiles()
+        self.assertTrue(rigFiles)
+        for filename in rigFiles:
+            expected = parseRigFile(filename, self.mesh)
+            exportutils.rig.clearRigCache()
+            self.assertSameRig(expected, exportutils.rig.readRigFile(filename, self.mesh, locations={}))
+            # From memory and from the .npz file in the cache directory
+            self.assertSameRig(expected, exportutils.rig.readRigFile(filename, self.mesh, locations={}))
+            exportutils.rig.clearRigCache()
+            self.assertSameRig(expected, exportutils.rig.readRigFile(filename, self.mesh, locations={}))
+        self.assertEqual(len([name for name in os.listdir(self.cacheDir) if name.endswith('.npz')]), len(rigFiles))
+
+    def testEmptyJoints(self):
+        rig = exportutils.rig.CompiledRig()
+        rig.names = ['empty', 'joint', 'last']
+        rig.jointTargets = np.array([0, 1, 2], dtype=np.int32)
+        rig.jointIndptr = np.array([0, 0, 2, 2], dtype=np.int32)
+        rig.jointVerts = np.array([0, 1], dtype=np.int32)
+        locations = rig.getLocationArray(self.mesh)
+        self.assertTrue(np.all(np.isnan(locations[[0, 2]])))
+        np.testing.assert_allclose(locations[1], self.mesh.coord[:2].mean(axis=0), atol=1e-5)
+
+    def testBoneWeights(self):
+        filename = os.path.join('data', 'rigs', 'soft1.rig')
+        _, armature, weights = parseRigFile(filename, self.mesh)
+        skel, boneWeights = skeleton.loadRig(filename, self.mesh)
+        self.assertEqual(sorted(bone.name for bone in skel.getBones()), sorted(bone[0] for bone in armature))
+
+        total = np.zeros(self.mesh.getVertexCount())
+        for verts, values in boneWeights.values():
+            np.add.at(total, np.asarray(verts), values)
+        np.testing.assert_allclose(total, 1.0, atol=1e-5)
+
+        for name, wts in weights.items():
+            if not wts:
+                continue
+            verts, values = boneWeights[name]
+            self.assertEqual(list(verts[:len(wts)]), [v for v, _ in wts])
+
+    def testReferenceRig(self):
+        skeleton.clearRetargetCache()
+        mesh = files3d.loadMesh(os.path.join('data', '3dobjs', 'base.obj'))
+        rig = skeleton.getReferenceRig(mesh)
+        self.assertTrue(skeleton.getReferenceRig(mesh) is rig)
+        name = rig.getBones()[-1].name
+        head = rig.getBone(name).headPos.copy()
+
+        # The reference rig follows the shape of the mesh
+        mesh.changeCoords(mesh.coord * 2)
+        scaled = skeleton.getReferenceRig(mesh)
+        self.assertFalse(scaled is rig)
+        np.testing.assert_allclose(scaled.getBone(name).headPos, head * 2, rtol=1e-5, atol=1e-5)
+        skeleton.clearRetargetCache()
+
+if __name__ == '__main__':
+    unittest.main()
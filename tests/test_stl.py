@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Record layout of binary STL files and the triangles written by the STL
+exporters.
+"""
+
+import testpath
+testpath.addPluginPath('9_export_stl')
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import files3d
+import mh2stl
+
+class MeshInfo(object):
+    def __init__(self, obj):
+        self.object = obj
+
+class Stuff(object):
+    def __init__(self, name, obj):
+        self.name = name
+        self.meshInfo = MeshInfo(obj)
+
+class StlTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mesh = files3d.loadMesh(os.path.join('data', '3dobjs', 'base.obj'))
+        cls.folder = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder, True)
+
+    def setUp(self):
+        # Export the base mesh twice, without a human and export config
+        self.stuffs = [Stuff('base', self.mesh), Stuff('copy', self.mesh)]
+        self._setupStuffs = mh2stl._setupStuffs
+        mh2stl._setupStuffs = lambda human, filepath, config: ('base mesh', self.stuffs)
+
+    def tearDown(self):
+        mh2stl._setupStuffs = self._setupStuffs
+
+    def testRecordLayout(self):
+        self.assertEqual(mh2stl.StlRecord.itemsize, 50)
+        self.assertEqual([mh2stl.StlRecord.fields[name][1] for name in ('normal', 'vertices', 'attribute')], [0, 12, 48])
+
+    def testTriangles(self):
+        coords, normals = mh2stl.getTriangles(self.stuffs[:1])
+        fvert = self.mesh.fvert
+        isQuad = fvert[:,0] != fvert[:,3]
+        self.assertEqual(coords.shape, (len(fvert) + np.sum(isQuad), 3, 3))
+        self.assertEqual(normals.shape, (len(coords), 3))
+        self.assertEqual(coords.dtype, np.float32)
+
+        # The triangles of each face, in face order
+        expected = []
+        for fv, quad in zip(fvert, isQuad):
+            expected.append(fv[[0, 1, 2]])
+            if quad:
+                expected.append(fv[[2, 3, 0]])
+        np.testing.assert_array_equal(coords, self.mesh.coord[np.array(expected)])
+
+        np.testing.assert_allclose(np.sum(normals ** 2, axis=-1), 1, atol=1e-5)
+        cross = np.cross(coords[:,1] - coords[:,0], coords[:,2] - coords[:,0])
+        self.assertTrue(np.all(np.sum(cross * normals, axis=-1) >= 0))
+
+        empty = mh2stl.getTriangles([])
+        self.assertEqual((empty[0].shape, empty[1].shape), ((0, 3, 3), (0, 3)))
+
+    def testBinary(self):
+        coords, normals = mh2stl.getTriangles(self.stuffs)
+        filepath = os.path.join(self.folder, 'base.stl')
+        mh2stl.exportStlBinary(None, filepath, None)
+        self.assertEqual(os.path.getsize(filepath), 84 + 50 * len(coords))
+        with open(filepath, 'rb') as f:
+            header = f.read(80)
+            count = np.fromfile(f, '<u4', 1)[0]
+            records = np.fromfile(f, mh2stl.StlRecord)
+        self.assertEqual(header, '\x00' * 80)
+        self.assertEqual(count, len(coords))
+        self.assertEqual(len(records), count)
+        np.testing.assert_array_equal(records['normal'], normals)
+        np.testing.assert_array_equal(records['vertices'], coords)
+        np.testing.assert_array_equal(records['attribute'], 0)
+
+    def testAscii(self):
+        coords, normals = mh2stl.getTriangles(self.stuffs)
+        filepath = os.path.join(self.folder, 'base.stl')
+        mh2stl.exportStlAscii(None, filepath, None)
+        with open(filepath) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'solid base_mesh')
+        self.assertEqual(lines[-1], 'endsolid base_mesh')
+        self.assertEqual(len(lines), 2 + 7 * len(coords))
+        facets = [line.split() for line in lines[1:-1]]
+        self.assertEqual(set(words[0] for words in facets[2::7]), set(['vertex']))
+        values = np.array([words[-3:] for i, words in enumerate(facets) if i % 7 in (0, 2, 3, 4)], dtype=np.float32)
+        values = values.reshape(-1, 4, 3)
+        np.testing.assert_allclose(values[:,0], normals, atol=1e-5)
+        np.testing.assert_allclose(values[:,1:], coords, atol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
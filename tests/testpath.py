@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+**Project Name:**      MakeHuman
+
+**Product Home Page:** http://www.makehuman.org/
+
+**Code Home Page:**    http://code.google.com/p/makehuman/
+
+**Authors:**           MakeHuman Team
+
+**Copyright(c):**      MakeHuman Team 2001-2013
+
+**Licensing:**         AGPL3 (see also http://www.makehuman.org/node/318)
+
+**Coding Standards:**  See http://www.makehuman.org/node/165
+
+Abstract
+--------
+
+Sets up the module path for the tests as makehuman.py does, and changes to
+the root of the source tree, where the data paths are relative to.
+
+Import this first in every test module. Run the tests from the root of the
+source tree with:
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+
+rootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def recursiveDirNames(root):
+    pathlist = []
+    for filename in os.listdir(root):
+        path = os.path.join(root, filename)
+        if os.path.isdir(path) and filename != ".svn":
+            pathlist.append(path)
+            pathlist = pathlist + recursiveDirNames(path)
+    return pathlist
+
+def setSysPath():
+    syspath = [rootDir] + [os.path.join(rootDir, d) for d in ("lib", "apps", "shared")]
+    syspath = syspath + recursiveDirNames(os.path.join(rootDir, "apps"))
+    syspath.append(os.path.join(rootDir, "core"))
+    syspath = syspath + recursiveDirNames(os.path.join(rootDir, "core"))
+    syspath.append(os.path.join(rootDir, "plugins"))
+    sys.path = syspath + [path for path in sys.path if path not in syspath]
+
+def addPluginPath(plugin):
+    """
+    Make the modules of a plugin folder, such as 9_export_stl, importable.
+    """
+    path = os.path.join(rootDir, "plugins", plugin)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+setSysPath()
+os.chdir(rootDir)